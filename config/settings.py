@@ -87,13 +87,78 @@ SESSION_NAME = env_str("SESSION_NAME", "reposter_session")
 USER_API_ID = env_int("USER_API_ID")
 USER_API_HASH = env_str("USER_API_HASH")
 USER_SESSION_NAME = env_str("USER_SESSION_NAME", "reposter_user_session")
+# Несколько user-сессий через запятую (первая — основная); по умолчанию одна USER_SESSION_NAME
+USER_SESSION_NAMES = [
+    name.strip() for name in env_str("USER_SESSION_NAMES", "").split(",") if name.strip()
+] or [USER_SESSION_NAME]
 
 # Общие настройки
 OWNER_IDS = parse_owner_ids()
 DB_PATH = env_str("DB_PATH", "forwarder.db")
+DB_CACHE_SIZE_KB = env_int("DB_CACHE_SIZE_KB", 8192) or 8192
+DB_STATEMENT_CACHE = env_int("DB_STATEMENT_CACHE", 256) or 256
+DB_READER_THREADS = env_int("DB_READER_THREADS", 2) or 2
+DB_WRITE_BATCH = env_int("DB_WRITE_BATCH", 64) or 64
 LOG_FILE = env_str("LOG_FILE", "bot.log")
 MAX_LOG_SIZE_MB = env_int("MAX_LOG_SIZE_MB", 10) or 10
 ALBUM_IDLE_SEC = env_float("ALBUM_IDLE_SEC", 4.5)
+# Адаптивный таймаут альбомов: p99 интервалов между элементами + запас, не меньше минимума
+ALBUM_IDLE_MIN_SEC = env_float("ALBUM_IDLE_MIN_SEC", 0.3)
+ALBUM_IDLE_MARGIN_SEC = env_float("ALBUM_IDLE_MARGIN_SEC", 0.5)
+ALBUM_LEARN_MIN_SAMPLES = env_int("ALBUM_LEARN_MIN_SAMPLES", 20) or 20
+# Склейка одиночных постов, пришедших во время отправки в тот же склад (окно 0 — без склейки)
+FORWARD_COALESCE_SEC = env_float("FORWARD_COALESCE_SEC", 0.3)
+FORWARD_BATCH_MAX = min(100, env_int("FORWARD_BATCH_MAX", 100) or 100)
+# Параллельная рассылка по складам: общий лимит и лимит на каждый клиент
+FORWARD_CONCURRENCY = env_int("FORWARD_CONCURRENCY", 8) or 8
+FORWARD_CLIENT_CONCURRENCY = env_int("FORWARD_CLIENT_CONCURRENCY", 4) or 4
+FORWARD_BULK_CONCURRENCY = env_int("FORWARD_BULK_CONCURRENCY", 4) or 4
+# Очереди доставки: воркеры, предел очереди и политика переполнения (block, drop_oldest, spill)
+DELIVERY_WORKERS = env_int("DELIVERY_WORKERS", 16) or 16
+DELIVERY_MAX_BACKLOG = env_int("DELIVERY_MAX_BACKLOG", 10000) or 10000
+DELIVERY_OVERFLOW = env_str("DELIVERY_OVERFLOW", "block").lower()
+DELIVERY_SPILL_PATH = env_str("DELIVERY_SPILL_PATH", "delivery_spill.jsonl")
+# Воркеры, которые обслуживают только живые посты (не догоняние, бэкфилл и повторы)
+DELIVERY_LIVE_WORKERS = env_int("DELIVERY_LIVE_WORKERS", 4)
+# Завершение работы: сколько ждать доставки очереди и куда сохранить недоставленное
+SHUTDOWN_DRAIN_SEC = env_float("SHUTDOWN_DRAIN_SEC", 20)
+DELIVERY_JOURNAL_PATH = env_str("DELIVERY_JOURNAL_PATH", "delivery_journal.jsonl")
+# Догоняние пропущенных постов при запуске и переподключении: предел на источник и пауза между запросами истории
+CATCHUP_MAX_PER_SOURCE = env_int("CATCHUP_MAX_PER_SOURCE", 500)
+CATCHUP_REQUEST_DELAY_SEC = env_float("CATCHUP_REQUEST_DELAY_SEC", 1.0)
+# Бэкфилл истории (/backfill): пауза между запросами истории и как часто обновлять сообщение о ходе
+BACKFILL_REQUEST_DELAY_SEC = env_float("BACKFILL_REQUEST_DELAY_SEC", 1.0)
+BACKFILL_STATUS_EVERY_SEC = env_float("BACKFILL_STATUS_EVERY_SEC", 5.0)
+# Темп отправки (лимиты Telegram): на процесс, на клиент и на один склад
+RATE_GLOBAL_PER_SEC = env_float("RATE_GLOBAL_PER_SEC", 25.0)
+RATE_CLIENT_PER_SEC = env_float("RATE_CLIENT_PER_SEC", 20.0)
+RATE_TARGET_PER_MIN = env_float("RATE_TARGET_PER_MIN", 20.0)
+RATE_TARGET_BURST = env_float("RATE_TARGET_BURST", 5.0)
+# Полосы приоритета: запас токенов для ответов админам и для живых постов (массовая пересылка его не трогает)
+RATE_RESERVE_INTERACTIVE = env_float("RATE_RESERVE_INTERACTIVE", 3.0)
+RATE_RESERVE_LIVE = env_float("RATE_RESERVE_LIVE", 5.0)
+# Сколько секунд после действия админа массовая пересылка стоит целиком
+INTERACTIVE_HOLD_SEC = env_float("INTERACTIVE_HOLD_SEC", 2.0)
+# Повторы неудачных пересылок: экспоненциальная задержка, предел попыток, опрос очереди
+RETRY_BASE_SEC = env_float("RETRY_BASE_SEC", 30.0)
+RETRY_MAX_SEC = env_float("RETRY_MAX_SEC", 3600.0)
+RETRY_MAX_ATTEMPTS = env_int("RETRY_MAX_ATTEMPTS", 8) or 8
+RETRY_POLL_SEC = env_float("RETRY_POLL_SEC", 5.0)
+RETRY_BATCH = env_int("RETRY_BATCH", 50) or 50
+# Дедупликация: окно последних ID сообщений на источник и предел хранимых альбомов
+DEDUP_WINDOW = env_int("DEDUP_WINDOW", 4096) or 4096
+DEDUP_MAX_ALBUMS = env_int("DEDUP_MAX_ALBUMS", 5000) or 5000
+# Карта возможностей складов: перепроверка прав бота и user client в фоне
+CAPABILITY_TTL_SEC = env_float("CAPABILITY_TTL_SEC", 21600)
+CAPABILITY_PROBE_INTERVAL_SEC = env_float("CAPABILITY_PROBE_INTERVAL_SEC", 60)
+CAPABILITY_PROBE_BATCH = env_int("CAPABILITY_PROBE_BATCH", 10) or 10
+# Автомат отключения склада: после N подряд неудач из-за склада; интервал проверок растёт до максимума
+BREAKER_THRESHOLD = env_int("BREAKER_THRESHOLD", 3) or 3
+BREAKER_BASE_SEC = env_float("BREAKER_BASE_SEC", 300)
+BREAKER_MAX_SEC = env_float("BREAKER_MAX_SEC", 21600)
+# Сколько последних событий помнить для отбрасывания дублей между клиентами
+CLAIM_WINDOW = env_int("CLAIM_WINDOW", 8192) or 8192
+FORWARDER_CHECKPOINT_SEC = env_float("FORWARDER_CHECKPOINT_SEC", 15.0)
 REPOST_STEP = env_int("REPOST_STEP", 1) or 1
 if REPOST_STEP < 1:
     REPOST_STEP = 1
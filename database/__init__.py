@@ -1 +1,2 @@
 from .operations import Database
+from .async_db import AsyncDatabase
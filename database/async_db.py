@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Асинхронный фасад над Database: SQLite никогда не выполняется в event loop
+"""
+import asyncio
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from .operations import Database
+from utils.logger import log
+
+try:
+    from config import DB_READER_THREADS, DB_WRITE_BATCH
+except ImportError:
+    DB_READER_THREADS = 2
+    DB_WRITE_BATCH = 64
+
+
+def _resolve(future: asyncio.Future, result: Any, error: Optional[BaseException]) -> None:
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class AsyncDatabase:
+    """
+    Чтения выполняются в пуле потоков-читателей, записи — в одном потоке-писателе.
+    Писатель забирает из очереди сразу пачку записей и фиксирует их одним COMMIT;
+    каждая запись внутри пачки идёт в своём SAVEPOINT, так что ошибка одной
+    не откатывает остальные.
+    """
+
+    def __init__(self, db: Database, readers: int = DB_READER_THREADS, batch_size: int = DB_WRITE_BATCH):
+        self.db = db
+        self._batch_size = max(1, batch_size)
+        self._readers = ThreadPoolExecutor(max_workers=max(1, readers), thread_name_prefix="db-reader")
+        self._writes: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._writer = threading.Thread(target=self._writer_loop, name="db-writer", daemon=True)
+        self._writer.start()
+
+    # === Инфраструктура ===
+
+    async def read(self, fn: Callable, *args) -> Any:
+        """Выполняет чтение в пуле читателей"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, fn, *args)
+
+    async def write(self, fn: Callable, *args) -> Any:
+        """Ставит запись в очередь писателя и ждёт её фиксации"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._writes.put((fn, args, future, loop))
+        return await future
+
+    def _writer_loop(self) -> None:
+        stopping = False
+        while not stopping:
+            job = self._writes.get()
+            if job is None:
+                break
+            batch = [job]
+            while len(batch) < self._batch_size:
+                try:
+                    nxt = self._writes.get_nowait()
+                except queue.Empty:
+                    break
+                if nxt is None:
+                    stopping = True
+                    break
+                batch.append(nxt)
+            results: List[Tuple[Any, Optional[BaseException]]] = []
+            try:
+                with self.db.transaction():
+                    for fn, args, _, _ in batch:
+                        try:
+                            with self.db.transaction():
+                                results.append((fn(*args), None))
+                        except Exception as e:
+                            results.append((None, e))
+            except Exception as e:
+                log(f"ОШИБКА фиксации пачки записей в БД: {e}")
+                results = [(None, e)] * len(batch)
+            for (_, _, future, loop), (result, error) in zip(batch, results):
+                try:
+                    loop.call_soon_threadsafe(_resolve, future, result, error)
+                except RuntimeError:
+                    # Event loop уже закрыт
+                    pass
+
+    def close(self) -> None:
+        """Дожидается записи очереди и закрывает подключения"""
+        self._writes.put(None)
+        self._writer.join()
+        self._readers.shutdown(wait=True)
+        self.db.close()
+
+    # === Данные в памяти (без I/O) ===
+
+    def get_targets_for_source(self, source_id: int) -> Tuple[int, ...]:
+        return self.db.get_targets_for_source(source_id)
+
+    def is_routed(self, source_id: int) -> bool:
+        return self.db.is_routed(source_id)
+
+    def get_repost_step(self, target_id: Optional[int] = None) -> int:
+        return self.db.get_repost_step(target_id)
+
+    def get_repost_steps(self) -> Tuple[int, Dict[int, int]]:
+        return self.db.get_repost_steps()
+
+    # === Чтение ===
+
+    async def source_exists(self, cid: int) -> bool:
+        return await self.read(self.db.source_exists, cid)
+
+    async def target_exists(self, cid: int) -> bool:
+        return await self.read(self.db.target_exists, cid)
+
+    async def list_sources(self) -> List[Tuple[int, str, Optional[str], Optional[str]]]:
+        return await self.read(self.db.list_sources)
+
+    async def list_targets(self) -> List[Tuple[int, str, Optional[str], Optional[str]]]:
+        return await self.read(self.db.list_targets)
+
+    async def get_bindings(self) -> List[Tuple[int, int]]:
+        return await self.read(self.db.get_bindings)
+
+    # === Запись ===
+
+    async def add_source(self, cid: int, name: str, username: Optional[str] = None, invite_link: Optional[str] = None) -> bool:
+        return await self.write(self.db.add_source, cid, name, username, invite_link)
+
+    async def add_target(self, cid: int, name: str, username: Optional[str] = None, invite_link: Optional[str] = None) -> bool:
+        return await self.write(self.db.add_target, cid, name, username, invite_link)
+
+    async def update_source_invite(self, cid: int, invite_link: str) -> None:
+        await self.write(self.db.update_source_invite, cid, invite_link)
+
+    async def update_target_invite(self, cid: int, invite_link: str) -> None:
+        await self.write(self.db.update_target_invite, cid, invite_link)
+
+    async def add_binding(self, source_id: int, target_id: int) -> None:
+        await self.write(self.db.add_binding, source_id, target_id)
+
+    async def remove_binding(self, source_id: int, target_id: int) -> None:
+        await self.write(self.db.remove_binding, source_id, target_id)
+
+    async def add_bindings(self, pairs: List[Tuple[int, int]]) -> Tuple[List[Tuple[int, int]], int]:
+        return await self.write(self.db.add_bindings, pairs)
+
+    async def remove_bindings(self, pairs: List[Tuple[int, int]]) -> int:
+        return await self.write(self.db.remove_bindings, pairs)
+
+    async def remove_source(self, source_id: int) -> Tuple[int, int, str]:
+        return await self.write(self.db.remove_source, source_id)
+
+    async def remove_target(self, target_id: int) -> Tuple[int, int, str]:
+        return await self.write(self.db.remove_target, target_id)
+
+    async def set_repost_step(self, step: int, target_id: Optional[int] = None) -> None:
+        await self.write(self.db.set_repost_step, step, target_id)
+
+    async def save_forwarder_state(self, state: Dict[str, Any]) -> None:
+        await self.write(self.db.save_forwarder_state, state)
+
+    async def load_forwarder_state(self) -> Dict[str, Any]:
+        return await self.read(self.db.load_forwarder_state)
+
+    async def add_retry(self, source_id: int, target_id: int, message_ids: List[int], album: bool,
+                        attempts: int, next_at: float, error: str, retry_id: Optional[int] = None) -> int:
+        return await self.write(self.db.add_retry, source_id, target_id, message_ids, album,
+                                attempts, next_at, error, retry_id)
+
+    async def claim_due_retries(self, now: float, limit: int, lease: float) -> List[Tuple[int, int, int, List[int], bool, int]]:
+        return await self.write(self.db.claim_due_retries, now, limit, lease)
+
+    async def delete_retry(self, retry_id: int) -> None:
+        await self.write(self.db.delete_retry, retry_id)
+
+    async def count_retries(self) -> int:
+        return await self.read(self.db.count_retries)
+
+    async def add_dead_letter(self, source_id: int, target_id: int, message_ids: List[int], album: bool,
+                              attempts: int, error: str, retry_id: Optional[int] = None) -> None:
+        await self.write(self.db.add_dead_letter, source_id, target_id, message_ids, album, attempts, error, retry_id)
+
+    async def list_dead_letters(self, limit: int = 20) -> List[Tuple[int, int, int, List[int], int, str, float]]:
+        return await self.read(self.db.list_dead_letters, limit)
+
+    async def count_dead_letters(self) -> int:
+        return await self.read(self.db.count_dead_letters)
+
+    async def replay_dead_letters(self, dead_id: Optional[int] = None) -> int:
+        return await self.write(self.db.replay_dead_letters, dead_id)
+
+    async def clear_dead_letters(self) -> int:
+        return await self.write(self.db.clear_dead_letters)
+
+    async def load_capabilities(self) -> Dict[int, Tuple[Optional[bool], Optional[bool], float, Optional[str]]]:
+        return await self.read(self.db.load_capabilities)
+
+    async def save_capabilities(self, rows: List[Tuple[int, Optional[bool], Optional[bool], float, Optional[str]]]) -> None:
+        await self.write(self.db.save_capabilities, rows)
+
+    async def load_peers(self) -> List[Tuple[str, int, int]]:
+        return await self.read(self.db.load_peers)
+
+    async def save_peers(self, rows: List[Tuple[str, int, int]]) -> None:
+        await self.write(self.db.save_peers, rows)
+
+    async def delete_peers(self, client: str, peer_ids: List[int]) -> None:
+        await self.write(self.db.delete_peers, client, peer_ids)
+
+    async def add_backfill(self, source_id: int, target_id: int, min_id: int, max_id: int,
+                           chat_id: Optional[int], status_msg_id: Optional[int]) -> int:
+        return await self.write(self.db.add_backfill, source_id, target_id, min_id, max_id, chat_id, status_msg_id)
+
+    async def update_backfill(self, job_id: int, cursor_id: int, forwarded: int, status: str,
+                              error: Optional[str] = None) -> None:
+        await self.write(self.db.update_backfill, job_id, cursor_id, forwarded, status, error)
+
+    async def list_backfills(self, status: Optional[str] = None, limit: int = 20) -> List[Tuple]:
+        return await self.read(self.db.list_backfills, status, limit)
+
+    async def get_backfill(self, job_id: int) -> Optional[Tuple]:
+        return await self.read(self.db.get_backfill, job_id)
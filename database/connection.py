@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+Долгоживущее подключение к SQLite
+"""
+import sqlite3
+
+try:
+    from config import DB_CACHE_SIZE_KB, DB_STATEMENT_CACHE
+except ImportError:
+    DB_CACHE_SIZE_KB = 8192
+    DB_STATEMENT_CACHE = 256
+
+
+def open_connection(db_path: str) -> sqlite3.Connection:
+    """
+    Открывает подключение с WAL, synchronous=NORMAL и кэшем страниц.
+    Транзакции управляются вручную (isolation_level=None), подготовленные
+    запросы кэшируются самим sqlite3 (cached_statements).
+    """
+    conn = sqlite3.connect(
+        db_path,
+        isolation_level=None,
+        check_same_thread=False,
+        cached_statements=DB_STATEMENT_CACHE,
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{int(DB_CACHE_SIZE_KB)}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
@@ -2,8 +2,9 @@
 """
 Модели базы данных и миграции
 """
+import json
 import sqlite3
-from typing import List, Tuple, Optional, Set
+from typing import Callable, List, Tuple, Optional, Set
 
 
 def _table_has_column(conn: sqlite3.Connection, table: str, column: str) -> bool:
@@ -43,8 +44,6 @@ def _migrate_channel_ids(conn: sqlite3.Connection) -> None:
             conn.execute("UPDATE targets SET id = ? WHERE id = ?", (new_id, old_id))
             # Обновляем связки
             conn.execute("UPDATE bindings SET target_id = ? WHERE target_id = ?", (new_id, old_id))
-    
-    conn.commit()
 
 
 def _ensure_columns(conn: sqlite3.Connection) -> None:
@@ -59,48 +58,189 @@ def _ensure_columns(conn: sqlite3.Connection) -> None:
         conn.execute("ALTER TABLE targets ADD COLUMN username TEXT")
     if not _table_has_column(conn, "targets", "invite_link"):
         conn.execute("ALTER TABLE targets ADD COLUMN invite_link TEXT")
-    conn.commit()
-    
+
     # Мигрируем ID каналов
     _migrate_channel_ids(conn)
 
 
-def init_db(db_path: str) -> None:
-    """Инициализирует базу данных и создает таблицы"""
-    with sqlite3.connect(db_path) as conn:
-        c = conn.cursor()
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS sources (
-                id INTEGER PRIMARY KEY,
-                name TEXT NOT NULL,
-                username TEXT,
-                invite_link TEXT
-            )
-        """)
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS targets (
-                id INTEGER PRIMARY KEY,
-                name TEXT NOT NULL,
-                username TEXT,
-                invite_link TEXT
-            )
-        """)
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS bindings (
-                source_id INTEGER,
-                target_id INTEGER,
-                UNIQUE(source_id, target_id),
-                FOREIGN KEY(source_id) REFERENCES sources(id) ON DELETE CASCADE,
-                FOREIGN KEY(target_id) REFERENCES targets(id) ON DELETE CASCADE
-            )
-        """)
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS settings (
-                key TEXT PRIMARY KEY,
-                value TEXT NOT NULL
-            )
-        """)
-        conn.commit()
-    # Применяем миграции для существующих БД
-    with sqlite3.connect(db_path) as conn:
-        _ensure_columns(conn)
+def _migration_1_base_schema(conn: sqlite3.Connection) -> None:
+    """Базовые таблицы + догоняющие правки старых БД (колонки, формат ID)"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sources (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            username TEXT,
+            invite_link TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS targets (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            username TEXT,
+            invite_link TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS bindings (
+            source_id INTEGER,
+            target_id INTEGER,
+            UNIQUE(source_id, target_id),
+            FOREIGN KEY(source_id) REFERENCES sources(id) ON DELETE CASCADE,
+            FOREIGN KEY(target_id) REFERENCES targets(id) ON DELETE CASCADE
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+    """)
+    _ensure_columns(conn)
+
+
+def _migration_2_binding_indexes(conn: sqlite3.Connection) -> None:
+    """Индекс по складу; поиск по источнику покрывает UNIQUE(source_id, target_id)"""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bindings_target ON bindings(target_id)")
+
+
+def _migration_3_target_settings(conn: sqlite3.Connection) -> None:
+    """Переносит шаги складов из строковых ключей settings в таблицу target_settings"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS target_settings (
+            target_id INTEGER PRIMARY KEY,
+            repost_step INTEGER
+        )
+    """)
+    rows = conn.execute("SELECT key, value FROM settings WHERE key LIKE 'target_step_%'").fetchall()
+    for key, value in rows:
+        try:
+            target_id = int(key[len("target_step_"):])
+            step = max(1, int(value))
+        except ValueError:
+            continue
+        conn.execute(
+            "INSERT OR REPLACE INTO target_settings (target_id, repost_step) VALUES (?, ?)",
+            (target_id, step)
+        )
+    conn.execute("DELETE FROM settings WHERE key LIKE 'target_step_%'")
+
+
+def _migration_4_forwarder_state(conn: sqlite3.Connection) -> None:
+    """Снимки состояния ForwarderService (счётчики, дедупликация, резервные склады)"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS forwarder_state (
+            name TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+
+
+def _migration_5_retry_queue(conn: sqlite3.Connection) -> None:
+    """Очередь повторов неудачных пересылок и журнал окончательно неудавшихся (dead letters)"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS retry_queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            source_id INTEGER NOT NULL,
+            target_id INTEGER NOT NULL,
+            message_ids TEXT NOT NULL,
+            album INTEGER NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_at REAL NOT NULL,
+            last_error TEXT,
+            created_at REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_retry_queue_next_at ON retry_queue(next_at)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS dead_letters (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            source_id INTEGER NOT NULL,
+            target_id INTEGER NOT NULL,
+            message_ids TEXT NOT NULL,
+            album INTEGER NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL,
+            last_error TEXT,
+            failed_at REAL NOT NULL
+        )
+    """)
+
+
+def _migration_6_target_capabilities(conn: sqlite3.Connection) -> None:
+    """Какой клиент может публиковать в склад; переносит failed_targets из состояния пересылки"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS target_capabilities (
+            target_id INTEGER PRIMARY KEY,
+            bot INTEGER,
+            user INTEGER,
+            verified_at REAL NOT NULL DEFAULT 0,
+            last_error TEXT
+        )
+    """)
+    row = conn.execute("SELECT data FROM forwarder_state WHERE name='failed_targets'").fetchone()
+    if row:
+        try:
+            failed = json.loads(row[0])
+        except ValueError:
+            failed = []
+        conn.executemany(
+            "INSERT OR IGNORE INTO target_capabilities (target_id, bot, user, verified_at) VALUES (?, 0, 1, 0)",
+            [(int(t),) for t in failed]
+        )
+        conn.execute("DELETE FROM forwarder_state WHERE name='failed_targets'")
+
+
+def _migration_7_peers(conn: sqlite3.Connection) -> None:
+    """Access hash каналов для каждого клиента — чтобы не резолвить сущности при пересылке"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS peers (
+            client TEXT NOT NULL,
+            peer_id INTEGER NOT NULL,
+            access_hash INTEGER NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (client, peer_id)
+        )
+    """)
+
+
+def _migration_8_backfill_jobs(conn: sqlite3.Connection) -> None:
+    """Задания бэкфилла истории с точкой продолжения (последний доставленный ID)"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS backfill_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            source_id INTEGER NOT NULL,
+            target_id INTEGER NOT NULL,
+            min_id INTEGER NOT NULL,
+            max_id INTEGER NOT NULL,
+            cursor_id INTEGER NOT NULL,
+            forwarded INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL,
+            error TEXT,
+            chat_id INTEGER,
+            status_msg_id INTEGER,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+
+
+# Миграции по порядку; номер версии = позиция в списке (PRAGMA user_version)
+MIGRATIONS: List[Callable[[sqlite3.Connection], None]] = [
+    _migration_1_base_schema,
+    _migration_2_binding_indexes,
+    _migration_3_target_settings,
+    _migration_4_forwarder_state,
+    _migration_5_retry_queue,
+    _migration_6_target_capabilities,
+    _migration_7_peers,
+    _migration_8_backfill_jobs,
+]
+
+
+def init_db(conn: sqlite3.Connection) -> None:
+    """Применяет недостающие миграции (вызывается внутри транзакции)"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        migration(conn)
+        conn.execute(f"PRAGMA user_version = {number}")
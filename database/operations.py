@@ -2,8 +2,13 @@
 """
 Операции с базой данных
 """
+import json
 import sqlite3
-from typing import List, Tuple, Optional
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Tuple, Optional
+from .connection import open_connection
 from .models import init_db
 from utils.channel_id import normalize_channel_id
 
@@ -16,21 +21,129 @@ except ImportError:
 class Database:
     def __init__(self, db_path: str):
         self.db_path = db_path
-        init_db(db_path)
+        # Одно долгоживущее подключение; доступ сериализуется блокировкой
+        self._conn = open_connection(db_path)
+        self._lock = threading.RLock()
+        self._tx_depth = 0
+        self._tx_owner: Optional[int] = None
+        # Читатели из других потоков используют свои подключения (WAL не блокирует их записью)
+        self._local = threading.local()
+        self._readers: List[sqlite3.Connection] = []
+        self._routes_dirty = False
+        self._steps_dirty = False
+        with self.transaction() as conn:
+            init_db(conn)
+        # Снимок маршрутов: source_id → кортеж target_id (читается на горячем пути без I/O)
+        self._routes: Dict[int, Tuple[int, ...]] = {}
+        self.reload_routes()
+        # Шаги репоста: глобальный по умолчанию + переопределения по складам
+        self._default_step = max(1, DEFAULT_REPOST_STEP or 1)
+        self._target_steps: Dict[int, int] = {}
+        self.reload_repost_steps()
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """
+        Явная транзакция: всё внутри блока фиксируется одним COMMIT.
+        Вложенные вызовы превращаются в SAVEPOINT и откатываются независимо.
+        """
+        with self._lock:
+            conn = self._conn
+            depth = self._tx_depth
+            if depth == 0:
+                conn.execute("BEGIN IMMEDIATE")
+                self._tx_owner = threading.get_ident()
+            else:
+                conn.execute(f"SAVEPOINT sp_{depth}")
+            self._tx_depth = depth + 1
+            try:
+                yield conn
+            except BaseException:
+                if depth == 0:
+                    conn.execute("ROLLBACK")
+                    self._routes_dirty = False
+                    self._steps_dirty = False
+                else:
+                    conn.execute(f"ROLLBACK TO sp_{depth}")
+                    conn.execute(f"RELEASE sp_{depth}")
+                raise
+            else:
+                if depth == 0:
+                    conn.execute("COMMIT")
+                else:
+                    conn.execute(f"RELEASE sp_{depth}")
+            finally:
+                self._tx_depth = depth
+                if depth == 0:
+                    self._tx_owner = None
+            if depth == 0 and self._routes_dirty:
+                self._routes_dirty = False
+                self.reload_routes()
+            if depth == 0 and self._steps_dirty:
+                self._steps_dirty = False
+                self.reload_repost_steps()
+
+    def _reader(self) -> Optional[sqlite3.Connection]:
+        """Подключение для чтения текущего потока (None — читать через основное)"""
+        if self._tx_owner == threading.get_ident():
+            # Внутри своей транзакции читаем через основное подключение, чтобы видеть свои записи
+            return None
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = open_connection(self.db_path)
+            self._local.conn = conn
+            with self._lock:
+                self._readers.append(conn)
+        return conn
+
+    def _fetchall(self, sql: str, params: tuple = ()) -> list:
+        conn = self._reader()
+        if conn is not None:
+            return conn.execute(sql, params).fetchall()
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _fetchone(self, sql: str, params: tuple = ()) -> Optional[tuple]:
+        conn = self._reader()
+        if conn is not None:
+            return conn.execute(sql, params).fetchone()
+        with self._lock:
+            return self._conn.execute(sql, params).fetchone()
+
+    def close(self) -> None:
+        with self._lock:
+            for conn in self._readers:
+                conn.close()
+            self._readers.clear()
+            self._conn.close()
+
+    def _invalidate_routes(self) -> None:
+        """Помечает снимок маршрутов устаревшим; перестраивается после COMMIT"""
+        self._routes_dirty = True
+
+    def reload_routes(self) -> None:
+        """Перестраивает снимок маршрутов из таблицы bindings и атомарно подменяет его"""
+        rows = self._fetchall("SELECT source_id, target_id FROM bindings ORDER BY rowid")
+        grouped: Dict[int, List[int]] = {}
+        for source_id, target_id in rows:
+            grouped.setdefault(source_id, []).append(target_id)
+        routes: Dict[int, Tuple[int, ...]] = {sid: tuple(tids) for sid, tids in grouped.items()}
+        # Алиасы: старые (ненормализованные) ID источников доступны и по нормализованному ключу
+        for source_id, targets in list(routes.items()):
+            normalized_id = normalize_channel_id(source_id)
+            if normalized_id not in routes:
+                routes[normalized_id] = targets
+        self._routes = routes
 
     def source_exists(self, cid: int) -> bool:
         """Проверяет, существует ли источник с данным ID"""
         normalized_id = normalize_channel_id(cid)
-        with sqlite3.connect(self.db_path) as conn:
-            row = conn.execute("SELECT 1 FROM sources WHERE id = ?", (normalized_id,)).fetchone()
-            return row is not None
+        return self._fetchone("SELECT 1 FROM sources WHERE id = ?", (normalized_id,)) is not None
 
     def target_exists(self, cid: int) -> bool:
         """Проверяет, существует ли склад с данным ID"""
         normalized_id = normalize_channel_id(cid)
-        with sqlite3.connect(self.db_path) as conn:
-            row = conn.execute("SELECT 1 FROM targets WHERE id = ?", (normalized_id,)).fetchone()
-            return row is not None
+        return self._fetchone("SELECT 1 FROM targets WHERE id = ?", (normalized_id,)) is not None
 
     def add_source(self, cid: int, name: str, username: Optional[str] = None, invite_link: Optional[str] = None) -> bool:
         """
@@ -38,7 +151,7 @@ class Database:
         """
         # Нормализуем ID канала
         normalized_id = normalize_channel_id(cid)
-        with sqlite3.connect(self.db_path) as conn:
+        with self.transaction() as conn:
             # Проверяем, существует ли уже
             exists = conn.execute("SELECT 1 FROM sources WHERE id = ?", (normalized_id,)).fetchone() is not None
             if exists:
@@ -47,16 +160,13 @@ class Database:
                     "UPDATE sources SET name = ?, username = ?, invite_link = ? WHERE id = ?",
                     (name, username, invite_link, normalized_id)
                 )
-                conn.commit()
                 return False
-            else:
-                # Добавляем новый
-                conn.execute(
-                    "INSERT INTO sources (id, name, username, invite_link) VALUES (?, ?, ?, ?)",
-                    (normalized_id, name, username, invite_link)
-                )
-                conn.commit()
-                return True
+            # Добавляем новый
+            conn.execute(
+                "INSERT INTO sources (id, name, username, invite_link) VALUES (?, ?, ?, ?)",
+                (normalized_id, name, username, invite_link)
+            )
+            return True
 
     def add_target(self, cid: int, name: str, username: Optional[str] = None, invite_link: Optional[str] = None) -> bool:
         """
@@ -64,7 +174,7 @@ class Database:
         """
         # Нормализуем ID канала
         normalized_id = normalize_channel_id(cid)
-        with sqlite3.connect(self.db_path) as conn:
+        with self.transaction() as conn:
             # Проверяем, существует ли уже
             exists = conn.execute("SELECT 1 FROM targets WHERE id = ?", (normalized_id,)).fetchone() is not None
             if exists:
@@ -73,83 +183,108 @@ class Database:
                     "UPDATE targets SET name = ?, username = ?, invite_link = ? WHERE id = ?",
                     (name, username, invite_link, normalized_id)
                 )
-                conn.commit()
                 return False
-            else:
-                # Добавляем новый
-                conn.execute(
-                    "INSERT INTO targets (id, name, username, invite_link) VALUES (?, ?, ?, ?)",
-                    (normalized_id, name, username, invite_link)
-                )
-                conn.commit()
-                return True
+            # Добавляем новый
+            conn.execute(
+                "INSERT INTO targets (id, name, username, invite_link) VALUES (?, ?, ?, ?)",
+                (normalized_id, name, username, invite_link)
+            )
+            return True
 
     def update_source_invite(self, cid: int, invite_link: str) -> None:
-        with sqlite3.connect(self.db_path) as conn:
+        with self.transaction() as conn:
             conn.execute("UPDATE sources SET invite_link = ? WHERE id = ?", (invite_link, cid))
-            conn.commit()
 
     def update_target_invite(self, cid: int, invite_link: str) -> None:
-        with sqlite3.connect(self.db_path) as conn:
+        with self.transaction() as conn:
             conn.execute("UPDATE targets SET invite_link = ? WHERE id = ?", (invite_link, cid))
-            conn.commit()
 
     def list_sources(self) -> List[Tuple[int, str, Optional[str], Optional[str]]]:
-        with sqlite3.connect(self.db_path) as conn:
-            return conn.execute(
-                "SELECT id, name, username, invite_link FROM sources ORDER BY name COLLATE NOCASE"
-            ).fetchall()
+        return self._fetchall(
+            "SELECT id, name, username, invite_link FROM sources ORDER BY name COLLATE NOCASE"
+        )
 
     def list_targets(self) -> List[Tuple[int, str, Optional[str], Optional[str]]]:
-        with sqlite3.connect(self.db_path) as conn:
-            return conn.execute(
-                "SELECT id, name, username, invite_link FROM targets ORDER BY name COLLATE NOCASE"
-            ).fetchall()
+        return self._fetchall(
+            "SELECT id, name, username, invite_link FROM targets ORDER BY name COLLATE NOCASE"
+        )
 
     def add_binding(self, source_id: int, target_id: int) -> None:
         # Нормализуем ID перед сохранением
         normalized_source_id = normalize_channel_id(source_id)
         normalized_target_id = normalize_channel_id(target_id)
-        with sqlite3.connect(self.db_path) as conn:
+        with self.transaction() as conn:
             conn.execute(
                 "INSERT OR IGNORE INTO bindings (source_id, target_id) VALUES (?, ?)",
                 (normalized_source_id, normalized_target_id)
             )
-            conn.commit()
+            self._invalidate_routes()
 
     def remove_binding(self, source_id: int, target_id: int) -> None:
-        with sqlite3.connect(self.db_path) as conn:
+        with self.transaction() as conn:
             conn.execute(
                 "DELETE FROM bindings WHERE source_id=? AND target_id=?",
                 (source_id, target_id)
             )
-            conn.commit()
+            self._invalidate_routes()
+
+    def add_bindings(self, pairs: Iterable[Tuple[int, int]]) -> Tuple[List[Tuple[int, int]], int]:
+        """
+        Добавляет связки пачкой в одной транзакции.
+        Возвращает (список добавленных пар, количество уже существовавших).
+        """
+        normalized = list(dict.fromkeys(
+            (normalize_channel_id(sid), normalize_channel_id(tid)) for sid, tid in pairs
+        ))
+        if not normalized:
+            return [], 0
+        source_ids = sorted({sid for sid, _ in normalized})
+        with self.transaction() as conn:
+            placeholders = ",".join("?" * len(source_ids))
+            existing = set(conn.execute(
+                f"SELECT source_id, target_id FROM bindings WHERE source_id IN ({placeholders})",
+                source_ids
+            ).fetchall())
+            added = [pair for pair in normalized if pair not in existing]
+            if added:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO bindings (source_id, target_id) VALUES (?, ?)",
+                    added
+                )
+                self._invalidate_routes()
+        return added, len(normalized) - len(added)
+
+    def remove_bindings(self, pairs: Iterable[Tuple[int, int]]) -> int:
+        """Удаляет связки пачкой в одной транзакции. Возвращает количество удалённых."""
+        pairs = list(pairs)
+        if not pairs:
+            return 0
+        with self.transaction() as conn:
+            before = conn.total_changes
+            conn.executemany("DELETE FROM bindings WHERE source_id=? AND target_id=?", pairs)
+            removed = conn.total_changes - before
+            if removed:
+                self._invalidate_routes()
+        return removed
 
     def get_bindings(self) -> List[Tuple[int, int]]:
-        with sqlite3.connect(self.db_path) as conn:
-            return conn.execute("SELECT source_id, target_id FROM bindings").fetchall()
+        return self._fetchall("SELECT source_id, target_id FROM bindings")
 
-    def get_targets_for_source(self, source_id: int) -> List[int]:
-        # Нормализуем ID источника для поиска
-        normalized_source_id = normalize_channel_id(source_id)
-        with sqlite3.connect(self.db_path) as conn:
-            # Пробуем найти по нормализованному ID
-            rows = conn.execute(
-                "SELECT target_id FROM bindings WHERE source_id=?",
-                (normalized_source_id,)
-            ).fetchall()
-            if rows:
-                return [r[0] for r in rows]
-            
-            # Если не нашли, пробуем найти по исходному ID (для обратной совместимости)
-            rows = conn.execute(
-                "SELECT target_id FROM bindings WHERE source_id=?",
-                (source_id,)
-            ).fetchall()
-            return [r[0] for r in rows]
+    def is_routed(self, source_id: int) -> bool:
+        """Есть ли у источника (ID уже в формате -100...) склады — проверка на горячем пути"""
+        return source_id in self._routes
+
+    def get_targets_for_source(self, source_id: int) -> Tuple[int, ...]:
+        """Склады для источника из снимка маршрутов (без обращения к БД)"""
+        routes = self._routes
+        targets = routes.get(normalize_channel_id(source_id))
+        if targets is None:
+            # Обратная совместимость: ID в исходном виде
+            targets = routes.get(source_id, ())
+        return targets
 
     def remove_source(self, source_id: int) -> Tuple[int, int, str]:
-        with sqlite3.connect(self.db_path) as conn:
+        with self.transaction() as conn:
             cur = conn.cursor()
             name_row = cur.execute("SELECT name FROM sources WHERE id=?", (source_id,)).fetchone()
             name = name_row[0] if name_row else str(source_id)
@@ -157,47 +292,249 @@ class Database:
             cur.execute("DELETE FROM bindings WHERE source_id=?", (source_id,))
             cur.execute("DELETE FROM sources WHERE id=?", (source_id,))
             deleted_src = cur.rowcount
-            conn.commit()
-            return binds, deleted_src, name
+            self._invalidate_routes()
+        return binds, deleted_src, name
 
-    def get_repost_step(self, target_id: Optional[int] = None) -> int:
-        """Шаг репоста: для target_id (склада) или глобальный. 1=все, 2=каждый второй и т.д."""
-        with sqlite3.connect(self.db_path) as conn:
+    def _invalidate_repost_steps(self) -> None:
+        """Помечает снимок шагов репоста устаревшим; перечитывается после COMMIT"""
+        self._steps_dirty = True
+
+    def reload_repost_steps(self) -> None:
+        """Перечитывает шаги репоста из settings и target_settings в память"""
+        default_step = max(1, DEFAULT_REPOST_STEP or 1)
+        row = self._fetchone("SELECT value FROM settings WHERE key = 'repost_step'")
+        if row:
             try:
-                if target_id is not None:
-                    row = conn.execute(
-                        "SELECT value FROM settings WHERE key = ?",
-                        (f"target_step_{target_id}",)
-                    ).fetchone()
-                    if row:
-                        return max(1, int(row[0]))
-                row = conn.execute("SELECT value FROM settings WHERE key = ?", ("repost_step",)).fetchone()
-                if row:
-                    return max(1, int(row[0]))
-            except sqlite3.OperationalError:
+                default_step = max(1, int(row[0]))
+            except ValueError:
                 pass
-        return max(1, DEFAULT_REPOST_STEP or 1)
+        rows = self._fetchall("SELECT target_id, repost_step FROM target_settings WHERE repost_step IS NOT NULL")
+        self._default_step = default_step
+        self._target_steps = {target_id: max(1, step) for target_id, step in rows}
+
+    def get_repost_step(self, target_id: Optional[int] = None) -> int:
+        """Шаг репоста: для target_id (склада) или глобальный. 1=все, 2=каждый второй и т.д."""
+        if target_id is not None:
+            return self._target_steps.get(target_id, self._default_step)
+        return self._default_step
+
+    def get_repost_steps(self) -> Tuple[int, Dict[int, int]]:
+        """Снимок шагов: (глобальный, {target_id: шаг}) — для экрана настроек"""
+        return self._default_step, self._target_steps
 
     def set_repost_step(self, step: int, target_id: Optional[int] = None) -> None:
         """Устанавливает шаг: глобально или для конкретного склада."""
         step = max(1, int(step))
-        with sqlite3.connect(self.db_path) as conn:
-            key = f"target_step_{target_id}" if target_id is not None else "repost_step"
-            conn.execute(
-                "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
-                (key, str(step))
-            )
-            conn.commit()
+        with self.transaction() as conn:
+            if target_id is not None:
+                conn.execute(
+                    "INSERT INTO target_settings (target_id, repost_step) VALUES (?, ?) "
+                    "ON CONFLICT(target_id) DO UPDATE SET repost_step = excluded.repost_step",
+                    (target_id, step)
+                )
+            else:
+                conn.execute(
+                    "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                    ("repost_step", str(step))
+                )
+            self._invalidate_repost_steps()
 
     def remove_target(self, target_id: int) -> Tuple[int, int, str]:
-        with sqlite3.connect(self.db_path) as conn:
+        with self.transaction() as conn:
             cur = conn.cursor()
             name_row = cur.execute("SELECT name FROM targets WHERE id=?", (target_id,)).fetchone()
             name = name_row[0] if name_row else str(target_id)
             binds = cur.execute("SELECT COUNT(*) FROM bindings WHERE target_id=?", (target_id,)).fetchone()[0]
             cur.execute("DELETE FROM bindings WHERE target_id=?", (target_id,))
             cur.execute("DELETE FROM targets WHERE id=?", (target_id,))
-            cur.execute("DELETE FROM settings WHERE key=?", (f"target_step_{target_id}",))
             deleted_tgt = cur.rowcount
-            conn.commit()
-            return binds, deleted_tgt, name
+            cur.execute("DELETE FROM target_settings WHERE target_id=?", (target_id,))
+            cur.execute("DELETE FROM target_capabilities WHERE target_id=?", (target_id,))
+            self._invalidate_routes()
+            self._invalidate_repost_steps()
+        return binds, deleted_tgt, name
+
+    def save_forwarder_state(self, state: Dict[str, Any]) -> None:
+        """Сохраняет компоненты состояния пересылки (сериализация выполняется здесь, вне event loop)"""
+        if not state:
+            return
+        now = time.time()
+        rows = [(name, json.dumps(data, separators=(",", ":")), now) for name, data in state.items()]
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO forwarder_state (name, data, updated_at) VALUES (?, ?, ?)",
+                rows
+            )
+
+    def load_forwarder_state(self) -> Dict[str, Any]:
+        """Загружает сохранённые компоненты состояния пересылки"""
+        state: Dict[str, Any] = {}
+        for name, data in self._fetchall("SELECT name, data FROM forwarder_state"):
+            try:
+                state[name] = json.loads(data)
+            except ValueError:
+                continue
+        return state
+
+    # === Очередь повторов и dead letters ===
+
+    def add_retry(self, source_id: int, target_id: int, message_ids: List[int], album: bool,
+                  attempts: int, next_at: float, error: str, retry_id: Optional[int] = None) -> int:
+        """Ставит (или переносит) повтор пересылки на next_at. Возвращает id записи."""
+        with self.transaction() as conn:
+            if retry_id is not None:
+                cur = conn.execute(
+                    "UPDATE retry_queue SET attempts = ?, next_at = ?, last_error = ? WHERE id = ?",
+                    (attempts, next_at, error, retry_id)
+                )
+                if cur.rowcount:
+                    return retry_id
+            cur = conn.execute(
+                "INSERT INTO retry_queue (source_id, target_id, message_ids, album, attempts, next_at, last_error, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (source_id, target_id, json.dumps(message_ids), int(album), attempts, next_at, error, time.time())
+            )
+            return cur.lastrowid
+
+    def claim_due_retries(self, now: float, limit: int, lease: float) -> List[Tuple[int, int, int, List[int], bool, int]]:
+        """
+        Забирает до limit созревших повторов и продлевает им next_at на lease секунд,
+        чтобы повтор не был взят дважды (и вернулся сам, если процесс упадёт до результата).
+        """
+        with self.transaction() as conn:
+            rows = conn.execute(
+                "SELECT id, source_id, target_id, message_ids, album, attempts FROM retry_queue "
+                "WHERE next_at <= ? ORDER BY next_at LIMIT ?",
+                (now, limit)
+            ).fetchall()
+            if rows:
+                conn.executemany(
+                    "UPDATE retry_queue SET next_at = ? WHERE id = ?",
+                    [(now + lease, row[0]) for row in rows]
+                )
+        return [(rid, sid, tid, json.loads(ids), bool(album), attempts) for rid, sid, tid, ids, album, attempts in rows]
+
+    def delete_retry(self, retry_id: int) -> None:
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM retry_queue WHERE id = ?", (retry_id,))
+
+    def count_retries(self) -> int:
+        return self._fetchone("SELECT COUNT(*) FROM retry_queue")[0]
+
+    def add_dead_letter(self, source_id: int, target_id: int, message_ids: List[int], album: bool,
+                        attempts: int, error: str, retry_id: Optional[int] = None) -> None:
+        """Переносит окончательно неудавшуюся пересылку в dead_letters"""
+        with self.transaction() as conn:
+            if retry_id is not None:
+                conn.execute("DELETE FROM retry_queue WHERE id = ?", (retry_id,))
+            conn.execute(
+                "INSERT INTO dead_letters (source_id, target_id, message_ids, album, attempts, last_error, failed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (source_id, target_id, json.dumps(message_ids), int(album), attempts, error, time.time())
+            )
+
+    def list_dead_letters(self, limit: int = 20) -> List[Tuple[int, int, int, List[int], int, str, float]]:
+        rows = self._fetchall(
+            "SELECT id, source_id, target_id, message_ids, attempts, last_error, failed_at "
+            "FROM dead_letters ORDER BY id DESC LIMIT ?",
+            (limit,)
+        )
+        return [(did, sid, tid, json.loads(ids), attempts, err or "", at) for did, sid, tid, ids, attempts, err, at in rows]
+
+    def count_dead_letters(self) -> int:
+        return self._fetchone("SELECT COUNT(*) FROM dead_letters")[0]
+
+    def replay_dead_letters(self, dead_id: Optional[int] = None) -> int:
+        """Возвращает dead letters (одну или все) в очередь повторов с нулевым счётчиком попыток"""
+        where, params = ("WHERE id = ?", (dead_id,)) if dead_id is not None else ("", ())
+        now = time.time()
+        with self.transaction() as conn:
+            cur = conn.execute(
+                "INSERT INTO retry_queue (source_id, target_id, message_ids, album, attempts, next_at, last_error, created_at) "
+                f"SELECT source_id, target_id, message_ids, album, 0, ?, last_error, ? FROM dead_letters {where}",
+                (now, now) + params
+            )
+            replayed = cur.rowcount
+            conn.execute(f"DELETE FROM dead_letters {where}", params)
+        return replayed
+
+    def clear_dead_letters(self) -> int:
+        with self.transaction() as conn:
+            return conn.execute("DELETE FROM dead_letters").rowcount
+
+    # === Возможности клиентов по складам ===
+
+    def load_capabilities(self) -> Dict[int, Tuple[Optional[bool], Optional[bool], float, Optional[str]]]:
+        """target_id → (бот может публиковать, user client может, время проверки, последняя ошибка)"""
+        rows = self._fetchall("SELECT target_id, bot, user, verified_at, last_error FROM target_capabilities")
+        to_bool = lambda v: None if v is None else bool(v)
+        return {tid: (to_bool(bot), to_bool(user), verified_at, error) for tid, bot, user, verified_at, error in rows}
+
+    def save_capabilities(self, rows: List[Tuple[int, Optional[bool], Optional[bool], float, Optional[str]]]) -> None:
+        if not rows:
+            return
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO target_capabilities (target_id, bot, user, verified_at, last_error) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(tid, None if bot is None else int(bot), None if user is None else int(user), verified_at, error)
+                 for tid, bot, user, verified_at, error in rows]
+            )
+
+    # === Access hash каналов ===
+
+    def load_peers(self) -> List[Tuple[str, int, int]]:
+        """(клиент, ID канала с -100, access_hash)"""
+        return self._fetchall("SELECT client, peer_id, access_hash FROM peers")
+
+    def save_peers(self, rows: List[Tuple[str, int, int]]) -> None:
+        if not rows:
+            return
+        now = time.time()
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO peers (client, peer_id, access_hash, updated_at) VALUES (?, ?, ?, ?)",
+                [(client, peer_id, access_hash, now) for client, peer_id, access_hash in rows]
+            )
+
+    def delete_peers(self, client: str, peer_ids: List[int]) -> None:
+        with self.transaction() as conn:
+            conn.executemany("DELETE FROM peers WHERE client = ? AND peer_id = ?", [(client, p) for p in peer_ids])
+
+    # === Бэкфилл истории ===
+
+    def add_backfill(self, source_id: int, target_id: int, min_id: int, max_id: int,
+                     chat_id: Optional[int], status_msg_id: Optional[int]) -> int:
+        now = time.time()
+        with self.transaction() as conn:
+            cur = conn.execute(
+                "INSERT INTO backfill_jobs (source_id, target_id, min_id, max_id, cursor_id, forwarded, status, "
+                "chat_id, status_msg_id, created_at, updated_at) VALUES (?, ?, ?, ?, ?, 0, 'running', ?, ?, ?, ?)",
+                (source_id, target_id, min_id, max_id, min_id, chat_id, status_msg_id, now, now)
+            )
+            return cur.lastrowid
+
+    def update_backfill(self, job_id: int, cursor_id: int, forwarded: int, status: str,
+                        error: Optional[str] = None) -> None:
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE backfill_jobs SET cursor_id = ?, forwarded = ?, status = ?, error = ?, updated_at = ? "
+                "WHERE id = ?",
+                (cursor_id, forwarded, status, error, time.time(), job_id)
+            )
+
+    def list_backfills(self, status: Optional[str] = None, limit: int = 20) -> List[Tuple]:
+        """(id, источник, склад, min_id, max_id, cursor_id, переслано, статус, ошибка, чат, сообщение статуса)"""
+        where, params = ("WHERE status = ?", (status,)) if status else ("", ())
+        return self._fetchall(
+            "SELECT id, source_id, target_id, min_id, max_id, cursor_id, forwarded, status, error, chat_id, "
+            f"status_msg_id FROM backfill_jobs {where} ORDER BY id DESC LIMIT ?",
+            params + (limit,)
+        )
+
+    def get_backfill(self, job_id: int) -> Optional[Tuple]:
+        return self._fetchone(
+            "SELECT id, source_id, target_id, min_id, max_id, cursor_id, forwarded, status, error, chat_id, "
+            "status_msg_id FROM backfill_jobs WHERE id = ?",
+            (job_id,)
+        )
@@ -1,5 +1,6 @@
 from .commands import setup_commands
 from .callbacks import setup_callbacks
 from .messages import setup_messages
+from .priority import setup_priority
 
-__all__ = ['setup_commands', 'setup_callbacks', 'setup_messages']
+__all__ = ['setup_commands', 'setup_callbacks', 'setup_messages', 'setup_priority']
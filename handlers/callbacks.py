@@ -5,12 +5,11 @@
 from telethon import events, Button
 from telethon.errors import MessageNotModifiedError
 from config import OWNER_IDS
-from database import Database
-from utils.formatters import render_sources_view, render_targets_view, render_settings_main, chunk_buttons, make_channel_link
-from utils.channel_id import normalize_channel_id
+from database import AsyncDatabase
+from utils.formatters import render_sources_view, render_targets_view, render_settings_main, render_dead_letters, chunk_buttons, make_channel_link
 
 
-def setup_callbacks(client, db: Database, user_states: dict):
+def setup_callbacks(client, db: AsyncDatabase, user_states: dict, forwarder=None):
     """Настраивает обработчики callback кнопок"""
 
     @client.on(events.CallbackQuery())
@@ -34,7 +33,7 @@ def setup_callbacks(client, db: Database, user_states: dict):
             else:
                 selected.add(tid)
             st["selected_tgts"] = selected
-            targets = db.list_targets()
+            targets = await db.list_targets()
             buttons = [
                 Button.inline(
                     ("✓" if _tid in selected else "▫") + f" {name}",
@@ -62,7 +61,7 @@ def setup_callbacks(client, db: Database, user_states: dict):
                 return
             # Переходим к выбору источников
             st["step"] = "bind_choose_srcs"
-            sources = db.list_sources()
+            sources = await db.list_sources()
             buttons = [
                 Button.inline(f"▫ {sname}", f"bind_src_{sid}".encode())
                 for sid, sname, _, _ in sources
@@ -88,7 +87,7 @@ def setup_callbacks(client, db: Database, user_states: dict):
             else:
                 selected_srcs.add(src_id)
             st["selected_srcs"] = selected_srcs
-            sources = db.list_sources()
+            sources = await db.list_sources()
             buttons = [
                 Button.inline(
                     ("✓" if _sid in selected_srcs else "▫") + f" {name}",
@@ -116,23 +115,11 @@ def setup_callbacks(client, db: Database, user_states: dict):
                 await event.answer("Нужно выбрать хотя бы один склад и один источник.", alert=True)
                 return
             
-            already, added = 0, 0
-            added_bindings = []  # Сохраняем созданные связки для отображения
-            import sqlite3
-            with sqlite3.connect(db.db_path) as conn:
-                cur = conn.cursor()
-                # Создаем все комбинации: каждый источник → каждый склад
-                for src_id in selected_srcs:
-                    normalized_src_id = normalize_channel_id(src_id)
-                    for tgt_id in selected_tgts:
-                        normalized_tgt_id = normalize_channel_id(tgt_id)
-                        # Проверяем, существует ли связка
-                        if cur.execute("SELECT 1 FROM bindings WHERE source_id=? AND target_id=?", (normalized_src_id, normalized_tgt_id)).fetchone():
-                            already += 1
-                        else:
-                            db.add_binding(normalized_src_id, normalized_tgt_id)
-                            added += 1
-                            added_bindings.append((normalized_src_id, normalized_tgt_id))
+            # Создаем все комбинации одной транзакцией: каждый источник → каждый склад
+            added_bindings, already = await db.add_bindings(
+                [(src_id, tgt_id) for src_id in selected_srcs for tgt_id in selected_tgts]
+            )
+            added = len(added_bindings)
             
             user_states.pop(event.sender_id, None)
             msg = []
@@ -143,8 +130,8 @@ def setup_callbacks(client, db: Database, user_states: dict):
             
             # Если есть созданные связки, показываем их список
             if added_bindings:
-                src_rows = {sid: (name, username, invite_link) for sid, name, username, invite_link in db.list_sources()}
-                tgt_rows = {tid: (name, username, invite_link) for tid, name, username, invite_link in db.list_targets()}
+                src_rows = {sid: (name, username, invite_link) for sid, name, username, invite_link in await db.list_sources()}
+                tgt_rows = {tid: (name, username, invite_link) for tid, name, username, invite_link in await db.list_targets()}
                 # Группируем по складам (targets), как в /list
                 groups = {}
                 for src_id, tgt_id in added_bindings:
@@ -178,17 +165,17 @@ def setup_callbacks(client, db: Database, user_states: dict):
         # Удаление связки
         elif data.startswith("remove_") and data.count("_") == 2:
             _, s, t = data.split("_")
-            db.remove_binding(int(s), int(t))
+            await db.remove_binding(int(s), int(t))
             await event.edit("Связка удалена.")
             await event.answer()
 
         # Удаление источника
         elif data.startswith("del_src_"):
             sid = int(data.split("_")[-1])
-            binds, deleted, name = db.remove_source(sid)
+            binds, deleted, name = await db.remove_source(sid)
             if deleted:
                 await event.answer(f"Источник удалён. Связок удалено: {binds}.")
-                text, buttons = render_sources_view(db)
+                text, buttons = await render_sources_view(db)
                 await event.edit(text, buttons=buttons, parse_mode='html', link_preview=False)
                 await event.respond(f"Удалён источник «{name}». Удалено связок: {binds}.")
             else:
@@ -197,10 +184,12 @@ def setup_callbacks(client, db: Database, user_states: dict):
         # Удаление склада
         elif data.startswith("del_tgt_"):
             tid = int(data.split("_")[-1])
-            binds, deleted, name = db.remove_target(tid)
+            binds, deleted, name = await db.remove_target(tid)
+            if forwarder is not None:
+                forwarder.capabilities.forget(tid)
             if deleted:
                 await event.answer(f"Склад удалён. Связок удалено: {binds}.")
-                text, buttons = render_targets_view(db)
+                text, buttons = await render_targets_view(db)
                 await event.edit(text, buttons=buttons, parse_mode='html', link_preview=False)
                 await event.respond(f"Удалён склад «{name}». Удалено связок: {binds}.")
             else:
@@ -210,7 +199,7 @@ def setup_callbacks(client, db: Database, user_states: dict):
 
         # Главное меню настроек (возврат)
         elif data == "settings_back":
-            text, btns = render_settings_main(db)
+            text, btns = await render_settings_main(db)
             try:
                 await event.edit(text, parse_mode='html', buttons=btns)
             except MessageNotModifiedError:
@@ -220,7 +209,7 @@ def setup_callbacks(client, db: Database, user_states: dict):
         elif data.startswith("tgt_step_"):
             try:
                 tid = int(data.split("_")[-1])
-                tgt_rows = {_tid: (name, u, i) for _tid, name, u, i in db.list_targets()}
+                tgt_rows = {_tid: (name, u, i) for _tid, name, u, i in await db.list_targets()}
                 tname = tgt_rows.get(tid, (str(tid), None, None))[0]
                 step = db.get_repost_step(tid)
                 step_desc = "все посты" if step == 1 else f"каждый {step}-й пост"
@@ -244,10 +233,10 @@ def setup_callbacks(client, db: Database, user_states: dict):
             try:
                 step = int(data.split("_")[-1])
                 if 1 <= step <= 10:
-                    db.set_repost_step(step)
+                    await db.set_repost_step(step)
                     msg = "Готово. Новые склады будут репостить всё подряд." if step == 1 else f"Готово. Новые склады будут репостить каждый {step}-й пост."
                     await event.answer(msg, alert=False)
-                    text, btns = render_settings_main(db)
+                    text, btns = await render_settings_main(db)
                     try:
                         await event.edit(text, parse_mode='html', buttons=btns)
                     except MessageNotModifiedError:
@@ -265,8 +254,8 @@ def setup_callbacks(client, db: Database, user_states: dict):
                     tid = int(parts[3])
                     step = int(parts[4])
                     if 1 <= step <= 10:
-                        db.set_repost_step(step, target_id=tid)
-                        tgt_rows = {_tid: (name, u, i) for _tid, name, u, i in db.list_targets()}
+                        await db.set_repost_step(step, target_id=tid)
+                        tgt_rows = {_tid: (name, u, i) for _tid, name, u, i in await db.list_targets()}
                         tname = tgt_rows.get(tid, (str(tid), None, None))[0]
                         msg = f"✓ «{tname}»: {'всё подряд' if step == 1 else f'каждый {step}-й пост'}"
                         await event.answer(msg, alert=False)
@@ -290,6 +279,35 @@ def setup_callbacks(client, db: Database, user_states: dict):
             except (ValueError, IndexError):
                 await event.answer("Ошибка.", alert=True)
 
+        # === Неудавшиеся пересылки (dead letters) ===
+
+        # Повтор одной или всех
+        elif data.startswith("dl_replay_"):
+            arg = data[len("dl_replay_"):]
+            try:
+                replayed = await db.replay_dead_letters(None if arg == "all" else int(arg))
+            except ValueError:
+                await event.answer("Ошибка.", alert=True)
+                return
+            if forwarder and forwarder.retry:
+                await forwarder.retry.poll()
+            await event.answer(f"Поставлено на повтор: {replayed}")
+            text, buttons = await render_dead_letters(db)
+            try:
+                await event.edit(text, buttons=buttons, parse_mode='html', link_preview=False)
+            except MessageNotModifiedError:
+                pass
+
+        # Очистка журнала
+        elif data == "dl_clear":
+            cleared = await db.clear_dead_letters()
+            await event.answer(f"Удалено записей: {cleared}")
+            text, buttons = await render_dead_letters(db)
+            try:
+                await event.edit(text, buttons=buttons, parse_mode='html', link_preview=False)
+            except MessageNotModifiedError:
+                pass
+
         # Закрытие сообщения
         elif data == "close_msg":
             try:
@@ -2,16 +2,27 @@
 """
 Обработчики команд бота
 """
+import datetime
 from telethon import events, Button
 from telethon.tl.types import Channel, Chat
 from config import OWNER_IDS, COPY_HINT
-from database import Database
-from utils.formatters import get_chat_name, make_channel_link, render_sources_view, render_targets_view, render_settings_main, chunk_buttons
+from database import AsyncDatabase
+from utils.formatters import get_chat_name, make_channel_link, render_sources_view, render_targets_view, render_settings_main, render_status, render_dead_letters, chunk_buttons
 from utils.validators import is_invite_link
 from utils.channel_id import normalize_channel_id
+from utils.logger import log
+from services.backfill import BackfillError, BackfillJob, BackfillService
 
+BACKFILL_USAGE = (
+    "Использование:\n"
+    "/backfill <источник> <склад> <кол-во постов | ГГГГ-ММ-ДД> — перенести историю\n"
+    "/backfill cancel <N> — отменить задание\n"
+    "/backfill resume <N> — продолжить приостановленное задание\n"
+    "/backfill — последние задания"
+)
 
-def setup_commands(client, db: Database, user_states: dict, user_client=None):
+
+def setup_commands(client, db: AsyncDatabase, user_states: dict, user_client=None, forwarder=None, backfill=None):
     """Настраивает обработчики команд"""
 
     @client.on(events.NewMessage(pattern=r'^/start', func=lambda e: e.is_private))
@@ -34,6 +45,9 @@ def setup_commands(client, db: Database, user_states: dict, user_client=None):
             "/list — список связок\n"
             "/remove — удалить связку\n"
             "/settings — настройки (шаг репоста)\n"
+            "/status — состояние очередей доставки\n"
+            "/dead — неудавшиеся пересылки (повтор)\n"
+            "/backfill — перенос истории источника в склад\n"
             "/help — помощь",
             buttons=menu_keyboard
         )
@@ -52,6 +66,9 @@ def setup_commands(client, db: Database, user_states: dict, user_client=None):
             "/list — список связок\n"
             "/remove — удалить связку\n"
             "/settings — настройки (шаг репоста)\n"
+            "/status — состояние очередей доставки\n"
+            "/dead — неудавшиеся пересылки (повтор)\n"
+            "/backfill — перенос истории источника в склад\n"
             "/help — помощь"
         )
 
@@ -59,9 +76,88 @@ def setup_commands(client, db: Database, user_states: dict, user_client=None):
     async def cmd_settings(event):
         if event.sender_id not in OWNER_IDS:
             return
-        text, buttons = render_settings_main(db)
+        text, buttons = await render_settings_main(db)
         await event.respond(text, parse_mode='html', buttons=buttons)
 
+    @client.on(events.NewMessage(pattern=r'^/status', func=lambda e: e.is_private))
+    async def cmd_status(event):
+        if event.sender_id not in OWNER_IDS:
+            return
+        if not forwarder:
+            await event.respond("Сервис пересылки не запущен.")
+            return
+        await event.respond(render_status(forwarder), parse_mode='html', link_preview=False)
+
+    @client.on(events.NewMessage(pattern=r'^/dead', func=lambda e: e.is_private))
+    async def cmd_dead(event):
+        if event.sender_id not in OWNER_IDS:
+            return
+        text, buttons = await render_dead_letters(db)
+        await event.respond(text, buttons=buttons, parse_mode='html', link_preview=False)
+
+    @client.on(events.NewMessage(pattern=r'^/backfill', func=lambda e: e.is_private))
+    async def cmd_backfill(event):
+        if event.sender_id not in OWNER_IDS:
+            return
+        if not backfill:
+            await event.respond("Сервис бэкфилла не запущен.")
+            return
+        args = event.raw_text.split()[1:]
+        try:
+            if not args:
+                jobs = [BackfillJob(row) for row in await db.list_backfills(limit=10)]
+                if not jobs:
+                    await event.respond(BACKFILL_USAGE)
+                    return
+                await event.respond("\n\n".join([await BackfillService.render(job) for job in jobs]))
+                return
+            if len(args) == 2 and args[0] in ("cancel", "resume") and args[1].lstrip("#").isdigit():
+                job_id = int(args[1].lstrip("#"))
+                if args[0] == "cancel":
+                    ok = await backfill.cancel(job_id)
+                    await event.respond(f"Задание #{job_id} отменено." if ok else f"Задание #{job_id} не выполняется.")
+                else:
+                    started = await backfill.resume(job_id)
+                    await event.respond(f"Задание #{job_id} продолжено." if started else f"Задание #{job_id} уже идёт.")
+                return
+            if len(args) != 3:
+                await event.respond(BACKFILL_USAGE)
+                return
+            try:
+                source_id = normalize_channel_id(int(args[0]))
+                target_id = normalize_channel_id(int(args[1]))
+            except ValueError:
+                await event.respond(BACKFILL_USAGE)
+                return
+            count, since = None, None
+            if args[2].isdigit():
+                count = int(args[2])
+            else:
+                try:
+                    since = datetime.datetime.strptime(args[2], "%Y-%m-%d").replace(tzinfo=datetime.timezone.utc)
+                except ValueError:
+                    await event.respond(BACKFILL_USAGE)
+                    return
+            if count is not None and count <= 0:
+                await event.respond("Количество постов должно быть больше нуля.")
+                return
+            if not await db.source_exists(source_id):
+                await event.respond(f"Источник {source_id} не найден. Добавь его через /add_source.")
+                return
+            if not await db.target_exists(target_id):
+                await event.respond(f"Склад {target_id} не найден. Добавь его через /add_target.")
+                return
+            status = await event.respond("📥 Бэкфилл: определяю диапазон сообщений...")
+            job = await backfill.create(
+                source_id, target_id, count=count, since=since, chat_id=status.chat_id, status_msg_id=status.id
+            )
+            log(f"Бэкфилл #{job.id} создан админом {event.sender_id}")
+        except BackfillError as e:
+            await event.respond(f"Бэкфилл невозможен: {e}")
+        except Exception as e:
+            log(f"ОШИБКА создания бэкфилла: {e}")
+            await event.respond(f"Ошибка бэкфилла: {e}")
+
     @client.on(events.NewMessage(pattern=r'^/add_source', func=lambda e: e.is_private))
     async def cmd_add_source(event):
         if event.sender_id not in OWNER_IDS:
@@ -82,22 +178,22 @@ def setup_commands(client, db: Database, user_states: dict, user_client=None):
     async def cmd_sources(event):
         if event.sender_id not in OWNER_IDS:
             return
-        text, buttons = render_sources_view(db)
+        text, buttons = await render_sources_view(db)
         await event.respond(text, buttons=buttons, parse_mode='html', link_preview=False)
 
     @client.on(events.NewMessage(pattern=r'^/targets', func=lambda e: e.is_private))
     async def cmd_targets(event):
         if event.sender_id not in OWNER_IDS:
             return
-        text, buttons = render_targets_view(db)
+        text, buttons = await render_targets_view(db)
         await event.respond(text, buttons=buttons, parse_mode='html', link_preview=False)
 
     @client.on(events.NewMessage(pattern=r'^/bind', func=lambda e: e.is_private))
     async def cmd_bind(event):
         if event.sender_id not in OWNER_IDS:
             return
-        sources = db.list_sources()
-        targets = db.list_targets()
+        sources = await db.list_sources()
+        targets = await db.list_targets()
         if not sources or not targets:
             await event.respond("Нет источников или складов. Сначала добавь их.")
             return
@@ -122,12 +218,12 @@ def setup_commands(client, db: Database, user_states: dict, user_client=None):
     async def cmd_list(event):
         if event.sender_id not in OWNER_IDS:
             return
-        binds = db.get_bindings()
+        binds = await db.get_bindings()
         if not binds:
             await event.respond("Связок нет.")
             return
-        src_rows = {sid: (name, username, invite_link) for sid, name, username, invite_link in db.list_sources()}
-        tgt_rows = {tid: (name, username, invite_link) for tid, name, username, invite_link in db.list_targets()}
+        src_rows = {sid: (name, username, invite_link) for sid, name, username, invite_link in await db.list_sources()}
+        tgt_rows = {tid: (name, username, invite_link) for tid, name, username, invite_link in await db.list_targets()}
         # Группируем по складам (targets), а не по источникам
         groups = {}
         for src_id, tgt_id in binds:
@@ -149,12 +245,12 @@ def setup_commands(client, db: Database, user_states: dict, user_client=None):
     async def cmd_remove(event):
         if event.sender_id not in OWNER_IDS:
             return
-        binds = db.get_bindings()
+        binds = await db.get_bindings()
         if not binds:
             await event.respond("Связок нет.")
             return
-        src_rows = {sid: name for sid, name, _, _ in db.list_sources()}
-        tgt_rows = {tid: name for tid, name, _, _ in db.list_targets()}
+        src_rows = {sid: name for sid, name, _, _ in await db.list_sources()}
+        tgt_rows = {tid: name for tid, name, _, _ in await db.list_targets()}
         buttons = []
         for sid, tid in binds:
             sname = src_rows.get(sid, str(sid))
@@ -184,24 +280,24 @@ def setup_commands(client, db: Database, user_states: dict, user_client=None):
 
         # Кнопки reply-меню (проверяем до state — работают всегда)
         if text == "Настройки":
-            text_out, buttons = render_settings_main(db)
+            text_out, buttons = await render_settings_main(db)
             await event.respond(text_out, parse_mode='html', buttons=buttons)
             return
         if text == "Все источники":
-            text_out, btns = render_sources_view(db)
+            text_out, btns = await render_sources_view(db)
             await event.respond(text_out, buttons=btns, parse_mode='html', link_preview=False)
             return
         if text == "Все склады":
-            text_out, btns = render_targets_view(db)
+            text_out, btns = await render_targets_view(db)
             await event.respond(text_out, buttons=btns, parse_mode='html', link_preview=False)
             return
         if text == "Список связок":
-            binds = db.get_bindings()
+            binds = await db.get_bindings()
             if not binds:
                 await event.respond("Связок нет.")
             else:
-                src_rows = {sid: (name, username, invite_link) for sid, name, username, invite_link in db.list_sources()}
-                tgt_rows = {tid: (name, username, invite_link) for tid, name, username, invite_link in db.list_targets()}
+                src_rows = {sid: (name, username, invite_link) for sid, name, username, invite_link in await db.list_sources()}
+                tgt_rows = {tid: (name, username, invite_link) for tid, name, username, invite_link in await db.list_targets()}
                 groups = {}
                 for src_id, tgt_id in binds:
                     if tgt_id not in groups:
@@ -227,8 +323,8 @@ def setup_commands(client, db: Database, user_states: dict, user_client=None):
             await event.respond("Перешли сообщение из канала-склада.", buttons=[[Button.text("✕ Отмена", resize=True, single_use=True)]])
             return
         if text == "Создать связку":
-            sources = db.list_sources()
-            targets = db.list_targets()
+            sources = await db.list_sources()
+            targets = await db.list_targets()
             if not sources or not targets:
                 await event.respond("Нет источников или складов. Сначала добавь их.")
                 return
@@ -428,8 +524,8 @@ def setup_commands(client, db: Database, user_states: dict, user_client=None):
 
             if step == "add_source":
                 # Проверяем, не добавлен ли уже этот источник
-                if db.source_exists(chat_id):
-                    existing_sources = db.list_sources()
+                if await db.source_exists(chat_id):
+                    existing_sources = await db.list_sources()
                     for sid, sname, suser, sinv in existing_sources:
                         if sid == normalize_channel_id(chat_id):
                             await event.respond(
@@ -458,7 +554,7 @@ def setup_commands(client, db: Database, user_states: dict, user_client=None):
                     )
                     return
                 
-                is_new = db.add_source(chat_id, chat_title, chat_username, None)
+                is_new = await db.add_source(chat_id, chat_title, chat_username, None)
                 if is_new:
                     await event.respond(
                         f"<b>Источник добавлен:</b> {make_channel_link(chat_title, chat_id, chat_username, None)}",
@@ -492,8 +588,8 @@ def setup_commands(client, db: Database, user_states: dict, user_client=None):
                     user_states.pop(event.sender_id, None)
             else:
                 # Проверяем, не добавлен ли уже этот склад
-                if db.target_exists(chat_id):
-                    existing_targets = db.list_targets()
+                if await db.target_exists(chat_id):
+                    existing_targets = await db.list_targets()
                     for tid, tname, tuser, tinv in existing_targets:
                         if tid == normalize_channel_id(chat_id):
                             await event.respond(
@@ -524,7 +620,7 @@ def setup_commands(client, db: Database, user_states: dict, user_client=None):
                     )
                     return
                 
-                is_new = db.add_target(chat_id, chat_title, chat_username, None)
+                is_new = await db.add_target(chat_id, chat_title, chat_username, None)
                 if is_new:
                     await event.respond(
                         f"<b>Склад добавлен:</b> {make_channel_link(chat_title, chat_id, chat_username, None)}",
@@ -577,8 +673,8 @@ def setup_commands(client, db: Database, user_states: dict, user_client=None):
             
             if kind == "source":
                 # Проверяем, не добавлен ли уже этот источник
-                if db.source_exists(cid):
-                    existing_sources = db.list_sources()
+                if await db.source_exists(cid):
+                    existing_sources = await db.list_sources()
                     for sid, sname, suser, sinv in existing_sources:
                         if sid == normalize_channel_id(cid):
                             await event.respond(
@@ -591,7 +687,7 @@ def setup_commands(client, db: Database, user_states: dict, user_client=None):
                             user_states.pop(event.sender_id, None)
                             return
                 
-                is_new = db.add_source(cid, name, c_username, None)
+                is_new = await db.add_source(cid, name, c_username, None)
                 if is_new:
                     await event.respond(
                         f"<b>Источник добавлен:</b> {make_channel_link(name, cid, c_username, None)}",
@@ -624,8 +720,8 @@ def setup_commands(client, db: Database, user_states: dict, user_client=None):
                     user_states.pop(event.sender_id, None)
             else:
                 # Проверяем, не добавлен ли уже этот склад
-                if db.target_exists(cid):
-                    existing_targets = db.list_targets()
+                if await db.target_exists(cid):
+                    existing_targets = await db.list_targets()
                     for tid, tname, tuser, tinv in existing_targets:
                         if tid == normalize_channel_id(cid):
                             await event.respond(
@@ -638,7 +734,7 @@ def setup_commands(client, db: Database, user_states: dict, user_client=None):
                             user_states.pop(event.sender_id, None)
                             return
                 
-                is_new = db.add_target(cid, name, c_username, None)
+                is_new = await db.add_target(cid, name, c_username, None)
                 if is_new:
                     await event.respond(
                         f"<b>Склад добавлен:</b> {make_channel_link(name, cid, c_username, None)}",
@@ -713,18 +809,18 @@ def setup_commands(client, db: Database, user_states: dict, user_client=None):
             
             try:
                 if kind == "source":
-                    db.update_source_invite(cid, invite_link)
+                    await db.update_source_invite(cid, invite_link)
                     await event.respond("<b>Ссылка сохранена для источника.</b> Теперь название канала будет кликабельным.", parse_mode='html', link_preview=False, buttons=Button.clear())
                 else:
-                    db.update_target_invite(cid, invite_link)
+                    await db.update_target_invite(cid, invite_link)
                     await event.respond("<b>Ссылка сохранена для склада.</b> Теперь название канала будет кликабельным.", parse_mode='html', link_preview=False, buttons=Button.clear())
             except Exception as e:
                 # Если ошибка при сохранении (например, API restriction), просто сохраняем ссылку без проверки
                 if kind == "source":
-                    db.update_source_invite(cid, invite_link)
+                    await db.update_source_invite(cid, invite_link)
                     await event.respond("<b>Ссылка сохранена для источника.</b>", parse_mode='html', link_preview=False, buttons=Button.clear())
                 else:
-                    db.update_target_invite(cid, invite_link)
+                    await db.update_target_invite(cid, invite_link)
                     await event.respond("<b>Ссылка сохранена для склада.</b>", parse_mode='html', link_preview=False, buttons=Button.clear())
             
             user_states.pop(event.sender_id, None)
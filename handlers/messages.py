@@ -3,59 +3,67 @@
 Обработчики сообщений из каналов
 """
 from telethon import events
-from telethon.tl.types import Channel, Chat
-from typing import Optional
-from database import Database
+from telethon.tl.types import PeerChannel, PeerChat, UpdateNewChannelMessage, UpdateNewMessage, UpdateShortChatMessage
+from typing import Callable
+from database import AsyncDatabase
 from services.forwarder import ForwarderService
 from utils.logger import log
-from utils.channel_id import normalize_channel_id
 from utils.chat_names import chat_name_cache
 
 
-def get_chat_id_from_event(event) -> Optional[int]:
-    """Извлекает ID чата из события"""
-    # Пробуем разные способы получения ID
-    if hasattr(event, 'chat_id') and event.chat_id:
-        return event.chat_id
-    
-    if hasattr(event, 'peer_id'):
-        peer = event.peer_id
-        if hasattr(peer, 'channel_id'):
-            return peer.channel_id
-        if hasattr(peer, 'chat_id'):
-            return peer.chat_id
-        if hasattr(peer, 'user_id'):
-            return peer.user_id
-    
-    if hasattr(event.message, 'peer_id'):
-        peer = event.message.peer_id
-        if hasattr(peer, 'channel_id'):
-            return peer.channel_id
-        if hasattr(peer, 'chat_id'):
-            return peer.chat_id
-    
-    return None
+# Смещение ID каналов в формате -100... (как в маршрутах и normalize_channel_id)
+CHANNEL_ID_BASE = 1000000000000
+
+
+def source_post_event(is_routed: Callable[[int], bool]) -> type:
+    """
+    Класс события NewMessage только для постов источников, у которых есть склады.
+    Лишние обновления (чаты user-аккаунта, ЛС) отсекаются в build по peer сырого
+    обновления — до создания события и Message. Набор маршрутов читается вживую
+    (is_routed), поэтому добавление и удаление источников не требует перерегистрации.
+    ID источника кладётся в event.source_id.
+    """
 
+    class SourcePost(events.NewMessage):
+        @classmethod
+        def build(cls, update, others=None, self_id=None):
+            if isinstance(update, UpdateNewChannelMessage):
+                peer = getattr(update.message, "peer_id", None)
+                if not isinstance(peer, PeerChannel):
+                    return None
+                source_id = -(CHANNEL_ID_BASE + peer.channel_id)
+            elif isinstance(update, UpdateNewMessage):
+                peer = getattr(update.message, "peer_id", None)
+                if not isinstance(peer, PeerChat):
+                    return None
+                source_id = -peer.chat_id
+            elif isinstance(update, UpdateShortChatMessage):
+                source_id = -update.chat_id
+            else:
+                return None
+            if not is_routed(source_id):
+                return None
+            event = super().build(update, others, self_id)
+            if event is not None:
+                event.source_id = source_id
+            return event
 
-def setup_messages(client, db: Database, forwarder: ForwarderService, user_client=None):
+    return SourcePost
+
+
+def setup_messages(client, db: AsyncDatabase, forwarder: ForwarderService, user_client=None):
     """Настраивает обработчики сообщений из каналов"""
     
     async def handle_channel_message(event, client_name: str):
         """Обработчик сообщений из каналов"""
         try:
-            # Проверяем, что это пост из канала (не из ЛС)
-            if event.is_private:
-                return
+            # ID источника уже определён по сырому обновлению (SourcePost.build)
+            normalized_chat_id = event.source_id
             
-            # Получаем ID чата
-            chat_id = get_chat_id_from_event(event)
-            if not chat_id:
-                log(f"ОШИБКА: Не удалось извлечь chat_id из события, клиент={client_name}")
+            # Второй клиент с тем же постом отбрасывается сразу, до всей обработки
+            if not forwarder.claims.claim(normalized_chat_id, event.message.id, client_name):
                 return
             
-            # Нормализуем ID канала
-            normalized_chat_id = normalize_channel_id(chat_id)
-            
             # Получаем целевые чаты для этого источника
             targets = db.get_targets_for_source(normalized_chat_id)
             if not targets:
@@ -66,7 +74,7 @@ def setup_messages(client, db: Database, forwarder: ForwarderService, user_clien
         except Exception as e:
             # Получаем название канала для лога ошибки
             try:
-                chat_id = get_chat_id_from_event(event) if 'event' in locals() else None
+                chat_id = getattr(event, 'source_id', None)
                 if chat_id:
                     chat_name = await chat_name_cache.get_name(chat_id)
                     log(f"Error in handle_channel_message for {chat_name}, client={client_name}: {e}")
@@ -77,14 +85,16 @@ def setup_messages(client, db: Database, forwarder: ForwarderService, user_clien
             import traceback
             log(f"Traceback: {traceback.format_exc()}")
 
+    SourcePost = source_post_event(db.is_routed)
+
     # Настраиваем обработчик на bot клиент
-    @client.on(events.NewMessage(chats=None))
+    @client.on(SourcePost())
     async def on_channel_post_bot(event):
         await handle_channel_message(event, "bot")
     
     def register_user_client_handler(uc):
         """Регистрирует обработчик на user client (для переподключения)"""
-        @uc.on(events.NewMessage(chats=None))
+        @uc.on(SourcePost())
         async def on_channel_post_user(event):
             await handle_channel_message(event, "user")
 
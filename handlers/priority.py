@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""
+Приоритет действий админа над пересылкой
+"""
+from telethon import events
+from config import OWNER_IDS
+from services.forwarder import ForwarderService
+
+
+def setup_priority(client, forwarder: ForwarderService):
+    """
+    Регистрируется раньше остальных обработчиков: каждое сообщение админа боту и
+    нажатие кнопки сразу отмечается в лимитере — ответ получает токен из запаса
+    полосы interactive, а массовая пересылка ненадолго уступает клиент.
+    """
+
+    def is_owner(event) -> bool:
+        return event.sender_id in OWNER_IDS
+
+    @client.on(events.NewMessage(func=lambda e: e.is_private and is_owner(e)))
+    async def on_admin_message(event):
+        forwarder.limiter.note_interactive("bot")
+
+    @client.on(events.CallbackQuery(func=is_owner))
+    async def on_admin_callback(event):
+        forwarder.limiter.note_interactive("bot")
@@ -3,17 +3,26 @@
 Главный файл запуска бота
 """
 import asyncio
+import signal
+from typing import Dict
 from telethon import TelegramClient
 from telethon.tl.types import BotCommand, BotCommandScopeDefault
 from telethon.tl.functions.bots import SetBotCommandsRequest
+from telethon.tl.functions.updates import GetStateRequest
 from config import (
     MODE, BOT_TOKEN, API_ID, API_HASH, SESSION_NAME,
-    USER_API_ID, USER_API_HASH, USER_SESSION_NAME,
-    DB_PATH, OWNER_IDS
+    USER_API_ID, USER_API_HASH, USER_SESSION_NAMES,
+    DB_PATH, OWNER_IDS, SHUTDOWN_DRAIN_SEC
 )
-from database import Database
+from database import Database, AsyncDatabase
 from services.forwarder import ForwarderService
-from handlers import setup_commands, setup_callbacks, setup_messages
+from services.checkpoint import StateCheckpointer
+from services.retry import RetryService
+from services.capabilities import CapabilityService, probe_client
+from services.peers import PeerResolver
+from services.catchup import CatchupService
+from services.backfill import BackfillService
+from handlers import setup_commands, setup_callbacks, setup_messages, setup_priority
 from utils.logger import log
 from utils.chat_names import chat_name_cache
 
@@ -29,12 +38,35 @@ async def notify_admins(client: TelegramClient, text: str):
             log(f"Не удалось отправить уведомление админу {owner_id}: {e}")
 
 
+async def resolve_peers(db: AsyncDatabase, forwarder: ForwarderService):
+    """Разрешает все источники и склады для каждого клиента заранее, пачками"""
+    try:
+        chat_ids = [row[0] for row in await db.list_sources()] + [row[0] for row in await db.list_targets()]
+        clients = {"bot": forwarder.client}
+        clients.update({session.key: session.client for session in forwarder.users})
+        for client_key, client in clients.items():
+            unresolved = await forwarder.peers.resolve(client_key, client, chat_ids)
+            log(f"Каналы для клиента {client_key} разрешены: {len(chat_ids) - unresolved} из {len(chat_ids)}")
+    except Exception as e:
+        log(f"Предупреждение: Не удалось заранее разрешить каналы: {e}")
+
+
+async def run_until_stopped(client: TelegramClient, stop_event: asyncio.Event):
+    """Как run_until_disconnected, но завершается и по сигналу остановки — не отключая клиент"""
+    await client(GetStateRequest())
+    stopping = asyncio.ensure_future(stop_event.wait())
+    try:
+        await asyncio.wait({client.disconnected, stopping}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        stopping.cancel()
+
+
 async def main():
     """Основная функция запуска бота"""
     log("Бот запускается")
     
-    # Инициализация базы данных
-    db = Database(DB_PATH)
+    # Инициализация базы данных (запросы выполняются вне event loop)
+    db = AsyncDatabase(Database(DB_PATH))
     
     # Инициализация основного клиента Telethon
     if MODE == "bot":
@@ -52,33 +84,61 @@ async def main():
         await client.start(bot_token=BOT_TOKEN)
         log(f"Клиент бота запущен")
     
-    # Инициализация user клиента для fallback (если нужен)
-    user_client = None
+    # Инициализация user-сессий для fallback (если нужны)
+    user_clients: Dict[str, TelegramClient] = {}
+    user_api_id = USER_API_ID or API_ID
+    user_api_hash = USER_API_HASH or API_HASH
     if MODE == "auto" or (MODE == "bot" and (USER_API_ID or USER_API_HASH)):
-        try:
-            user_api_id = USER_API_ID or API_ID
-            user_api_hash = USER_API_HASH or API_HASH
-            user_client = TelegramClient(USER_SESSION_NAME, user_api_id, user_api_hash)
-            await user_client.start()
-            log(f"Клиент пользователя запущен для резервного варианта")
-        except Exception as e:
-            log(f"Предупреждение: Не удалось запустить клиент пользователя: {e}. Продолжаем без резервного варианта.")
-            user_client = None
+        for session_name in USER_SESSION_NAMES:
+            try:
+                uc = TelegramClient(session_name, user_api_id, user_api_hash)
+                await uc.start()
+                user_clients[session_name] = uc
+                log(f"Клиент пользователя {session_name} запущен для резервного варианта")
+            except Exception as e:
+                log(f"Предупреждение: Не удалось запустить клиент пользователя {session_name}: {e}")
+        if not user_clients:
+            log("Предупреждение: Ни один клиент пользователя не запущен. Продолжаем без резервного варианта.")
+    # Основная user-сессия: принимает события и резолвит названия
+    primary_user_name = next(iter(user_clients), None)
+    user_client = user_clients.get(primary_user_name) if primary_user_name else None
     
     # Инициализация кэша названий каналов
     chat_name_cache.set_clients(client, user_client)
     
     # Инициализация сервиса пересылки
-    forwarder = ForwarderService(client, user_client, get_repost_step=db.get_repost_step)
+    peers = PeerResolver(db)
+    await peers.load()
+    forwarder = ForwarderService(client, get_repost_step=db.get_repost_step, peers=peers)
+    for session_name, uc in user_clients.items():
+        forwarder.users.add(session_name, uc)
+    checkpointer = StateCheckpointer(db, forwarder)
+    await checkpointer.restore()
+    checkpointer.start()
+    retry = RetryService(db, forwarder.queue.put, scheduler=forwarder.scheduler)
+    forwarder.set_retry_service(retry)
+    capabilities = CapabilityService(
+        db, forwarder.capabilities,
+        lambda: {"bot": lambda target: probe_client(forwarder.client, target), "user": forwarder.users.probe}
+    )
+    await capabilities.restore()
+    forwarder.breakers.attach(notify=lambda text: notify_admins(client, text), probe=capabilities.can_post)
+    forwarder.start()
+    retry.start()
+    capabilities.start()
+    resolve_task = asyncio.create_task(resolve_peers(db, forwarder))
+    backfill = BackfillService(db, forwarder)
     
     # Состояния пользователей (для интерактивных команд)
     user_states = {}
     
     # Настройка обработчиков
+    # Первым: действия админа получают приоритет над пересылкой
+    setup_priority(client, forwarder)
     log("Настройка обработчиков команд...")
-    setup_commands(client, db, user_states, user_client)
+    setup_commands(client, db, user_states, user_client, forwarder, backfill)
     log("Настройка обработчиков callback...")
-    setup_callbacks(client, db, user_states)
+    setup_callbacks(client, db, user_states, forwarder)
     log("Настройка обработчиков сообщений...")
     register_user_handler = setup_messages(client, db, forwarder, user_client)
     
@@ -95,6 +155,9 @@ async def main():
                 BotCommand(command="list", description="Список связок"),
                 BotCommand(command="remove", description="Удалить связку"),
                 BotCommand(command="settings", description="Настройки (шаг репоста)"),
+                BotCommand(command="status", description="Состояние очередей доставки"),
+                BotCommand(command="dead", description="Неудавшиеся пересылки"),
+                BotCommand(command="backfill", description="Перенос истории источника в склад"),
             ]
             await client(SetBotCommandsRequest(
                 scope=BotCommandScopeDefault(),
@@ -108,83 +171,110 @@ async def main():
             log(f"Трассировка: {traceback.format_exc()}")
     
     # Логируем список источников для отладки
-    sources = db.list_sources()
+    sources = await db.list_sources()
     log(f"Зарегистрированные источники: {[(sid, name) for sid, name, _, _ in sources]}")
     
     log("Обработчики зарегистрированы, бот готов")
     
+    # Догоняем посты, вышедшие пока бот был остановлен
+    catchup = CatchupService(db, forwarder)
+    catchup.trigger("запуск")
+    # Незавершённые задания бэкфилла продолжаются с сохранённой точки
+    resumed = await backfill.resume()
+    if resumed:
+        log(f"Продолжено заданий бэкфилла: {resumed}")
+    
+    # Остановка по SIGTERM (systemd) и SIGINT: доставляем накопленное до отключения клиентов
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    
     # Запуск бота
+    current_user_clients = dict(user_clients)
+    user_tasks = []
+    user_should_stop = False
     try:
-        if user_client and MODE in ("bot", "auto"):
-            # User client с автопереподключением
-            user_api_id = USER_API_ID or API_ID
-            user_api_hash = USER_API_HASH or API_HASH
-            current_user_client = user_client
-            user_task = None
-            user_should_stop = False
-
-            async def run_user_client_with_reconnect():
-                nonlocal current_user_client, user_task
+        if user_clients and MODE in ("bot", "auto"):
+            # User-сессии с автопереподключением, каждая в своей задаче
+            async def run_user_client_with_reconnect(session_name: str):
+                is_primary = session_name == primary_user_name
                 while not user_should_stop:
                     try:
-                        await current_user_client.run_until_disconnected()
+                        await current_user_clients[session_name].run_until_disconnected()
                     except asyncio.CancelledError:
                         break
                     except Exception as e:
-                        log(f"User client упал: {e}")
+                        log(f"User client {session_name} упал: {e}")
+                        forwarder.users.mark_down(session_name)
                         try:
                             await notify_admins(
                                 client,
-                                f"⚠️ User bot упал: {str(e)[:200]}\n\nПереподключаю через {USER_CLIENT_RECONNECT_DELAY} сек..."
+                                f"⚠️ User bot {session_name} упал: {str(e)[:200]}\n\nПереподключаю через {USER_CLIENT_RECONNECT_DELAY} сек..."
                             )
                         except Exception:
                             pass
                         try:
-                            await current_user_client.disconnect()
+                            await current_user_clients[session_name].disconnect()
                         except Exception:
                             pass
                         if user_should_stop:
                             break
                         await asyncio.sleep(USER_CLIENT_RECONNECT_DELAY)
                         try:
-                            new_client = TelegramClient(USER_SESSION_NAME, user_api_id, user_api_hash)
+                            new_client = TelegramClient(session_name, user_api_id, user_api_hash)
                             await new_client.start()
-                            current_user_client = new_client
-                            forwarder.set_user_client(new_client)
-                            chat_name_cache.set_user_client(new_client)
-                            register_user_handler(new_client)
-                            log("User client переподключен")
-                            await notify_admins(client, "✓ User bot переподключен.")
+                            current_user_clients[session_name] = new_client
+                            forwarder.set_user_client(new_client, session_name)
+                            if is_primary:
+                                chat_name_cache.set_user_client(new_client)
+                                register_user_handler(new_client)
+                            log(f"User client {session_name} переподключен")
+                            catchup.trigger(f"переподключение {session_name}")
+                            await notify_admins(client, f"✓ User bot {session_name} переподключен.")
                         except Exception as e2:
-                            log(f"Не удалось переподключить user client: {e2}")
+                            log(f"Не удалось переподключить user client {session_name}: {e2}")
                             await notify_admins(
                                 client,
-                                f"❌ Не удалось переподключить user bot: {e2}"
+                                f"❌ Не удалось переподключить user bot {session_name}: {e2}"
                             )
 
-            user_task = asyncio.create_task(run_user_client_with_reconnect())
-            try:
-                await client.run_until_disconnected()
-            finally:
-                user_should_stop = True
-                if user_task:
-                    user_task.cancel()
-                    try:
-                        await user_task
-                    except asyncio.CancelledError:
-                        pass
-                try:
-                    await current_user_client.disconnect()
-                except Exception:
-                    pass
-        else:
-            await client.run_until_disconnected()
+            user_tasks = [
+                asyncio.create_task(run_user_client_with_reconnect(name)) for name in current_user_clients
+            ]
+        await run_until_stopped(client, stop_event)
     finally:
-        if user_client:
+        log("Остановка: прекращаем приём постов и доставляем накопленное")
+        resolve_task.cancel()
+        await catchup.stop()
+        await backfill.stop()
+        await retry.stop()
+        try:
+            if not await forwarder.drain(SHUTDOWN_DRAIN_SEC):
+                log(f"Очередь не доставлена за {SHUTDOWN_DRAIN_SEC:.0f} сек, остаток будет сохранён в журнал")
+        except Exception as e:
+            log(f"ОШИБКА доставки очереди при остановке: {e}")
+        await forwarder.stop()
+        await capabilities.stop()
+        await checkpointer.stop()
+        # Клиенты отключаем только после доставки
+        user_should_stop = True
+        for task in user_tasks:
+            task.cancel()
+        await asyncio.gather(*user_tasks, return_exceptions=True)
+        for uc in list(current_user_clients.values()) + list(user_clients.values()):
             try:
-                await user_client.disconnect()
+                await uc.disconnect()
             except Exception:
                 pass
+        try:
+            await client.disconnect()
+        except Exception:
+            pass
+        db.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Адаптивный таймаут сборки альбомов по наблюдаемым интервалам между элементами
+"""
+import math
+from collections import deque
+from typing import Deque, Dict
+
+# Telegram не присылает в одном альбоме больше 10 элементов
+MAX_ALBUM_ITEMS = 10
+
+
+class AlbumTimeouts:
+    """
+    Для каждого источника хранит последние интервалы между элементами альбомов
+    и выдаёт таймаут ожидания = p99 интервалов + запас, в пределах [minimum, default].
+    Пока наблюдений меньше min_samples, используется default (ALBUM_IDLE_SEC).
+    """
+
+    def __init__(self, default: float, minimum: float, margin: float, min_samples: int, history: int = 200):
+        self.default = default
+        self.minimum = min(minimum, default)
+        self.margin = margin
+        self.min_samples = max(1, min_samples)
+        self.history = max(self.min_samples, history)
+        self._gaps: Dict[int, Deque[float]] = {}
+        self._timeouts: Dict[int, float] = {}
+
+    def observe(self, source_id: int, gap: float) -> None:
+        """Учитывает интервал между соседними элементами одного альбома"""
+        gaps = self._gaps.get(source_id)
+        if gaps is None:
+            gaps = self._gaps[source_id] = deque(maxlen=self.history)
+        gaps.append(max(0.0, gap))
+        if len(gaps) < self.min_samples:
+            return
+        ordered = sorted(gaps)
+        p99 = ordered[min(len(ordered) - 1, math.ceil(0.99 * len(ordered)) - 1)]
+        self._timeouts[source_id] = min(self.default, max(self.minimum, p99 + self.margin))
+
+    def timeout(self, source_id: int) -> float:
+        return self._timeouts.get(source_id, self.default)
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+Бэкфилл истории источника в склад (/backfill) с точками продолжения в БД
+"""
+import asyncio
+import datetime
+import time
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from telethon import TelegramClient
+from telethon.tl.types import Message
+from config import FORWARD_BATCH_MAX, BACKFILL_REQUEST_DELAY_SEC, BACKFILL_STATUS_EVERY_SEC
+from database import AsyncDatabase
+from services.delivery import DeliveryJob, RescheduleJob
+from services.errors import SOURCE_GONE, TRANSIENT, SourceAccessError, classify
+from services.ratelimit import LANE_BULK
+from services.forwarder import ForwarderService
+from utils.chat_names import chat_name_cache
+from utils.logger import log
+
+RUNNING = "running"
+PAUSED = "paused"  # остановлен ошибкой склада, можно продолжить
+DONE = "done"
+CANCELLED = "cancelled"
+
+STATUS_TITLES = {RUNNING: "идёт", PAUSED: "приостановлен", DONE: "завершён", CANCELLED: "отменён"}
+
+# Повторов временной ошибки на одну пачку, прежде чем приостановить задание
+TRANSIENT_ATTEMPTS = 3
+
+
+class BackfillError(Exception):
+    """Задание бэкфилла нельзя создать или продолжить (текст — для админа)"""
+
+
+class BackfillJob:
+    """Пересылка сообщений источника с ID в (min_id, max_id] в склад; cursor_id — последний доставленный"""
+
+    __slots__ = ("id", "source_id", "target_id", "min_id", "max_id", "cursor_id", "forwarded",
+                 "status", "error", "chat_id", "status_msg_id")
+
+    def __init__(self, row: Tuple):
+        (self.id, self.source_id, self.target_id, self.min_id, self.max_id, self.cursor_id,
+         self.forwarded, self.status, self.error, self.chat_id, self.status_msg_id) = row
+
+    @property
+    def progress(self) -> float:
+        span = self.max_id - self.min_id
+        return 1.0 if span <= 0 else min(1.0, (self.cursor_id - self.min_id) / span)
+
+
+class BackfillService:
+    """
+    Историю читает user-сессия постранично (iter_messages по 100, с паузой между
+    запросами) — в памяти только текущий альбом и пачка одиночных постов. Альбомы
+    собираются по grouped_id, одиночные посты уходят пачками до 100 ID. Доставка
+    идёт через общие лимиты частоты, по одной пачке за раз; после каждой пачки
+    cursor_id сохраняется в БД, и после перезапуска задание продолжается с него.
+    Верхняя граница (max_id) фиксируется при создании: новые посты идут обычным путём.
+    Шаг репоста не применяется — админ явно просит перенести историю.
+    """
+
+    def __init__(self, db: AsyncDatabase, forwarder: ForwarderService,
+                 request_delay: float = BACKFILL_REQUEST_DELAY_SEC,
+                 status_every: float = BACKFILL_STATUS_EVERY_SEC, batch: int = FORWARD_BATCH_MAX):
+        self.db = db
+        self.forwarder = forwarder
+        self.request_delay = max(0.0, request_delay)
+        self.status_every = max(1.0, status_every)
+        self.batch = max(1, min(100, batch))
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    def _reader(self) -> Tuple[str, TelegramClient]:
+        """Боту история канала недоступна — читает первая подключённая user-сессия"""
+        for session in self.forwarder.users:
+            if session.available:
+                return session.key, session.client
+        raise BackfillError("нет подключённой user-сессии: боту история канала недоступна")
+
+    async def create(self, source_id: int, target_id: int, count: Optional[int] = None,
+                     since: Optional[datetime.datetime] = None, chat_id: Optional[int] = None,
+                     status_msg_id: Optional[int] = None) -> BackfillJob:
+        """Определяет диапазон ID (последние count постов или с даты since) и запускает задание"""
+        key, client = self._reader()
+        peer = await self.forwarder.peers.lookup(key, client, source_id)
+        newest = await client.get_messages(peer, limit=1)
+        if not newest:
+            raise BackfillError("в источнике нет сообщений")
+        if count is not None:
+            # Сообщение, предшествующее последним count, — нижняя граница (не включается)
+            older = await client.get_messages(peer, limit=1, add_offset=count)
+        else:
+            older = await client.get_messages(peer, limit=1, offset_date=since)
+        min_id = older[0].id if older else 0
+        job_id = await self.db.add_backfill(source_id, target_id, min_id, newest[0].id, chat_id, status_msg_id)
+        job = BackfillJob(await self.db.get_backfill(job_id))
+        self._start(job)
+        return job
+
+    async def resume(self, job_id: Optional[int] = None) -> int:
+        """Продолжает незавершённые задания (все при запуске или одно приостановленное)"""
+        if job_id is None:
+            rows = await self.db.list_backfills(RUNNING, limit=1000)
+        else:
+            row = await self.db.get_backfill(job_id)
+            if row is None:
+                raise BackfillError(f"задание #{job_id} не найдено")
+            if row[7] not in (RUNNING, PAUSED):
+                raise BackfillError(f"задание #{job_id} {STATUS_TITLES.get(row[7], row[7])}")
+            rows = [row]
+        started = 0
+        for row in rows:
+            job = BackfillJob(row)
+            if job.id in self._tasks:
+                continue
+            job.status, job.error = RUNNING, None
+            self._start(job)
+            started += 1
+        return started
+
+    async def cancel(self, job_id: int) -> bool:
+        task = self._tasks.pop(job_id, None)
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        row = await self.db.get_backfill(job_id)
+        if row is None or row[7] in (DONE, CANCELLED):
+            return False
+        job = BackfillJob(row)
+        job.status = CANCELLED
+        await self.db.update_backfill(job.id, job.cursor_id, job.forwarded, CANCELLED, job.error)
+        await self._report(job)
+        return True
+
+    async def stop(self) -> None:
+        """Остановка бота: задания остаются running и продолжатся при следующем запуске"""
+        tasks = list(self._tasks.values())
+        self._tasks.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _start(self, job: BackfillJob) -> None:
+        task = asyncio.create_task(self._run(job))
+        self._tasks[job.id] = task
+
+        def forget(finished: asyncio.Task) -> None:
+            if self._tasks.get(job.id) is finished:
+                del self._tasks[job.id]
+
+        task.add_done_callback(forget)
+
+    async def _run(self, job: BackfillJob) -> None:
+        log(f"Бэкфилл #{job.id} {job.source_id} → {job.target_id}: ID {job.cursor_id + 1}..{job.max_id}")
+        await self._report(job)
+        reported = time.monotonic()
+        try:
+            key, client = self._reader()
+            peer = await self.forwarder.peers.lookup(key, client, job.source_id)
+            async for ids, album in self._units(client, peer, job.cursor_id, job.max_id):
+                error = await self._deliver(job, ids, album)
+                if error is not None:
+                    job.status, job.error = PAUSED, f"{type(error).__name__}: {error}"[:300]
+                    break
+                job.cursor_id = ids[-1]
+                job.forwarded += len(ids)
+                await self.db.update_backfill(job.id, job.cursor_id, job.forwarded, RUNNING)
+                if time.monotonic() - reported >= self.status_every:
+                    await self._report(job)
+                    reported = time.monotonic()
+            else:
+                job.status, job.cursor_id = DONE, job.max_id
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            job.status, job.error = PAUSED, f"{type(e).__name__}: {e}"[:300]
+        await self.db.update_backfill(job.id, job.cursor_id, job.forwarded, job.status, job.error)
+        log(f"Бэкфилл #{job.id}: {STATUS_TITLES[job.status]}, переслано {job.forwarded}"
+            + (f" ({job.error})" if job.error else ""))
+        await self._report(job)
+
+    async def _units(self, client: TelegramClient, peer, after_id: int,
+                     max_id: int) -> AsyncIterator[Tuple[List[int], bool]]:
+        """Поток (ID, альбом?) по возрастанию: альбомы целиком, одиночные посты пачками"""
+        singles: List[int] = []
+        album: List[int] = []
+        group = None
+        async for message in client.iter_messages(
+            peer, reverse=True, min_id=after_id, max_id=max_id + 1, wait_time=self.request_delay
+        ):
+            if not isinstance(message, Message):
+                continue
+            if message.grouped_id and message.grouped_id == group:
+                album.append(message.id)
+                continue
+            if album:
+                yield album, True
+                album = []
+            group = message.grouped_id
+            if group:
+                if singles:
+                    yield singles, False
+                    singles = []
+                album = [message.id]
+            else:
+                singles.append(message.id)
+                if len(singles) >= self.batch:
+                    yield singles, False
+                    singles = []
+        if album:
+            yield album, True
+        if singles:
+            yield singles, False
+
+    async def _deliver(self, job: BackfillJob, ids: List[int], album: bool) -> Optional[Exception]:
+        """Одна пачка с ожиданием FloodWait; None — доставлено (или сообщения удалены)"""
+        delivery = DeliveryJob(job.source_id, job.target_id, ids, album=album, lane=LANE_BULK)
+        attempts = 0
+        while True:
+            try:
+                error = await self.forwarder.deliver_now(delivery)
+            except RescheduleJob as e:
+                await asyncio.sleep(e.delay)
+                continue
+            # Удалённые сообщения пропускаем; потерянный доступ к источнику — пауза задания
+            if error is None or (classify(error) == SOURCE_GONE and not isinstance(error, SourceAccessError)):
+                return None
+            attempts += 1
+            if classify(error) != TRANSIENT or attempts >= TRANSIENT_ATTEMPTS:
+                return error
+            await asyncio.sleep(2 ** attempts)
+
+    async def _report(self, job: BackfillJob) -> None:
+        """Обновляет единственное сообщение о ходе задания"""
+        if not job.chat_id or not job.status_msg_id:
+            return
+        try:
+            await self.forwarder.client.edit_message(job.chat_id, job.status_msg_id, await self.render(job))
+        except Exception:
+            pass  # сообщение удалено или текст не изменился
+
+    @staticmethod
+    async def render(job: BackfillJob) -> str:
+        source_name = await chat_name_cache.get_name(job.source_id)
+        target_name = await chat_name_cache.get_name(job.target_id)
+        text = (
+            f"📥 Бэкфилл #{job.id}: {source_name} → {target_name}\n"
+            f"Состояние: {STATUS_TITLES.get(job.status, job.status)}\n"
+            f"Переслано: {job.forwarded} ({job.progress:.0%}, ID {job.cursor_id} из {job.max_id})"
+        )
+        if job.error:
+            text += f"\nОшибка: {job.error}"
+        if job.status == PAUSED:
+            text += f"\nПродолжить: /backfill resume {job.id}"
+        return text
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Автоматы отключения складов: closed → open → half-open → closed
+"""
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from services.scheduler import Scheduler
+from utils.logger import log
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    __slots__ = ("state", "failures", "interval", "opened_at", "probe_at", "last_error")
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0  # подряд неудачных доставок из-за склада
+        self.interval = 0.0
+        self.opened_at = 0.0
+        self.probe_at = 0.0
+        self.last_error = ""
+
+
+class BreakerBoard:
+    """
+    После threshold подряд доставок, не удавшихся из-за склада (нет прав / склад
+    недоступен) ни одним клиентом, автомат размыкается: доставка в склад сразу
+    завершается CircuitOpenError, без запросов к API. Через interval склад
+    проверяется (probe, а также одна пробная доставка в half-open): успех замыкает
+    автомат, неудача размыкает снова с удвоенным интервалом (до max_interval).
+    Админы получают одно уведомление на размыкание и одно на замыкание.
+    """
+
+    def __init__(self, scheduler: Scheduler, threshold: int, base_interval: float, max_interval: float):
+        self.scheduler = scheduler
+        self.threshold = max(1, threshold)
+        self.base_interval = max(1.0, base_interval)
+        self.max_interval = max(self.base_interval, max_interval)
+        self._breakers: Dict[int, CircuitBreaker] = {}
+        self._notify: Optional[Callable[[str], Awaitable[None]]] = None
+        self._probe: Optional[Callable[[int], Awaitable[Optional[bool]]]] = None
+
+    def attach(self, notify: Optional[Callable[[str], Awaitable[None]]] = None,
+               probe: Optional[Callable[[int], Awaitable[Optional[bool]]]] = None) -> None:
+        """notify(text) — уведомление админам; probe(target) — может ли кто-то публиковать в склад"""
+        self._notify = notify
+        self._probe = probe
+
+    def blocked_for(self, target: int) -> float:
+        """
+        0 — отправлять можно; иначе сколько секунд до следующей проверки.
+        В half-open пропускается одна пробная доставка.
+        """
+        breaker = self._breakers.get(target)
+        if breaker is None or breaker.state == CLOSED:
+            return 0.0
+        now = time.monotonic()
+        if breaker.state == OPEN and now >= breaker.probe_at:
+            breaker.state = HALF_OPEN
+            return 0.0
+        return max(1.0, breaker.probe_at - now)
+
+    def success(self, target: int) -> None:
+        breaker = self._breakers.get(target)
+        if breaker is None:
+            return
+        was_open = breaker.state != CLOSED
+        del self._breakers[target]
+        self.scheduler.cancel(("breaker", target))
+        if was_open:
+            log(f"Склад {target}: автомат замкнут, доставка возобновлена")
+            self._send_notice(f"✅ Склад {target} снова доступен, пересылка возобновлена.")
+
+    def failure(self, target: int, error: str) -> None:
+        """Доставка в склад не удалась из-за склада (нет прав / недоступен)"""
+        breaker = self._breakers.get(target)
+        if breaker is None:
+            breaker = self._breakers[target] = CircuitBreaker()
+        breaker.failures += 1
+        breaker.last_error = error[:200]
+        if breaker.state == HALF_OPEN:
+            self._open(target, breaker, min(self.max_interval, breaker.interval * 2))
+        elif breaker.state == CLOSED and breaker.failures >= self.threshold:
+            self._open(target, breaker, self.base_interval)
+            log(f"Склад {target}: автомат разомкнут после {breaker.failures} неудач: {breaker.last_error}")
+            self._send_notice(
+                f"⛔️ Склад {target} отключён: {breaker.failures} доставок подряд не удались.\n"
+                f"Причина: {breaker.last_error}\nПроверка через {self.base_interval:.0f} сек."
+            )
+
+    def inconclusive(self, target: int) -> None:
+        """Пробная доставка не удалась по причине, не связанной со складом — ждём следующей проверки"""
+        breaker = self._breakers.get(target)
+        if breaker is not None and breaker.state == HALF_OPEN:
+            self._open(target, breaker, breaker.interval)
+
+    def _open(self, target: int, breaker: CircuitBreaker, interval: float) -> None:
+        now = time.monotonic()
+        if breaker.state == CLOSED:
+            breaker.opened_at = now
+        breaker.state = OPEN
+        breaker.interval = interval
+        breaker.probe_at = now + interval
+        if self._probe is not None:
+            self.scheduler.call_later(interval, ("breaker", target), self._run_probe, target)
+
+    async def _run_probe(self, target: int) -> None:
+        breaker = self._breakers.get(target)
+        if breaker is None or breaker.state == CLOSED or self._probe is None:
+            return
+        breaker.state = HALF_OPEN
+        try:
+            ok = await self._probe(target)
+        except Exception as e:
+            log(f"ОШИБКА проверки склада {target}: {e}")
+            ok = None
+        if self._breakers.get(target) is not breaker or breaker.state != HALF_OPEN:
+            return  # пробная доставка успела решить судьбу автомата
+        if ok:
+            self.success(target)
+        elif ok is False:
+            self._open(target, breaker, min(self.max_interval, breaker.interval * 2))
+        else:
+            self._open(target, breaker, breaker.interval)
+
+    def _send_notice(self, text: str) -> None:
+        if self._notify is None:
+            return
+        try:
+            asyncio.get_running_loop().create_task(self._notify(text))
+        except RuntimeError:
+            pass
+
+    def stats(self) -> List[Tuple[int, str, int, float]]:
+        """(склад, состояние, неудач, секунд до проверки) для незамкнутых автоматов"""
+        now = time.monotonic()
+        return [
+            (target, b.state, b.failures, max(0.0, b.probe_at - now))
+            for target, b in self._breakers.items() if b.state != CLOSED
+        ]
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+Карта возможностей клиентов: кто (бот / user client) может публиковать в каждый склад
+"""
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from telethon import TelegramClient
+from telethon.errors import RPCError
+from config import CAPABILITY_TTL_SEC, CAPABILITY_PROBE_BATCH, CAPABILITY_PROBE_INTERVAL_SEC
+from database import AsyncDatabase
+from services.errors import TARGET_KINDS, classify
+from utils.logger import log
+
+ROLES = ("bot", "user")
+
+
+class TargetCapability:
+    """Для каждой роли: True — может публиковать, False — не может, None — неизвестно"""
+
+    __slots__ = ("bot", "user", "verified_at", "last_error")
+
+    def __init__(self, bot: Optional[bool] = None, user: Optional[bool] = None,
+                 verified_at: float = 0.0, last_error: Optional[str] = None):
+        self.bot = bot
+        self.user = user
+        self.verified_at = verified_at
+        self.last_error = last_error
+
+
+class CapabilityMap:
+    """
+    Маршрутизация по выученным возможностям: склад, куда бот не может публиковать,
+    сразу идёт через user client, без заведомо неудачной попытки ботом. Флаг роли
+    меняется только по результату отправки или проверки, а не сбрасывается первым
+    успехом другой роли, поэтому маршрут не «качается».
+    """
+
+    def __init__(self):
+        self._targets: Dict[int, TargetCapability] = {}
+        self._dirty: Set[int] = set()
+
+    def __len__(self) -> int:
+        return len(self._targets)
+
+    def get(self, target: int) -> TargetCapability:
+        cap = self._targets.get(target)
+        return cap if cap is not None else TargetCapability()
+
+    def route(self, target: int, has_user: bool) -> List[str]:
+        """Роли в порядке попыток"""
+        cap = self._targets.get(target)
+        if cap is None:
+            return ["bot", "user"] if has_user else ["bot"]
+        roles = [role for role in ROLES if getattr(cap, role) is not False and (role == "bot" or has_user)]
+        if not roles:
+            # Не может никто — пробуем как обычно: права могли вернуть до следующей проверки
+            return ["user", "bot"] if has_user and cap.user is not None else ["bot"]
+        # Известная возможность важнее неизвестной
+        if has_user and cap.bot is None and cap.user is True:
+            roles = ["user", "bot"]
+        return roles
+
+    def record(self, target: int, role: str, ok: bool, error: Optional[str] = None) -> None:
+        cap = self._targets.get(target)
+        if cap is None:
+            cap = self._targets[target] = TargetCapability()
+        changed = getattr(cap, role) != ok
+        setattr(cap, role, ok)
+        cap.verified_at = time.time()
+        if not ok:
+            cap.last_error = (error or "")[:300]
+        if changed:
+            log(f"Склад {target}: {role} {'может' if ok else 'не может'} публиковать")
+        self._dirty.add(target)
+
+    def forget(self, target: int) -> None:
+        self._targets.pop(target, None)
+        self._dirty.discard(target)
+
+    def stale(self, targets: List[int], ttl: float) -> List[int]:
+        """Склады без проверки или с проверкой старше ttl, сначала самые давние"""
+        deadline = time.time() - ttl
+        due = [(self.get(t).verified_at, t) for t in targets if self.get(t).verified_at < deadline]
+        return [t for _, t in sorted(due)]
+
+    def export_dirty(self) -> List[Tuple[int, Optional[bool], Optional[bool], float, Optional[str]]]:
+        rows = []
+        for target in self._dirty:
+            cap = self._targets.get(target)
+            if cap is not None:
+                rows.append((target, cap.bot, cap.user, cap.verified_at, cap.last_error))
+        self._dirty = set()
+        return rows
+
+    def restore(self, data: Dict[int, Tuple[Optional[bool], Optional[bool], float, Optional[str]]]) -> None:
+        for target, (bot, user, verified_at, error) in data.items():
+            self._targets[target] = TargetCapability(bot, user, verified_at, error)
+
+    def stats(self) -> Dict[str, int]:
+        counts = {"bot": 0, "user_only": 0, "none": 0, "unknown": 0}
+        for cap in self._targets.values():
+            if cap.bot:
+                counts["bot"] += 1
+            elif cap.user:
+                counts["user_only"] += 1
+            elif cap.bot is False and cap.user is False:
+                counts["none"] += 1
+            else:
+                counts["unknown"] += 1
+        return counts
+
+
+async def probe_client(client: TelegramClient, target: int) -> Tuple[Optional[bool], Optional[str]]:
+    """
+    Проверяет права без публикации: участие в чате и право писать.
+    Возвращает (может ли публиковать, ошибка); None — проверка не удалась (сеть,
+    FloodWait, склад не разрешён в кэше сессии и т.п.).
+    """
+    try:
+        entity = await client.get_entity(target)
+        perms = await client.get_permissions(entity, "me")
+    except RPCError as e:
+        # Не участник, канал закрыт, бан — публиковать нельзя; FloodWait и сбои сервера — неизвестно
+        return (False if classify(e) in TARGET_KINDS else None), f"{type(e).__name__}: {e}"
+    except (ValueError, TypeError) as e:
+        # Сущности нет в кэше сессии (обычно сразу после запуска) — это не отказ в правах
+        return None, str(e)
+    except Exception as e:
+        return None, str(e)
+    if perms.has_left or perms.is_banned:
+        return False, "нет в чате или заблокирован"
+    if getattr(entity, "broadcast", False):
+        if perms.is_creator or perms.post_messages:
+            return True, None
+        return False, "нет права публикации в канале"
+    banned = getattr(entity, "default_banned_rights", None)
+    if banned is not None and getattr(banned, "send_messages", False) and not perms.is_admin:
+        return False, "в чате запрещена отправка сообщений"
+    return True, None
+
+
+class CapabilityService:
+    """
+    Загружает и сохраняет карту возможностей (write-behind) и в фоне перепроверяет
+    склады, проверка которых старше CAPABILITY_TTL_SEC, — не больше
+    CAPABILITY_PROBE_BATCH за раз.
+    """
+
+    def __init__(self, db: AsyncDatabase, capabilities: CapabilityMap,
+                 probes: Callable[[], Dict[str, Callable[[int], Awaitable[Tuple[Optional[bool], Optional[str]]]]]],
+                 interval: float = CAPABILITY_PROBE_INTERVAL_SEC, ttl: float = CAPABILITY_TTL_SEC,
+                 batch: int = CAPABILITY_PROBE_BATCH):
+        self.db = db
+        self.capabilities = capabilities
+        self.probes = probes  # роль → проверка склада (см. probe_client)
+        self.interval = max(5.0, interval)
+        self.ttl = max(60.0, ttl)
+        self.batch = max(1, batch)
+        self._task: Optional[asyncio.Task] = None
+
+    async def restore(self) -> None:
+        try:
+            self.capabilities.restore(await self.db.load_capabilities())
+        except Exception as e:
+            log(f"Предупреждение: Не удалось загрузить карту возможностей складов: {e}")
+
+    async def flush(self) -> None:
+        rows = self.capabilities.export_dirty()
+        if not rows:
+            return
+        try:
+            await self.db.save_capabilities(rows)
+        except Exception as e:
+            log(f"ОШИБКА сохранения карты возможностей складов: {e}")
+
+    async def probe(self, target: int) -> None:
+        """Перепроверяет обе роли для склада"""
+        for role, probe in self.probes().items():
+            ok, error = await probe(target)
+            if ok is not None:
+                self.capabilities.record(target, role, ok, error)
+
+    async def can_post(self, target: int) -> Optional[bool]:
+        """Перепроверяет склад: True — публиковать может хотя бы одна роль, None — не удалось проверить"""
+        await self.probe(target)
+        cap = self.capabilities.get(target)
+        if cap.bot or cap.user:
+            return True
+        roles = self.probes()
+        if all(getattr(cap, role, None) is False for role in roles):
+            return False
+        return None
+
+    async def probe_stale(self) -> int:
+        targets = [row[0] for row in await self.db.list_targets()]
+        due = self.capabilities.stale(targets, self.ttl)[:self.batch]
+        for target in due:
+            await self.probe(target)
+        return len(due)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.probe_stale()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log(f"ОШИБКА проверки возможностей складов: {e}")
+            await self.flush()
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
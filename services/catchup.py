@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Догоняние постов, пропущенных во время простоя или разрыва соединения
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Deque, List, Optional, Tuple
+from telethon import TelegramClient
+from telethon.errors import FloodWaitError, RPCError
+from telethon.tl.types import Message
+from config import CATCHUP_MAX_PER_SOURCE, CATCHUP_REQUEST_DELAY_SEC
+from database import AsyncDatabase
+from services.forwarder import ForwarderService
+from utils.logger import log
+
+# Сообщений за один запрос истории (предел Telegram)
+FETCH_BATCH = 100
+# FloodWait на чтение истории дольше этого не ждём — переходим к другому клиенту
+MAX_FLOOD_WAIT_SEC = 60
+
+
+class CatchupService:
+    """
+    Для каждого источника с привязками запрашивает посты новее last_seen и
+    прогоняет их по порядку через forward_message: шаг репоста, дедупликация и
+    склейка альбомов работают как для живых постов, доставка идёт через обычные
+    очереди с лимитами частоты (одиночные посты склеиваются до 100 ID). Пока
+    источник догоняется, его живые посты ждут, чтобы не обогнать старые.
+    Источник без last_seen (ещё ни одного поста) не догоняется.
+    """
+
+    def __init__(self, db: AsyncDatabase, forwarder: ForwarderService,
+                 max_per_source: int = CATCHUP_MAX_PER_SOURCE,
+                 request_delay: float = CATCHUP_REQUEST_DELAY_SEC):
+        self.db = db
+        self.forwarder = forwarder
+        self.max_per_source = max(0, max_per_source)
+        self.request_delay = max(0.0, request_delay)
+        self._task: Optional[asyncio.Task] = None
+        self._rerun = False
+        # Итоги последнего прохода: (время окончания, источников, сообщений)
+        self.last_run: Optional[Tuple[float, int, int]] = None
+
+    def trigger(self, reason: str) -> None:
+        """Запускает проход в фоне; если он уже идёт — повторяет его после окончания"""
+        if self.max_per_source <= 0:
+            return
+        if self._task is not None and not self._task.done():
+            self._rerun = True
+            return
+        self._task = asyncio.create_task(self._run(reason))
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self, reason: str) -> None:
+        while True:
+            self._rerun = False
+            try:
+                await self.run(reason)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log(f"ОШИБКА догоняния пропущенных постов: {e}")
+            if not self._rerun:
+                return
+            reason = "повтор"
+
+    async def run(self, reason: str) -> int:
+        """Один проход по всем источникам; возвращает число обработанных сообщений"""
+        started = time.monotonic()
+        sources = total = 0
+        for source_id, *_ in await self.db.list_sources():
+            last = self.forwarder.last_seen.get(source_id)
+            if last is None or not self.db.get_targets_for_source(source_id):
+                continue
+            if not self.forwarder.accepting:
+                break
+            self.forwarder.hold_source(source_id)
+            try:
+                messages = await self._fetch(source_id, last)
+                # Привязки и шаги берутся на момент обработки — могли измениться за время простоя
+                targets = list(self.db.get_targets_for_source(source_id))
+                for message in messages:
+                    if not targets or not self.forwarder.accepting:
+                        break
+                    await self.forwarder.forward_message(message, targets, replay=True)
+            finally:
+                await self.forwarder.release_source(source_id)
+            if messages:
+                sources += 1
+                total += len(messages)
+                log(f"Догоняние {source_id}: {len(messages)} пропущенных сообщений после {last}")
+        self.last_run = (time.time(), sources, total)
+        log(f"Догоняние ({reason}) завершено за {time.monotonic() - started:.1f} сек: "
+            f"источников {sources}, сообщений {total}")
+        return total
+
+    def _clients(self) -> List[Tuple[str, TelegramClient]]:
+        """Сначала user-сессии (читают историю напрямую), затем бот"""
+        clients = [(s.key, s.client) for s in self.forwarder.users if s.available]
+        clients.append(("bot", self.forwarder.client))
+        return clients
+
+    async def _fetch(self, source_id: int, last: int) -> List[Message]:
+        """Сообщения источника новее last по возрастанию ID, не больше max_per_source последних"""
+        for key, client in self._clients():
+            for attempt in range(2):
+                try:
+                    peer = await self.forwarder.peers.lookup(key, client, source_id)
+                    if key == "bot":
+                        messages = await self._fetch_by_ids(client, peer, last)
+                    else:
+                        messages = await self._fetch_history(client, peer, last)
+                except FloodWaitError as e:
+                    if attempt or e.seconds > MAX_FLOOD_WAIT_SEC:
+                        log(f"Догоняние {source_id}: FloodWait {e.seconds} сек у {key}, пробуем другой клиент")
+                        break
+                    await asyncio.sleep(e.seconds + 1)
+                    continue
+                except (RPCError, ValueError, TypeError) as e:
+                    log(f"Догоняние {source_id}: {key} не может прочитать историю: {e}")
+                    break
+                if len(messages) >= self.max_per_source:
+                    log(f"Догоняние {source_id}: пропущено не меньше {self.max_per_source} сообщений, "
+                        f"более старые не пересылаются")
+                return messages
+        return []
+
+    async def _fetch_history(self, client: TelegramClient, peer, last: int) -> List[Message]:
+        """messages.getHistory: самые новые сообщения после last (Telethon запрашивает по 100)"""
+        messages = [
+            m async for m in client.iter_messages(
+                peer, limit=self.max_per_source, min_id=last, wait_time=self.request_delay
+            )
+            if isinstance(m, Message)
+        ]
+        messages.reverse()
+        return messages
+
+    async def _fetch_by_ids(self, client: TelegramClient, peer, last: int) -> List[Message]:
+        """
+        Боту история недоступна — запрашиваем ID подряд пачками по 100 (channels.getMessages).
+        Пачка без единого сообщения считается концом канала.
+        """
+        messages: Deque[Message] = deque(maxlen=self.max_per_source)
+        start = last + 1
+        while True:
+            batch = await client.get_messages(peer, ids=list(range(start, start + FETCH_BATCH)))
+            found = [m for m in batch if isinstance(m, Message)]
+            if not found:
+                return list(messages)
+            messages.extend(found)
+            start += FETCH_BATCH
+            await asyncio.sleep(self.request_delay)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Периодическое сохранение состояния пересылки в БД (write-behind)
+"""
+import asyncio
+from typing import Optional
+from config import FORWARDER_CHECKPOINT_SEC
+from database import AsyncDatabase
+from services.forwarder import ForwarderService
+from utils.logger import log
+
+
+class StateCheckpointer:
+    """Раз в FORWARDER_CHECKPOINT_SEC сохраняет изменившиеся компоненты состояния ForwarderService"""
+
+    def __init__(self, db: AsyncDatabase, forwarder: ForwarderService, interval: float = FORWARDER_CHECKPOINT_SEC):
+        self.db = db
+        self.forwarder = forwarder
+        self.interval = max(1.0, interval)
+        self._task: Optional[asyncio.Task] = None
+
+    async def restore(self) -> None:
+        """Загружает сохранённое состояние в ForwarderService"""
+        try:
+            state = await self.db.load_forwarder_state()
+            self.forwarder.restore_state(state)
+            if state:
+                log(f"Состояние пересылки восстановлено: {', '.join(sorted(state))}")
+        except Exception as e:
+            log(f"Предупреждение: Не удалось восстановить состояние пересылки: {e}")
+
+    async def checkpoint(self) -> None:
+        """Сохраняет изменившиеся компоненты (снимок — на event loop, сериализация — в потоке БД)"""
+        if not self.forwarder.state_dirty:
+            return
+        state = self.forwarder.export_state()
+        try:
+            await self.db.save_forwarder_state(state)
+        except Exception as e:
+            # Несохранённые компоненты уйдут в следующий чекпоинт, даже если больше не изменятся
+            self.forwarder.mark_dirty(state)
+            log(f"ОШИБКА сохранения состояния пересылки: {e}")
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.checkpoint()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Останавливает цикл и делает финальный чекпоинт"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.checkpoint()
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Компактные индексы дедупликации: окно-битмап по источнику, LRU для альбомов
+и таблица «захвата» событий между клиентами
+"""
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+
+class DedupIndex:
+    """
+    ID сообщений канала монотонны, поэтому на источник хватает наибольшего
+    виденного ID (high) и битмапа последних window ID: бит i означает, что
+    сообщение high - i уже обработано. Всё старше окна считается обработанным.
+    Память — window бит на источник, проверка и вставка — O(1), вытеснение детерминировано.
+    """
+
+    def __init__(self, window: int = 4096):
+        self.window = max(64, window)
+        self._mask = (1 << self.window) - 1
+        self._sources: Dict[int, List[int]] = {}  # chat_id → [high, bits]
+
+    def __len__(self) -> int:
+        return len(self._sources)
+
+    def seen(self, chat_id: int, msg_id: int) -> bool:
+        state = self._sources.get(chat_id)
+        if state is None:
+            return False
+        high, bits = state
+        if msg_id > high:
+            return False
+        offset = high - msg_id
+        if offset >= self.window:
+            return True
+        return bool((bits >> offset) & 1)
+
+    def add(self, chat_id: int, msg_id: int) -> None:
+        state = self._sources.get(chat_id)
+        if state is None:
+            self._sources[chat_id] = [msg_id, 1]
+            return
+        high, bits = state
+        if msg_id > high:
+            shift = msg_id - high
+            state[0] = msg_id
+            state[1] = ((bits << shift) | 1) & self._mask if shift < self.window else 1
+        else:
+            offset = high - msg_id
+            if offset < self.window:
+                state[1] = bits | (1 << offset)
+
+    def check_and_add(self, chat_id: int, msg_id: int) -> bool:
+        """True, если сообщение новое (и теперь помечено), False — если уже было"""
+        if self.seen(chat_id, msg_id):
+            return False
+        self.add(chat_id, msg_id)
+        return True
+
+    def export(self, upto: Optional[Dict[int, int]] = None) -> Dict[str, List[Any]]:
+        """upto — по источнику ID, отметки выше которого не сохраняются (посты ещё не доставлены)"""
+        data: Dict[str, List[Any]] = {}
+        for chat_id, (high, bits) in self._sources.items():
+            mark = upto.get(chat_id) if upto else None
+            if mark is not None and high > mark:
+                bits &= ~((1 << min(high - mark, self.window)) - 1)
+            data[str(chat_id)] = [high, format(bits, "x")]
+        return data
+
+    def restore(self, data: Dict[str, List[Any]]) -> None:
+        for chat_id, (high, bits) in data.items():
+            self._sources[int(chat_id)] = [int(high), int(bits, 16) & self._mask]
+
+
+class GroupLRU:
+    """Ограниченное множество ключей альбомов с вытеснением самых давних"""
+
+    def __init__(self, max_size: int = 5000):
+        self.max_size = max(1, max_size)
+        self._items: "OrderedDict[Hashable, None]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __contains__(self, key: Hashable) -> bool:
+        if key in self._items:
+            self._items.move_to_end(key)
+            return True
+        return False
+
+    def add(self, key: Hashable) -> None:
+        self._items[key] = None
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def export(self) -> List[List[int]]:
+        return [list(key) for key in self._items]
+
+    def restore(self, keys: List[List[int]]) -> None:
+        for key in keys:
+            self.add(tuple(key))
+
+
+class ClaimTable:
+    """
+    Первый клиент, получивший событие (chat_id, msg_id), «захватывает» его;
+    повтор от другого клиента отбрасывается за O(1) до любой обработки.
+    Помнит последние max_size событий и считает, какой клиент приходит первым
+    и с каким опережением.
+    """
+
+    def __init__(self, max_size: int = 8192):
+        self.max_size = max(1, max_size)
+        self._claims: "OrderedDict[Tuple[int, int], Tuple[str, float]]" = OrderedDict()
+        self.claimed: Dict[str, int] = {}  # событий захвачено клиентом
+        self.wins: Dict[str, int] = {}  # гонок выиграно (второй клиент тоже получил событие)
+        self.lead: Dict[str, float] = {}  # средняя фора победителя, сек
+        self.dropped = 0
+
+    def claim(self, chat_id: int, msg_id: int, client: str) -> bool:
+        """True — событие захвачено этим клиентом и его нужно обработать"""
+        key = (chat_id, msg_id)
+        now = time.monotonic()
+        entry = self._claims.get(key)
+        if entry is None:
+            self._claims[key] = (client, now)
+            if len(self._claims) > self.max_size:
+                self._claims.popitem(last=False)
+            self.claimed[client] = self.claimed.get(client, 0) + 1
+            return True
+        self.dropped += 1
+        winner, at = entry
+        if winner != client:
+            wins = self.wins.get(winner, 0) + 1
+            self.wins[winner] = wins
+            lead = now - at
+            self.lead[winner] = self.lead.get(winner, lead) + (lead - self.lead.get(winner, lead)) / wins
+        return False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "claimed": dict(self.claimed),
+            "wins": dict(self.wins),
+            "lead_ms": {name: round(sec * 1000) for name, sec in self.lead.items()},
+            "dropped": self.dropped,
+        }
@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+"""
+Очереди доставки: упорядоченные очереди по (источник, склад) и пул воркеров
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+from utils.logger import log
+from services.scheduler import Scheduler
+from services.ratelimit import LANE_BULK, LANE_LIVE
+
+OVERFLOW_BLOCK = "block"
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_SPILL = "spill"
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_SPILL)
+
+
+class RescheduleJob(Exception):
+    """Задание нужно повторить через delay секунд (например, после FloodWait), не теряя порядок"""
+
+    def __init__(self, delay: float):
+        super().__init__(f"повтор через {delay:.0f} сек")
+        self.delay = max(0.0, delay)
+
+
+class DeliveryJob:
+    """Пересылка набора сообщений одного источника в один склад"""
+
+    __slots__ = ("source_id", "target_id", "message_ids", "album", "from_peer", "enqueued_at",
+                 "retry_id", "attempts", "lane")
+
+    def __init__(self, source_id: int, target_id: int, message_ids: List[int], album: bool = False,
+                 from_peer: Any = None, retry_id: Optional[int] = None, attempts: int = 0,
+                 lane: int = LANE_LIVE):
+        self.source_id = source_id
+        self.target_id = target_id
+        self.message_ids = message_ids
+        self.album = album
+        # peer-объект Telethon не сериализуется; после восстановления с диска используется source_id
+        self.from_peer = from_peer
+        self.enqueued_at = time.monotonic()
+        # Запись в retry_queue, если задание — повтор
+        self.retry_id = retry_id
+        self.attempts = attempts
+        # Полоса приоритета: живые посты или массовая пересылка (догоняние, бэкфилл, повторы)
+        self.lane = lane
+
+    @property
+    def key(self) -> Tuple[int, int]:
+        return self.source_id, self.target_id
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {"s": self.source_id, "t": self.target_id, "m": self.message_ids, "a": self.album}
+        if self.retry_id is not None:
+            data["r"] = self.retry_id
+            data["n"] = self.attempts
+        if self.lane != LANE_LIVE:
+            data["l"] = self.lane
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "DeliveryJob":
+        return cls(data["s"], data["t"], list(data["m"]), bool(data.get("a")),
+                   retry_id=data.get("r"), attempts=data.get("n", 0), lane=data.get("l", LANE_LIVE))
+
+
+class DeliveryQueue:
+    """
+    Задания одного ключа (источник, склад) обрабатываются строго по очереди,
+    разные ключи — параллельно пулом воркеров. Общий объём очереди ограничен;
+    при переполнении действует политика: block, drop_oldest или spill (на диск).
+    Подряд идущие не-альбомные задания ключа воркер склеивает в одно (до coalesce ID).
+
+    Полосы: ключ готов в полосе live, если в нём есть хотя бы одно живое задание
+    (массовые задания впереди него тоже повышаются — порядок внутри ключа не
+    нарушается), иначе в полосе bulk. Воркеры берут live раньше bulk, а live_workers
+    из них обслуживают только live — живые посты не ждут освобождения воркера.
+    """
+
+    def __init__(self, handler: Callable[[DeliveryJob], Awaitable[None]], workers: int,
+                 max_backlog: int, overflow: str = OVERFLOW_BLOCK, spill_path: Optional[str] = None,
+                 scheduler: Optional[Scheduler] = None, coalesce: int = 1,
+                 journal_path: Optional[str] = None, live_workers: int = 0):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.live_workers = min(self.workers - 1, max(0, live_workers))
+        self.max_backlog = max(1, max_backlog)
+        self.overflow = overflow if overflow in OVERFLOW_POLICIES else OVERFLOW_BLOCK
+        self.spill_path = spill_path
+        self.scheduler = scheduler
+        self.coalesce = max(1, coalesce)
+        # Журнал заданий, не доставленных к остановке; воспроизводится при следующем запуске
+        self.journal_path = journal_path
+        self._active: Dict[Tuple[int, int], DeliveryJob] = {}  # задания в работе у воркеров
+        self._queues: Dict[Tuple[int, int], Deque[DeliveryJob]] = {}
+        # Готовые ключи по полосам; запись устаревает, если ключ повышен в другую полосу
+        self._ready: Dict[int, Deque[Tuple[int, int]]] = {LANE_LIVE: deque(), LANE_BULK: deque()}
+        self._ready_lane: Dict[Tuple[int, int], int] = {}  # ключ в _ready → его текущая полоса
+        self._wake = asyncio.Event()
+        self._bulk: Dict[Tuple[int, int], int] = {}  # число массовых заданий в очереди ключа
+        self._scheduled: Set[Tuple[int, int]] = set()  # ключи в _ready или в работе у воркера
+        self._size = 0
+        self._space = asyncio.Condition()
+        self._tasks: List[asyncio.Task] = []
+        self._spilled = 0
+        self._dropped = 0
+        self._unspilling = False
+        self._spill_lock = threading.Lock()  # запись и чтение файла идут в разных потоках
+        if self.spill_path and os.path.exists(self.spill_path):
+            with open(self.spill_path, "r", encoding="utf-8") as f:
+                self._spilled = sum(1 for line in f if line.strip())
+
+    def __len__(self) -> int:
+        return self._size
+
+    def busy(self, key: Tuple[int, int]) -> bool:
+        """У ключа есть задание в работе или в очереди"""
+        return key in self._active or bool(self._queues.get(key))
+
+    def start(self) -> None:
+        if not self._tasks:
+            replayed = self._replay_journal()
+            if replayed:
+                log(f"Из журнала восстановлено заданий доставки: {replayed}")
+            self._tasks = [
+                asyncio.create_task(self._worker((LANE_LIVE,) if i < self.live_workers else (LANE_LIVE, LANE_BULK)))
+                for i in range(self.workers)
+            ]
+            if self._spilled:
+                asyncio.create_task(self._unspill())
+
+    async def join(self, timeout: float) -> bool:
+        """Ждёт, пока очередь опустеет и воркеры закончат работу (не дольше timeout)"""
+        deadline = time.monotonic() + max(0.0, timeout)
+        while self._size or self._active or self._spilled:
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.1)
+        return True
+
+    async def stop(self) -> List[DeliveryJob]:
+        """
+        Останавливает воркеры; недоставленное (в том числе прерванное) пишется в журнал.
+        Возвращает задания, записанные в журнал.
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if not self.journal_path:
+            return []
+        jobs = self._pending_jobs()
+        written = await asyncio.to_thread(self._write_journal, jobs)
+        if written:
+            log(f"Недоставленные задания ({written}) сохранены в журнал {self.journal_path}")
+        return jobs
+
+    def _pending_jobs(self) -> List[DeliveryJob]:
+        """Ждущие (и прерванные) задания в порядке доставки; повторы остаются в retry_queue"""
+        return [job for bucket in self._queues.values() for job in bucket if job.retry_id is None]
+
+    def _write_journal(self, jobs: List[DeliveryJob]) -> int:
+        if not jobs:
+            return 0
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for job in jobs:
+                f.write(json.dumps(job.to_dict(), separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        # Атомарная замена: журнал либо старый, либо полностью новый
+        os.replace(tmp_path, self.journal_path)
+        return len(jobs)
+
+    def _replay_journal(self) -> int:
+        if not self.journal_path or not os.path.exists(self.journal_path):
+            return 0
+        count = 0
+        try:
+            with open(self.journal_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        self._push(DeliveryJob.from_dict(json.loads(line)))
+                        count += 1
+            os.remove(self.journal_path)
+        except Exception as e:
+            log(f"ОШИБКА чтения журнала доставки {self.journal_path}: {e}")
+        return count
+
+    async def put(self, job: DeliveryJob) -> None:
+        """Ставит задание в очередь его ключа (с учётом политики переполнения)"""
+        if self.overflow == OVERFLOW_SPILL and self.spill_path:
+            # Пока на диске есть задания (или их как раз забирают), новые тоже идут туда —
+            # иначе нарушится порядок
+            if self._spilled or self._unspilling or self._size >= self.max_backlog:
+                await asyncio.to_thread(self._spill, [job])
+                return
+        elif self._size >= self.max_backlog:
+            if self.overflow == OVERFLOW_DROP_OLDEST:
+                self._drop_oldest()
+            else:
+                async with self._space:
+                    await self._space.wait_for(lambda: self._size < self.max_backlog)
+        self._push(job)
+
+    def _push(self, job: DeliveryJob) -> None:
+        key = job.key
+        bucket = self._queues.get(key)
+        if bucket is None:
+            bucket = self._queues[key] = deque()
+        bucket.append(job)
+        self._size += 1
+        self._count(job, 1)
+        if key not in self._scheduled:
+            self._scheduled.add(key)
+            self._mark_ready(key)
+        elif self._ready_lane.get(key, LANE_LIVE) > job.lane:
+            # Живое задание повышает ждущий ключ до полосы live
+            self._mark_ready(key)
+
+    def _count(self, job: DeliveryJob, delta: int) -> None:
+        if job.lane == LANE_BULK:
+            left = self._bulk.get(job.key, 0) + delta
+            if left > 0:
+                self._bulk[job.key] = left
+            else:
+                self._bulk.pop(job.key, None)
+
+    def _lane(self, key: Tuple[int, int]) -> int:
+        bucket = self._queues.get(key)
+        return LANE_LIVE if bucket and len(bucket) > self._bulk.get(key, 0) else LANE_BULK
+
+    def _mark_ready(self, key: Tuple[int, int]) -> None:
+        lane = self._lane(key)
+        self._ready_lane[key] = lane
+        self._ready[lane].append(key)
+        self._wake.set()
+
+    def _next_key(self, lanes: Tuple[int, ...]) -> Optional[Tuple[int, int]]:
+        for lane in lanes:
+            ready = self._ready[lane]
+            while ready:
+                key = ready.popleft()
+                if self._ready_lane.get(key) == lane:
+                    del self._ready_lane[key]
+                    return key
+        return None
+
+    def _drop_oldest(self) -> None:
+        oldest_key = min(
+            (k for k, q in self._queues.items() if q),
+            key=lambda k: self._queues[k][0].enqueued_at,
+            default=None
+        )
+        if oldest_key is None:
+            return
+        job = self._queues[oldest_key].popleft()
+        self._size -= 1
+        self._count(job, -1)
+        self._dropped += 1
+        log(f"ОШИБКА: очередь доставки переполнена, отброшено задание {job.source_id} → {job.target_id} ({job.message_ids})")
+
+    def _spill(self, jobs: List[DeliveryJob]) -> None:
+        # Под блокировкой: иначе дозапись между чтением и os.replace в _read_spill теряется
+        with self._spill_lock:
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                for job in jobs:
+                    f.write(json.dumps(job.to_dict(), separators=(",", ":")) + "\n")
+            self._spilled += len(jobs)
+
+    def _read_spill(self, limit: int) -> List[DeliveryJob]:
+        """Забирает с диска до limit заданий, остальные оставляет в файле"""
+        with self._spill_lock:
+            with open(self.spill_path, "r", encoding="utf-8") as f:
+                lines = [line for line in f if line.strip()]
+            taken, rest = lines[:limit], lines[limit:]
+            tmp_path = self.spill_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.writelines(rest)
+            os.replace(tmp_path, self.spill_path)
+            self._spilled = len(rest)
+        return [DeliveryJob.from_dict(json.loads(line)) for line in taken]
+
+    async def _unspill(self) -> None:
+        """Возвращает задания с диска в память, когда очередь освободилась"""
+        if self._unspilling or not self._spilled:
+            return
+        self._unspilling = True
+        try:
+            while self._spilled and self._size < self.max_backlog // 2:
+                jobs = await asyncio.to_thread(self._read_spill, self.max_backlog - self._size)
+                for job in jobs:
+                    self._push(job)
+        except Exception as e:
+            log(f"ОШИБКА чтения заданий доставки с диска: {e}")
+        finally:
+            self._unspilling = False
+
+    def _take(self, bucket: Deque[DeliveryJob]) -> DeliveryJob:
+        """Снимает задание с головы очереди ключа, приклеивая следующие одиночные посты"""
+        job = bucket.popleft()
+        self._size -= 1
+        self._count(job, -1)
+        if job.album or job.retry_id is not None or self.coalesce <= 1:
+            return job
+        ids = None
+        while bucket:
+            nxt = bucket[0]
+            if (nxt.album or nxt.retry_id is not None or nxt.lane != job.lane
+                    or len(ids or job.message_ids) + len(nxt.message_ids) > self.coalesce):
+                break
+            bucket.popleft()
+            self._size -= 1
+            self._count(nxt, -1)
+            if ids is None:
+                ids = list(job.message_ids)
+            ids.extend(nxt.message_ids)
+        if ids is None:
+            return job
+        merged = DeliveryJob(job.source_id, job.target_id, ids, from_peer=job.from_peer, lane=job.lane)
+        merged.enqueued_at = job.enqueued_at
+        return merged
+
+    async def _worker(self, lanes: Tuple[int, ...]) -> None:
+        while True:
+            key = self._next_key(lanes)
+            if key is None:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            bucket = self._queues.get(key)
+            if not bucket:
+                self._scheduled.discard(key)
+                self._queues.pop(key, None)
+                continue
+            job = self._take(bucket)
+            self._active[key] = job
+            async with self._space:
+                self._space.notify_all()
+            deferred = None
+            try:
+                await self.handler(job)
+            except asyncio.CancelledError:
+                # Прерванное остановкой задание возвращается в голову очереди — попадёт в журнал
+                bucket.appendleft(job)
+                self._size += 1
+                self._count(job, 1)
+                self._queues[key] = bucket
+                raise
+            except RescheduleJob as e:
+                deferred = e.delay
+            except Exception as e:
+                log(f"ОШИБКА обработки задания доставки {job.source_id} → {job.target_id}: {e}")
+            finally:
+                self._active.pop(key, None)
+                if deferred is not None:
+                    # Возвращаем задание в голову его очереди; ключ станет готов после паузы
+                    bucket.appendleft(job)
+                    self._size += 1
+                    self._count(job, 1)
+                    self._queues[key] = bucket
+                    if self.scheduler is not None:
+                        self.scheduler.call_later(deferred, ("delivery", key), self._mark_ready, key)
+                    else:
+                        asyncio.get_running_loop().call_later(deferred, self._mark_ready, key)
+                elif bucket:
+                    # Ключ уходит в конец очереди готовых своей полосы — справедливость между складами
+                    self._mark_ready(key)
+                else:
+                    self._scheduled.discard(key)
+                    if self._queues.get(key) is bucket:
+                        del self._queues[key]
+                if self._spilled and self._size < self.max_backlog // 2:
+                    asyncio.create_task(self._unspill())
+
+    def stats(self) -> Dict[str, Any]:
+        """Глубина очередей для мониторинга"""
+        deepest = sorted(
+            ((k, len(q)) for k, q in self._queues.items() if q),
+            key=lambda item: item[1],
+            reverse=True
+        )[:5]
+        return {
+            "queued": self._size,
+            "bulk": sum(self._bulk.values()),
+            "keys": len(self._queues),
+            "max_backlog": self.max_backlog,
+            "spilled": self._spilled,
+            "dropped": self._dropped,
+            "deepest": deepest,
+        }
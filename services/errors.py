@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Классификация ошибок пересылки по типам исключений Telethon
+"""
+import asyncio
+from typing import Dict, Tuple, Type
+from telethon import errors
+
+# Виды ошибок
+PERMISSION = "permission"  # у клиента нет прав публиковать в склад
+TARGET_GONE = "target_gone"  # склад удалён, закрыт или клиент из него удалён
+SOURCE_GONE = "source_gone"  # исходные сообщения удалены или недоступны — повтор бесполезен
+FLOOD = "flood"  # лимиты Telegram (FloodWait, slow mode)
+TRANSIENT = "transient"  # сеть, таймауты, ошибки сервера — стоит повторить
+CIRCUIT_OPEN = "circuit_open"  # склад отключён автоматом, запрос не отправлялся
+UNKNOWN = "unknown"
+
+# Ошибки, которые говорят о проблеме склада (и ведут к размыканию автомата)
+TARGET_KINDS = (PERMISSION, TARGET_GONE)
+# Ошибки, после которых повтор пересылки не имеет смысла
+NON_RETRYABLE = (SOURCE_GONE, CIRCUIT_OPEN)
+
+
+class CircuitOpenError(Exception):
+    """Склад временно отключён автоматом: отправка не выполнялась"""
+
+    def __init__(self, target: int, retry_in: float):
+        super().__init__(f"склад {target} отключён, проверка через {retry_in:.0f} сек")
+        self.target = target
+        self.retry_in = retry_in
+
+
+class SourceAccessError(Exception):
+    """Клиент потерял доступ к источнику: ошибка не про склад, склад не штрафуется"""
+
+    def __init__(self, source: int, error: BaseException):
+        super().__init__(f"нет доступа к источнику {source}: {type(error).__name__}: {error}")
+        self.source = source
+        self.error = error
+
+
+# Ошибки, которые ForwardMessagesRequest возвращает и для склада, и для источника (from_peer):
+# по одному коду нельзя понять, чей это канал, — доступ к источнику проверяется отдельно
+AMBIGUOUS_PEER_ERRORS: Tuple[Type[BaseException], ...] = (
+    errors.ChannelPrivateError,
+    errors.ChatForbiddenError,
+    errors.ChannelInvalidError,
+    errors.ChatIdInvalidError,
+    errors.PeerIdInvalidError,
+    errors.UserNotParticipantError,
+)
+
+
+# Таблица классификации: первый подходящий класс определяет вид ошибки
+ERROR_TABLE: Tuple[Tuple[Type[BaseException], str], ...] = (
+    (CircuitOpenError, CIRCUIT_OPEN),
+    (SourceAccessError, SOURCE_GONE),
+    (errors.FloodWaitError, FLOOD),
+    (errors.SlowModeWaitError, FLOOD),
+    (errors.ChatAdminRequiredError, PERMISSION),
+    (errors.ChatWriteForbiddenError, PERMISSION),
+    (errors.UserBannedInChannelError, PERMISSION),
+    (errors.ChatSendMediaForbiddenError, PERMISSION),
+    (errors.ChatSendGifsForbiddenError, PERMISSION),
+    (errors.ChatSendStickersForbiddenError, PERMISSION),
+    (errors.ChatSendPollForbiddenError, PERMISSION),
+    (errors.ChatSendInlineForbiddenError, PERMISSION),
+    (errors.ChatGuestSendForbiddenError, PERMISSION),
+    (errors.ChatRestrictedError, PERMISSION),
+    (errors.BroadcastForbiddenError, PERMISSION),
+    (errors.UserChannelsTooMuchError, PERMISSION),
+    (errors.UserNotParticipantError, PERMISSION),
+    (errors.ChannelPrivateError, TARGET_GONE),
+    (errors.ChatForbiddenError, TARGET_GONE),
+    (errors.ChannelInvalidError, TARGET_GONE),
+    (errors.ChatIdInvalidError, TARGET_GONE),
+    (errors.PeerIdInvalidError, TARGET_GONE),
+    (errors.MessageIdInvalidError, SOURCE_GONE),
+    (errors.MessageIdsEmptyError, SOURCE_GONE),
+    (errors.ServerError, TRANSIENT),
+    (errors.TimedOutError, TRANSIENT),
+    (errors.RpcCallFailError, TRANSIENT),
+    (ConnectionError, TRANSIENT),
+    (asyncio.TimeoutError, TRANSIENT),
+    # Прочие 403 — отказ в доступе, прочие 400 — ошибка запроса
+    (errors.ForbiddenError, PERMISSION),
+    (errors.BadRequestError, UNKNOWN),
+)
+
+_cache: Dict[type, str] = {}
+
+
+def classify(error: BaseException) -> str:
+    """Вид ошибки по таблице; результат для типа запоминается"""
+    kind = _cache.get(type(error))
+    if kind is None:
+        kind = next((k for cls, k in ERROR_TABLE if isinstance(error, cls)), UNKNOWN)
+        _cache[type(error)] = kind
+    return kind
+
+
+def is_permission_error(error: BaseException) -> bool:
+    """У клиента нет прав на склад (или склад для него недоступен)"""
+    return classify(error) in TARGET_KINDS
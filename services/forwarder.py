@@ -3,74 +3,496 @@
 Сервис пересылки сообщений с поддержкой альбомов
 """
 import asyncio
-from typing import Dict, List, Optional, Callable
-from collections import defaultdict
+import time
+from typing import Any, Dict, List, Optional, Callable, Set, Tuple
+from collections import OrderedDict, defaultdict
 from telethon import TelegramClient
-from telethon.tl.types import Message
-from telethon.errors import ChatAdminRequiredError, ChatWriteForbiddenError, UserChannelsTooMuchError
-from config import ALBUM_IDLE_SEC
+from telethon.helpers import generate_random_long
+from telethon.tl.functions.messages import ForwardMessagesRequest
+from telethon.tl.types import ChannelForbidden, ChatForbidden, Message
+from telethon.errors import FloodWaitError, SlowModeWaitError, ChannelInvalidError
+from config import (
+    ALBUM_IDLE_SEC, FORWARD_CONCURRENCY, FORWARD_CLIENT_CONCURRENCY,
+    DELIVERY_WORKERS, DELIVERY_MAX_BACKLOG, DELIVERY_OVERFLOW, DELIVERY_SPILL_PATH,
+    RATE_GLOBAL_PER_SEC, RATE_CLIENT_PER_SEC, RATE_TARGET_PER_MIN, RATE_TARGET_BURST,
+    DEDUP_WINDOW, DEDUP_MAX_ALBUMS,
+    ALBUM_IDLE_MIN_SEC, ALBUM_IDLE_MARGIN_SEC, ALBUM_LEARN_MIN_SAMPLES,
+    FORWARD_COALESCE_SEC, FORWARD_BATCH_MAX, USER_SESSION_NAMES, CLAIM_WINDOW,
+    BREAKER_THRESHOLD, BREAKER_BASE_SEC, BREAKER_MAX_SEC, DELIVERY_JOURNAL_PATH,
+    RATE_RESERVE_INTERACTIVE, RATE_RESERVE_LIVE, INTERACTIVE_HOLD_SEC, DELIVERY_LIVE_WORKERS,
+    FORWARD_BULK_CONCURRENCY
+)
 from utils.logger import log
 from utils.chat_names import chat_name_cache
+from services.delivery import DeliveryJob, DeliveryQueue, RescheduleJob
+from services.ratelimit import LANE_BULK, LANE_LIVE, RateLimiter
+from services.dedup import ClaimTable, DedupIndex, GroupLRU
+from services.albums import AlbumTimeouts, MAX_ALBUM_ITEMS
+from services.scheduler import Scheduler
+from services.capabilities import CapabilityMap
+from services.sessions import SessionPool
+from services.peers import PeerResolver
+from services.errors import (
+    AMBIGUOUS_PEER_ERRORS, CircuitOpenError, SourceAccessError, TARGET_KINDS, classify, is_permission_error
+)
+from services.breaker import BreakerBoard
 
 
-def is_permission_error(error: Exception) -> bool:
-    """Проверяет, является ли ошибка связанной с правами доступа"""
-    error_str = str(error).lower()
-    permission_keywords = [
-        "admin required",
-        "write forbidden",
-        "channels too much",
-        "chat_admin_required",
-        "chat_write_forbidden",
-        "user_channels_too_much",
-        "not enough rights",
-        "insufficient rights",
-        "no rights",
-        "private and you lack permission",
-        "lack permission",
-        "permission to access",
-        "banned from it",
-        "access denied",
-        "forbidden"
-    ]
-    return any(keyword in error_str for keyword in permission_keywords) or isinstance(
-        error, (ChatAdminRequiredError, ChatWriteForbiddenError, UserChannelsTooMuchError)
-    )
+# Компоненты состояния, которые сохраняются между перезапусками
+STATE_COMPONENTS = ("counters", "processed", "skipped_albums", "last_seen")
 
 
 class ForwarderService:
     """Сервис для пересылки сообщений с обработкой альбомов"""
 
     def __init__(self, client: TelegramClient, user_client: Optional[TelegramClient] = None,
-                 get_repost_step: Optional[Callable[[int], int]] = None):
+                 get_repost_step: Optional[Callable[[int], int]] = None, peers: Optional[PeerResolver] = None):
         self.client = client
-        self.user_client = user_client
+        # Готовые InputPeer источников и складов по клиентам (access hash из БД)
+        self.peers = peers or PeerResolver()
+        # Пул user-сессий для резервной пересылки; первая — основная
+        self.users = SessionPool()
+        if user_client is not None:
+            self.users.add(USER_SESSION_NAMES[0], user_client)
         self.get_repost_step = get_repost_step or (lambda tid: 1)
         self.album_buffer: Dict[str, List[Message]] = {}
-        self.album_tasks: Dict[str, asyncio.Task] = {}
-        self.failed_targets: Dict[int, bool] = {}
-        self.processed_messages: set = set()
+        # Один таймер на все ожидающие альбомы, повторы и отложенные задания
+        self.scheduler = Scheduler()
+        self._album_meta: Dict[str, Tuple[Any, List[int]]] = {}  # key → (from_peer, склады)
+        self._albums_by_source: Dict[int, Set[str]] = {}  # незакрытые альбомы источника
+        # Время последнего элемента альбома (LRU: активные альбомы не вытесняются)
+        self._album_last_item: "OrderedDict[str, float]" = OrderedDict()
+        self.album_timeouts = AlbumTimeouts(
+            ALBUM_IDLE_SEC, ALBUM_IDLE_MIN_SEC, ALBUM_IDLE_MARGIN_SEC, ALBUM_LEARN_MIN_SAMPLES
+        )
+        self.late_album_items = 0
+        # Одиночные посты, ждущие склейки: (источник, склад) → (from_peer, ID сообщений)
+        self._pending_singles: Dict[Tuple[int, int], Tuple[Any, List[int]]] = {}
+        # Какой клиент может публиковать в склад (загружается и сохраняется CapabilityService)
+        self.capabilities = CapabilityMap()
+        # Дедупликация: окно-битмап ID сообщений по источнику и LRU ключей альбомов
+        self.processed_messages = DedupIndex(DEDUP_WINDOW)
+        self.processed_albums = GroupLRU(DEDUP_MAX_ALBUMS)
         self.processing_albums: set = set()
-        self.source_counters: Dict[int, int] = {}  # счётчик постов по источникам
-        self.skipped_albums: set = set()  # альбомы, пропущенные по шагу
+        # Захват событий на входе: bot и user client получают одни и те же посты
+        self.claims = ClaimTable(CLAIM_WINDOW)
+        self.source_target_counters: Dict[Tuple[int, int], int] = {}  # счётчик постов по (источник, склад)
+        self.skipped_albums = GroupLRU(DEDUP_MAX_ALBUMS)  # альбомы, пропущенные по шагу
+        self._dirty: Set[str] = set()  # изменившиеся компоненты состояния (для чекпоинта)
+        # ID, до которого все посты источника доставлены (или записаны в повторы/журнал), —
+        # с него догоняются пропущенные посты
+        self.last_seen: Dict[int, int] = {}
+        self._arrived: Dict[int, int] = {}  # наибольший полученный ID по источнику
+        # Ещё не завершённые посты источника: ID → число заданий (буфер альбома, склейка, очередь)
+        self._unsettled: Dict[int, Dict[int, int]] = {}
+        # Первый ID пересланного альбома, пока альбом не доставлен: в чекпоинт он не попадает
+        self._album_first: Dict[Tuple[int, int], int] = {}
+        # Источники, которые сейчас догоняются: живые посты ждут здесь, чтобы не обогнать старые
+        self._held: Dict[int, List[Tuple[Message, List[int]]]] = {}
+        # Ограничения параллельной рассылки: общее и на каждый клиент
+        self._global_slots = asyncio.Semaphore(max(1, FORWARD_CONCURRENCY))
+        self._client_slots: Dict[str, asyncio.Semaphore] = {}  # ключ клиента → семафор
+        # Массовая пересылка занимает не больше FORWARD_BULK_CONCURRENCY общих слотов — остальные для живых постов
+        self._lane_slots = {
+            LANE_LIVE: asyncio.Semaphore(max(1, FORWARD_CONCURRENCY)),
+            LANE_BULK: asyncio.Semaphore(max(1, min(FORWARD_CONCURRENCY, FORWARD_BULK_CONCURRENCY))),
+        }
+        self.retry = None  # RetryService, подключается после создания
+        # Автоматы отключения складов, куда не может публиковать ни один клиент
+        self.breakers = BreakerBoard(self.scheduler, BREAKER_THRESHOLD, BREAKER_BASE_SEC, BREAKER_MAX_SEC)
+        # Темп отправки: глобально, на клиент и на склад (с учётом FloodWait и запаса важных полос)
+        self.limiter = RateLimiter(
+            RATE_GLOBAL_PER_SEC, RATE_CLIENT_PER_SEC, RATE_TARGET_PER_MIN, RATE_TARGET_BURST,
+            RATE_RESERVE_INTERACTIVE, RATE_RESERVE_LIVE, INTERACTIVE_HOLD_SEC
+        )
+        # Доставка идёт через очереди по (источник, склад), обработчик событий не ждёт отправки
+        self.queue = DeliveryQueue(
+            self._deliver_job,
+            workers=DELIVERY_WORKERS,
+            max_backlog=DELIVERY_MAX_BACKLOG,
+            overflow=DELIVERY_OVERFLOW,
+            spill_path=DELIVERY_SPILL_PATH or None,
+            scheduler=self.scheduler,
+            coalesce=FORWARD_BATCH_MAX,
+            journal_path=DELIVERY_JOURNAL_PATH or None,
+            live_workers=DELIVERY_LIVE_WORKERS,
+        )
+        self.accepting = True  # False — приём новых постов остановлен (завершение работы)
 
-    def set_user_client(self, user_client: Optional[TelegramClient]):
-        """Обновляет user client (для переподключения)"""
-        self.user_client = user_client
+    def start(self) -> None:
+        """Запускает планировщик и воркеры доставки"""
+        self.scheduler.start()
+        self.queue.start()
+
+    async def drain(self, timeout: float) -> bool:
+        """
+        Завершение работы: прекращает приём постов, сразу отправляет в очередь
+        ждущие альбомы и склеиваемые посты и ждёт доставки не дольше timeout.
+        Недоставленное сохранит в журнал stop().
+        """
+        self.accepting = False
+        for key in list(self._album_meta):
+            if key in self.processing_albums:
+                continue
+            self.scheduler.cancel(("album", key))
+            from_peer, targets = self._album_meta[key]
+            await self.flush_album(key, from_peer, targets)
+        for key in list(self._pending_singles):
+            await self._flush_singles(key)
+        return await self.queue.join(timeout)
+
+    async def stop(self) -> None:
+        """Останавливает воркеры доставки и планировщик"""
+        # Записанные в журнал задания будут доставлены после запуска — last_seen может их обогнать
+        for job in await self.queue.stop():
+            self._settle(job.source_id, job.message_ids)
+        await self.scheduler.stop()
+
+    @property
+    def user_client(self) -> Optional[TelegramClient]:
+        """Клиент основной user-сессии"""
+        primary = self.users.primary
+        return primary.client if primary else None
+
+    def set_user_client(self, user_client: Optional[TelegramClient], name: Optional[str] = None):
+        """Обновляет клиент user-сессии (для переподключения); по умолчанию — основной"""
+        if name is None:
+            primary = self.users.primary
+            name = primary.name if primary else USER_SESSION_NAMES[0]
+        if user_client is None:
+            self.users.mark_down(name)
+        else:
+            self.users.add(name, user_client)
+
+    @property
+    def state_dirty(self) -> bool:
+        return bool(self._dirty)
+
+    def mark_dirty(self, names) -> None:
+        """Возвращает компоненты в число изменившихся (сохранение снимка не удалось)"""
+        self._dirty.update(name for name in names if name in STATE_COMPONENTS)
+
+    def export_state(self, only_dirty: bool = True) -> Dict[str, Any]:
+        """Снимок (изменившихся) компонентов состояния для сохранения в БД.
+        Компоненты снимка больше не считаются изменившимися; если сохранить его
+        не удалось, вызывающий возвращает их через mark_dirty.
+        """
+        names = self._dirty if only_dirty else STATE_COMPONENTS
+        self._dirty = set()
+        state: Dict[str, Any] = {}
+        if "counters" in names:
+            state["counters"] = [[s, t, c] for (s, t), c in self.source_target_counters.items()]
+        if "processed" in names:
+            # Отметки недоставленных постов не сохраняются: после сбоя их перешлёт догоняние
+            for album_key, first in list(self._album_first.items()):
+                if first <= self.last_seen.get(album_key[0], 0):
+                    del self._album_first[album_key]
+            state["processed"] = {
+                "messages": self.processed_messages.export(self.last_seen),
+                "albums": [key for key in self.processed_albums.export() if tuple(key) not in self._album_first],
+            }
+        if "skipped_albums" in names:
+            state["skipped_albums"] = self.skipped_albums.export()
+        if "last_seen" in names:
+            state["last_seen"] = [[s, m] for s, m in self.last_seen.items()]
+        return state
+
+    def restore_state(self, state: Dict[str, Any]) -> None:
+        """Восстанавливает состояние, сохранённое export_state"""
+        for s, t, c in state.get("counters", []):
+            self.source_target_counters[(s, t)] = c
+        processed = state.get("processed")
+        # Старый формат (список пар без разделения сообщений и альбомов) не восстанавливаем
+        if isinstance(processed, dict):
+            self.processed_messages.restore(processed.get("messages", {}))
+            self.processed_albums.restore(processed.get("albums", []))
+        self.skipped_albums.restore(state.get("skipped_albums", []))
+        for s, m in state.get("last_seen", []):
+            self.last_seen[s] = m
+
+    async def _send(self, role: str, client: TelegramClient, target: int, messages, from_peer,
+                    lane: int = LANE_LIVE) -> None:
+        """
+        Один ForwardMessagesRequest под лимитами параллельности и частоты.
+        FloodWait не «проглатывается» Telethon (flood_sleep_threshold=0): клиент или склад
+        паркуется на время, указанное сервером, а задание откладывается через RescheduleJob.
+        """
+        parked = self.limiter.parked_for(role, target)
+        if parked > 0:
+            raise RescheduleJob(parked)
+        await self.limiter.acquire(role, target, lane)
+        ids = messages if isinstance(messages, list) else [messages]
+        slots = self._client_slots.get(role)
+        if slots is None:
+            slots = self._client_slots[role] = asyncio.Semaphore(max(1, FORWARD_CLIENT_CONCURRENCY))
+        async with self._lane_slots[lane], self._global_slots, slots:
+            try:
+                try:
+                    for attempt in range(2):
+                        # InputPeer берутся из заранее разрешённого кэша, без запросов к сети
+                        to_peer = await self.peers.lookup(role, client, target)
+                        peer = await self.peers.lookup(role, client, from_peer)
+                        try:
+                            await client(ForwardMessagesRequest(
+                                from_peer=peer,
+                                id=ids,
+                                to_peer=to_peer,
+                                random_id=[generate_random_long() for _ in ids]
+                            ), flood_sleep_threshold=0)
+                            return
+                        except ChannelInvalidError:
+                            # Устаревший access hash — разрешаем заново по сети (не из кэша сессии) один раз
+                            await self.peers.refresh(role, client, [target, from_peer])
+                            if attempt:
+                                raise
+                except AMBIGUOUS_PEER_ERRORS as e:
+                    # FloodWait самой проверки источника попадает в обработчики ниже
+                    await self._check_source(role, client, from_peer, e)
+                    raise
+            except SlowModeWaitError as e:
+                self.limiter.park_target(target, e.seconds)
+                log(f"FloodWait: склад {target} в slow mode, пауза {e.seconds} сек")
+                raise RescheduleJob(e.seconds)
+            except FloodWaitError as e:
+                self.limiter.park_client(role, e.seconds)
+                log(f"FloodWait: клиент {role} на паузе {e.seconds} сек")
+                raise RescheduleJob(e.seconds)
+
+    async def _check_source(self, role: str, client: TelegramClient, from_peer, error: Exception) -> None:
+        """
+        Ошибка вида ChannelPrivate/PeerIdInvalid может относиться и к источнику: проверяем
+        доступ клиента к from_peer отдельным запросом. Нет доступа — SourceAccessError;
+        проверить не удалось — ошибка проверки (временная или неизвестная, не про склад);
+        источник доступен — ошибка действительно про склад, вызывающий пробрасывает её.
+        """
+        source = self.peers.peer_id(from_peer)
+        try:
+            entity = await client.get_entity(await self.peers.lookup(role, client, from_peer))
+        except AMBIGUOUS_PEER_ERRORS:
+            raise SourceAccessError(source, error) from error
+        except Exception as e:
+            log(f"Клиент {role}: не удалось проверить доступ к источнику {source}: {e}")
+            raise e from error
+        # Покинутый закрытый канал или чат: переслать из него нельзя
+        if isinstance(entity, (ChannelForbidden, ChatForbidden)) or (
+            getattr(entity, "left", False) and not getattr(entity, "username", None)
+        ):
+            raise SourceAccessError(source, error) from error
+
+    async def _send_user(self, target: int, messages, from_peer, lane: int = LANE_LIVE) -> None:
+        """
+        Отправка через наименее загруженную user-сессию, которой склад доступен.
+        При ошибке прав, недоступном источнике или паузе FloodWait пробуется следующая сессия.
+        """
+        tried: Set[str] = set()
+        denied: Optional[Exception] = None
+        lost: Optional[SourceAccessError] = None
+        wait: Optional[float] = None
+        while True:
+            session = self.users.pick(target, tried, lambda key: self.limiter.parked_for(key, target))
+            if session is None:
+                break
+            tried.add(session.name)
+            started = time.monotonic()
+            session.inflight += 1
+            try:
+                await self._send(session.key, session.client, target, messages, from_peer, lane)
+            except RescheduleJob as e:
+                wait = e.delay if wait is None else min(wait, e.delay)
+                continue
+            except SourceAccessError as e:
+                # Источник недоступен этой сессии — склад ни при чём, пробуем следующую
+                lost = e
+                continue
+            except Exception as e:
+                if is_permission_error(e):
+                    self.users.deny(session, target)
+                    denied = e
+                    continue
+                session.failures += 1
+                raise
+            finally:
+                session.inflight -= 1
+            session.observe(time.monotonic() - started)
+            return
+        if wait is not None:
+            raise RescheduleJob(wait)
+        if denied is not None:
+            raise denied
+        if lost is not None:
+            raise lost
+        raise ConnectionError("нет подключённых user-сессий")
+
+    async def _deliver(self, target: int, messages, from_peer, from_name: str,
+                       album: bool = False, lane: int = LANE_LIVE) -> Optional[Exception]:
+        """
+        Пересылает сообщение/альбом в один склад. Клиент выбирается по карте возможностей:
+        заведомо неподходящий клиент не пробуется. Возвращает ошибку или None.
+        """
+        # Получаем название цели для логов
+        target_name = await chat_name_cache.get_name(target)
+        batch = isinstance(messages, list) and not album
+        what = "Альбом переслан" if album else ("Сообщения пересланы" if batch else "Сообщение переслано")
+        details = f" ({len(messages)} элементов)" if album or batch else ""
+        error_prefix = "ОШИБКА пересылки альбома" if album else "ОШИБКА пересылки"
+        
+        # Склад отключён автоматом — ни одного запроса к API до проверки
+        blocked = self.breakers.blocked_for(target)
+        if blocked:
+            return CircuitOpenError(target, blocked)
+        
+        roles = self.capabilities.route(target, len(self.users) > 0)
+        error: Optional[Exception] = None
+        for attempt, role in enumerate(roles):
+            try:
+                if role == "user":
+                    await self._send_user(target, messages, from_peer, lane)
+                else:
+                    await self._send(role, self.client, target, messages, from_peer, lane)
+            except RescheduleJob:
+                self.breakers.inconclusive(target)
+                raise
+            except Exception as e:
+                error = e
+                # Источник недоступен этому клиенту — склад не штрафуем, пробуем следующего
+                if isinstance(e, SourceAccessError):
+                    continue
+                # Ошибка прав — запоминаем и пробуем следующего клиента; остальные ошибки не про права
+                if is_permission_error(e):
+                    self.capabilities.record(target, role, False, f"{type(e).__name__}: {e}")
+                    continue
+                break
+            self.capabilities.record(target, role, True)
+            self.breakers.success(target)
+            suffix = " (резервный вариант)" if attempt else ""
+            log(f"✓ {what} из {from_name} в {target_name}{details}{suffix}")
+            return None
+        log(f"{error_prefix} из {from_name} в {target_name}: {error}")
+        if classify(error) in TARGET_KINDS:
+            self.breakers.failure(target, f"{type(error).__name__}: {error}")
+        else:
+            self.breakers.inconclusive(target)
+        return error
+
+    def _hold(self, source_id: int, ids: List[int]) -> None:
+        """Посты ids ждут доставки — last_seen их не обгонит"""
+        pending = self._unsettled.setdefault(source_id, {})
+        for msg_id in ids:
+            pending[msg_id] = pending.get(msg_id, 0) + 1
+
+    def _settle(self, source_id: int, ids: List[int]) -> None:
+        """Задание по ids завершено (доставлено, записано в повторы или в журнал) — двигает last_seen"""
+        pending = self._unsettled.get(source_id)
+        if pending is not None:
+            for msg_id in ids:
+                count = pending.get(msg_id)
+                if count is None:
+                    continue
+                if count > 1:
+                    pending[msg_id] = count - 1
+                else:
+                    del pending[msg_id]
+            if not pending:
+                del self._unsettled[source_id]
+        mark = min(pending) - 1 if pending else self._arrived.get(source_id, 0)
+        if mark > self.last_seen.get(source_id, 0):
+            self.last_seen[source_id] = mark
+            self._dirty.add("last_seen")
+
+    async def _deliver_job(self, job: DeliveryJob) -> None:
+        """Обработчик задания из очереди доставки"""
+        from_name = await chat_name_cache.get_name(job.source_id)
+        if job.album or len(job.message_ids) > 1:
+            messages = job.message_ids
+        else:
+            messages = job.message_ids[0]
+        from_peer = job.from_peer if job.from_peer is not None else job.source_id
+        error = await self._deliver(job.target_id, messages, from_peer, from_name, album=job.album, lane=job.lane)
+        if self.retry is not None:
+            if error is None:
+                await self.retry.complete(job)
+            else:
+                await self.retry.schedule(job, error)
+        # Повторы из retry_queue учтены при первой попытке
+        if job.retry_id is None:
+            self._settle(job.source_id, job.message_ids)
+
+    async def deliver_now(self, job: DeliveryJob) -> Optional[Exception]:
+        """
+        Доставка в обход очередей и повторов (бэкфилл): лимиты частоты, карта возможностей
+        и автоматы действуют как обычно, ошибку обрабатывает вызывающий. FloodWait — RescheduleJob.
+        """
+        from_name = await chat_name_cache.get_name(job.source_id)
+        messages = job.message_ids if job.album or len(job.message_ids) > 1 else job.message_ids[0]
+        from_peer = job.from_peer if job.from_peer is not None else job.source_id
+        return await self._deliver(job.target_id, messages, from_peer, from_name, album=job.album, lane=job.lane)
+
+    def set_retry_service(self, retry) -> None:
+        """Подключает сервис повторов (неудачные задания уходят в retry_queue)"""
+        self.retry = retry
+
+    def _source_lane(self, source_id: int) -> int:
+        """Посты догоняемого источника — массовая пересылка, остальные — живые"""
+        return LANE_BULK if source_id in self._held else LANE_LIVE
+
+    async def _queue_single(self, source_id: int, target: int, msg_id: int, from_peer) -> None:
+        """
+        Одиночный пост в свободный склад уходит сразу. Пока у пары (источник, склад) идёт
+        отправка, посты копятся FORWARD_COALESCE_SEC (окно от первого поста) и уходят одним
+        forward_messages — до FORWARD_BATCH_MAX ID
+        """
+        self._hold(source_id, [msg_id])
+        key = (source_id, target)
+        pending = self._pending_singles.get(key)
+        if FORWARD_COALESCE_SEC <= 0 or (pending is None and not self.queue.busy(key)):
+            await self.queue.put(DeliveryJob(source_id, target, [msg_id], from_peer=from_peer,
+                                             lane=self._source_lane(source_id)))
+            return
+        if pending is None:
+            pending = self._pending_singles[key] = (from_peer, [])
+            self.scheduler.call_later(FORWARD_COALESCE_SEC, ("singles", key), self._flush_singles, key)
+        pending[1].append(msg_id)
+        if len(pending[1]) >= FORWARD_BATCH_MAX:
+            await self._flush_singles(key)
+
+    async def _flush_singles(self, key: Tuple[int, int]) -> None:
+        """Ставит накопленные одиночные посты в очередь доставки одним заданием"""
+        self.scheduler.cancel(("singles", key))
+        pending = self._pending_singles.pop(key, None)
+        if pending:
+            from_peer, ids = pending
+            await self.queue.put(DeliveryJob(key[0], key[1], ids, from_peer=from_peer, lane=self._source_lane(key[0])))
+
+    def _schedule_album_flush(self, key: str, delay: float) -> None:
+        """(Пере)планирует отправку альбома через delay секунд — дедлайн переносится на месте"""
+        from_peer, targets = self._album_meta[key]
+        self.scheduler.call_later(delay, ("album", key), self.flush_album, key, from_peer, targets)
+
+    async def _flush_source_albums(self, source_id: int, except_key: Optional[str] = None) -> None:
+        """
+        Новое сообщение источника доказывает, что его предыдущие альбомы завершены:
+        отправляем их сразу и до этого сообщения, чтобы сохранить порядок в складе
+        """
+        for key in list(self._albums_by_source.get(source_id, ())):
+            if key == except_key or key in self.processing_albums or key not in self._album_meta:
+                continue
+            self.scheduler.cancel(("album", key))
+            from_peer, targets = self._album_meta[key]
+            await self.flush_album(key, from_peer, targets)
 
     async def flush_album(self, key: str, from_peer, targets: List[int]):
-        """Пересылает накопленные сообщения альбома после задержки"""
+        """Пересылает накопленные сообщения альбома (вызывается планировщиком по дедлайну)"""
+        finished = False
         try:
-            await asyncio.sleep(ALBUM_IDLE_SEC)
-            
             # Проверяем, не обрабатывается ли уже этот альбом
             if key in self.processing_albums:
                 return  # Альбом уже обрабатывается другой задачей
+            finished = True
             
             msgs = sorted(self.album_buffer.get(key, []), key=lambda m: m.id)
             if not msgs:
                 return
-            message_ids = [m.id for m in msgs]
+            message_ids = list(dict.fromkeys(m.id for m in msgs))
             
             # Помечаем альбом как обрабатываемый (защита от одновременного выполнения)
             self.processing_albums.add(key)
@@ -82,73 +504,72 @@ class ForwarderService:
             elif msgs:
                 source_id = getattr(msgs[0], 'chat_id', None)
             
-            # Получаем название источника для логов
-            from_name = await chat_name_cache.get_name(source_id) if source_id else "Неизвестно"
-            
             # Проверяем дедупликацию: если альбом уже переслан другим клиентом, пропускаем
             album_key = None
             if source_id and msgs:
                 album_key = (source_id, msgs[0].grouped_id)
-                if album_key in self.processed_messages:
+                if album_key in self.processed_albums:
                     return  # Альбом уже переслан, пропускаем
             
-            success_count = 0
-            for target in targets:
-                # Получаем название цели для логов
-                target_name = await chat_name_cache.get_name(target)
-                
-                use_user_client = False
-                try:
-                    # Проверяем, нужен ли user bot для этого target
-                    use_user_client = self.failed_targets.get(target, False) and self.user_client
-                    
-                    client_to_use = self.user_client if use_user_client else self.client
-                    
-                    await client_to_use.forward_messages(
-                        entity=target,
-                        messages=message_ids,
-                        from_peer=from_peer
-                    )
-                    log(f"✓ Альбом переслан из {from_name} в {target_name} ({len(message_ids)} элементов)")
-                    success_count += 1
-                    # Если успешно через user bot, сбрасываем флаг
-                    if use_user_client:
-                        self.failed_targets[target] = False
-                except Exception as e:
-                    # Если ошибка прав и есть user client, пробуем через него
-                    if is_permission_error(e) and self.user_client and not use_user_client:
-                        try:
-                            await self.user_client.forward_messages(
-                                entity=target,
-                                messages=message_ids,
-                                from_peer=from_peer
-                            )
-                            log(f"✓ Альбом переслан из {from_name} в {target_name} ({len(message_ids)} элементов, резервный вариант)")
-                            success_count += 1
-                            self.failed_targets[target] = True
-                        except Exception as e2:
-                            log(f"ОШИБКА пересылки альбома из {from_name} в {target_name}: {e2}")
-                    else:
-                        log(f"ОШИБКА пересылки альбома из {from_name} в {target_name}: {e}")
+            # Помечаем до постановки в очередь: поздние элементы этого альбома не создадут новый
+            if album_key:
+                self.processed_albums.add(album_key)
+                self._album_first[album_key] = message_ids[0]
+                self._dirty.add("processed")
             
-            # Помечаем альбом как обработанный только если хотя бы одна пересылка успешна
-            if success_count > 0 and album_key:
-                self.processed_messages.add(album_key)
+            # Ставим альбом в очереди доставки складов (после ждущих склейки постов — порядок)
+            for target in targets:
+                if (source_id, target) in self._pending_singles:
+                    await self._flush_singles((source_id, target))
+                self._hold(source_id, message_ids)
+                await self.queue.put(DeliveryJob(source_id, target, message_ids, album=True, from_peer=from_peer,
+                                                 lane=self._source_lane(source_id)))
         except asyncio.CancelledError:
             return
         finally:
-            self.album_buffer.pop(key, None)
-            self.processing_albums.discard(key)
-            task = self.album_tasks.pop(key, None)
-            if task and not task.cancelled():
-                try:
-                    task.cancel()
-                except Exception:
-                    pass
+            # Прерванная отправка и дубликат не трогают состояние альбома
+            if finished:
+                buffered = self.album_buffer.pop(key, None)
+                self.processing_albums.discard(key)
+                self._album_meta.pop(key, None)
+                source_key = int(key.split('_')[0]) if '_' in key else None
+                if buffered and source_key is not None:
+                    self._settle(source_key, [m.id for m in buffered])
+                pending = self._albums_by_source.get(source_key)
+                if pending is not None:
+                    pending.discard(key)
+                    if not pending:
+                        self._albums_by_source.pop(source_key, None)
 
-    async def forward_message(self, message: Message, targets: List[int]):
-        """Пересылает сообщение в указанные чаты"""
-        if not targets:
+    def hold_source(self, source_id: int) -> None:
+        """Начало догоняния источника: живые посты откладываются до release_source"""
+        self._held.setdefault(source_id, [])
+
+    async def release_source(self, source_id: int) -> None:
+        """
+        Конец догоняния: догнанные альбомы завершены и уходят сразу, затем по порядку
+        обрабатываются отложенные живые посты (уже догнанные отсеет дедупликация)
+        """
+        await self._flush_source_albums(source_id)
+        held = self._held.get(source_id, [])
+        try:
+            while held:
+                message, targets = held.pop(0)
+                await self.forward_message(message, targets, replay=True)
+        finally:
+            self._held.pop(source_id, None)
+        # Альбомы из отложенных живых постов могут быть ещё не полными — ждут как обычно
+        for key in list(self._albums_by_source.get(source_id, ())):
+            if key in self._album_meta and key not in self.processing_albums:
+                self._schedule_album_flush(key, self.album_timeouts.timeout(source_id))
+
+    async def forward_message(self, message: Message, targets: List[int], replay: bool = False):
+        """
+        Пересылает сообщение в указанные чаты.
+        replay=True — сообщение из истории (догоняние): не откладывается и не
+        запускает таймер альбома, альбом закроет следующее сообщение источника.
+        """
+        if not targets or not self.accepting:
             return
 
         # Получаем ID чата-источника
@@ -168,13 +589,34 @@ class ForwarderService:
             log(f"ОШИБКА: Не удалось извлечь chat_id из сообщения {message.id}")
             return
 
+        held = self._held.get(chat_id)
+        if held is not None and not replay:
+            held.append((message, targets))
+            return
+        if message.id > self._arrived.get(chat_id, 0):
+            self._arrived[chat_id] = message.id
+        self._hold(chat_id, [message.id])
+        try:
+            await self._route_message(message, chat_id, targets, replay)
+        finally:
+            self._settle(chat_id, [message.id])
+
+    async def _route_message(self, message: Message, chat_id: int, targets: List[int], replay: bool) -> None:
+        """Альбом — в буфер, одиночный пост — в склейку; дедупликация и шаг репоста по складам"""
         # Обработка альбомов
         if message.grouped_id:
             key = f"{chat_id}_{message.grouped_id}"
+            now = time.monotonic()
             
             # Проверяем дедупликацию: если альбом уже полностью переслан, пропускаем
             album_key = (chat_id, message.grouped_id)
-            if album_key in self.processed_messages:
+            if album_key in self.processed_albums:
+                # Элемент опоздал к уже отправленному альбому — учитываем, чтобы таймаут подрос
+                last = self._album_last_item.get(key)
+                if last is not None and not replay:
+                    self._album_last_item.move_to_end(key)
+                    self.album_timeouts.observe(chat_id, now - last)
+                    self.late_album_items += 1
                 return
             if album_key in self.skipped_albums:
                 return
@@ -183,7 +625,9 @@ class ForwarderService:
             if key in self.processing_albums:
                 # Альбом обрабатывается, просто добавляем сообщение в буфер
                 bucket = self.album_buffer.setdefault(key, [])
-                bucket.append(message)
+                if all(m.id != message.id for m in bucket):
+                    bucket.append(message)
+                    self._hold(chat_id, [message.id])
                 return
             
             # Первое сообщение альбома — проверяем шаг для каждого склада
@@ -196,36 +640,50 @@ class ForwarderService:
                     step = self.get_repost_step(tgt)
                     if step <= 1 or counter % step == 0:
                         targets_to_forward.append(tgt)
+                self._dirty.add("counters")
                 if not targets_to_forward:
                     self.skipped_albums.add(album_key)
-                    if len(self.skipped_albums) > 5000:
-                        self.skipped_albums = set(list(self.skipped_albums)[2500:])
+                    self._dirty.add("skipped_albums")
+                    return
+                # Склады фиксируются по первому сообщению и используются для всего альбома
+                self._album_meta[key] = (message.peer_id, targets_to_forward)
+                self._albums_by_source.setdefault(chat_id, set()).add(key)
+                self.album_buffer[key] = []
+                # Начался новый альбом — предыдущие альбомы источника уже завершены
+                await self._flush_source_albums(chat_id, except_key=key)
+            else:
+                # Тот же элемент от второго клиента (bot и user в режиме auto) — не считаем
+                # его ни в размер альбома, ни в интервалы между элементами
+                if any(m.id == message.id for m in self.album_buffer[key]):
                     return
-                targets = targets_to_forward
+                last = self._album_last_item.get(key)
+                if last is not None and not replay:
+                    self.album_timeouts.observe(chat_id, now - last)
+            self._album_last_item[key] = now
+            self._album_last_item.move_to_end(key)
+            if len(self._album_last_item) > DEDUP_MAX_ALBUMS:
+                self._album_last_item.popitem(last=False)
 
             # Добавляем сообщение в буфер альбома
             bucket = self.album_buffer.setdefault(key, [])
             bucket.append(message)
+            self._hold(chat_id, [message.id])
             
-            # Отменяем предыдущую задачу для этого альбома
-            task = self.album_tasks.get(key)
-            if task:
-                try:
-                    task.cancel()
-                except Exception:
-                    pass
-            
-            # Создаем новую задачу с задержкой (targets уже отфильтрованы при первом сообщении)
-            self.album_tasks[key] = asyncio.create_task(
-                self.flush_album(key, message.peer_id, targets)
-            )
+            # Полный альбом отправляем сразу, иначе ждём выученный для источника таймаут
+            if len(bucket) >= MAX_ALBUM_ITEMS:
+                self._schedule_album_flush(key, 0)
+            elif not replay:
+                self._schedule_album_flush(key, self.album_timeouts.timeout(chat_id))
             return
         
+        # Одиночное сообщение источника завершает его незакрытые альбомы
+        if chat_id in self._albums_by_source:
+            await self._flush_source_albums(chat_id)
+        
         # Дедупликация — сразу помечаем, чтобы не считать дважды (bot+user клиенты)
-        message_key = (chat_id, message.id)
-        if message_key in self.processed_messages:
+        if not self.processed_messages.check_and_add(chat_id, message.id):
             return
-        self.processed_messages.add(message_key)
+        self._dirty.add("processed")
 
         # Проверка шага репоста — фильтруем склады
         targets_to_forward = []
@@ -236,51 +694,11 @@ class ForwarderService:
             step = self.get_repost_step(tgt)
             if step <= 1 or counter % step == 0:
                 targets_to_forward.append(tgt)
+        self._dirty.add("counters")
         targets = targets_to_forward
         if not targets:
             return
         
-        # Ограничиваем размер кэша (храним последние 10000 записей)
-        if len(self.processed_messages) > 10000:
-            # Удаляем старые записи (просто очищаем половину)
-            self.processed_messages = set(list(self.processed_messages)[5000:])
-
-        # Получаем название источника для логов
-        from_name = await chat_name_cache.get_name(chat_id)
-        
-        # Обычное сообщение - пересылаем сразу
+        # Обычное сообщение - копим для склейки и ставим в очереди доставки складов
         for target in targets:
-            # Получаем название цели для логов
-            target_name = await chat_name_cache.get_name(target)
-            
-            use_user_client = False
-            try:
-                # Проверяем, нужен ли user bot для этого target
-                use_user_client = self.failed_targets.get(target, False) and self.user_client
-                
-                client_to_use = self.user_client if use_user_client else self.client
-                
-                await client_to_use.forward_messages(
-                    entity=target,
-                    messages=message.id,
-                    from_peer=message.peer_id
-                )
-                log(f"✓ Сообщение переслано из {from_name} в {target_name}")
-                # Если успешно через user bot, сбрасываем флаг
-                if use_user_client:
-                    self.failed_targets[target] = False
-            except Exception as e:
-                # Если ошибка прав и есть user client, пробуем через него
-                if is_permission_error(e) and self.user_client and not use_user_client:
-                    try:
-                        await self.user_client.forward_messages(
-                            entity=target,
-                            messages=message.id,
-                            from_peer=message.peer_id
-                        )
-                        log(f"✓ Сообщение переслано из {from_name} в {target_name} (резервный вариант)")
-                        self.failed_targets[target] = True
-                    except Exception as e2:
-                        log(f"ОШИБКА пересылки из {from_name} в {target_name}: {e2}")
-                else:
-                    log(f"ОШИБКА пересылки из {from_name} в {target_name}: {e}")
+            await self._queue_single(chat_id, target, message.id, message.peer_id)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Заранее разрешённые InputPeer источников и складов для каждого клиента (access hash хранится в БД)
+"""
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+from telethon import TelegramClient, utils
+from telethon.errors import RPCError
+from telethon.tl.functions.channels import GetChannelsRequest
+from telethon.tl.types import InputChannel, InputPeerChannel, InputPeerChat, PeerChannel, PeerChat
+from database import AsyncDatabase
+from utils.logger import log
+
+# channels.getChannels принимает до 100 каналов за запрос
+RESOLVE_BATCH = 100
+
+
+class PeerResolver:
+    """
+    Access hash канала свой у каждого аккаунта, поэтому кэш ведётся по ключу клиента
+    ("bot", "user:<сессия>"). При запуске все источники и склады разрешаются пачками
+    и сохраняются в БД; пересылка берёт готовый InputPeer из памяти. При
+    ChannelInvalid запись сбрасывается и разрешается заново.
+    """
+
+    def __init__(self, db: Optional[AsyncDatabase] = None):
+        self.db = db
+        self._peers: Dict[Tuple[str, int], InputPeerChannel] = {}
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._peers)
+
+    @staticmethod
+    def peer_id(peer: Union[int, object]) -> int:
+        """ID с -100 для числа или Peer-объекта"""
+        return peer if isinstance(peer, int) else utils.get_peer_id(peer)
+
+    async def load(self) -> None:
+        if self.db is None:
+            return
+        try:
+            for client_key, peer_id, access_hash in await self.db.load_peers():
+                real_id, _ = utils.resolve_id(peer_id)
+                self._peers[(client_key, peer_id)] = InputPeerChannel(real_id, access_hash)
+        except Exception as e:
+            log(f"Предупреждение: Не удалось загрузить access hash каналов: {e}")
+
+    def get(self, client_key: str, peer: Union[int, object]):
+        """Готовый InputPeer без обращения к сети, None — если неизвестен"""
+        peer_id = self.peer_id(peer)
+        real_id, kind = utils.resolve_id(peer_id)
+        if kind is PeerChat:
+            return InputPeerChat(real_id)
+        return self._peers.get((client_key, peer_id))
+
+    async def lookup(self, client_key: str, client: TelegramClient, peer: Union[int, object]):
+        """InputPeer из кэша, а при промахе — через Telethon (с запоминанием)"""
+        cached = self.get(client_key, peer)
+        if cached is not None:
+            return cached
+        self.misses += 1
+        peer_id = self.peer_id(peer)
+        input_peer = await client.get_input_entity(peer_id)
+        await self._remember(client_key, [input_peer])
+        return input_peer
+
+    async def invalidate(self, client_key: str, peers: Iterable[Union[int, object]]) -> None:
+        peer_ids = [self.peer_id(p) for p in peers]
+        for peer_id in peer_ids:
+            self._peers.pop((client_key, peer_id), None)
+        if self.db is None:
+            return
+        try:
+            await self.db.delete_peers(client_key, peer_ids)
+        except Exception as e:
+            log(f"ОШИБКА удаления access hash каналов: {e}")
+
+    async def _remember(self, client_key: str, input_peers: List[object]) -> None:
+        rows = []
+        for input_peer in input_peers:
+            if isinstance(input_peer, InputPeerChannel):
+                peer_id = utils.get_peer_id(PeerChannel(input_peer.channel_id))
+                self._peers[(client_key, peer_id)] = input_peer
+                rows.append((client_key, peer_id, input_peer.access_hash))
+        if rows and self.db is not None:
+            try:
+                await self.db.save_peers(rows)
+            except Exception as e:
+                log(f"ОШИБКА сохранения access hash каналов: {e}")
+
+    async def _fetch(self, client: TelegramClient, missing: Set[int]) -> List[object]:
+        """
+        Разрешает каналы по сети, минуя кэш сессии: боту — channels.getChannels по 100
+        (хватает access_hash=0), аккаунту — один проход по диалогам. Найденные ID
+        удаляются из missing; Telethon заодно обновляет кэш сессии по ответам.
+        """
+        found: List[object] = []
+        if await client.is_bot():
+            ordered = sorted(missing)
+            for i in range(0, len(ordered), RESOLVE_BATCH):
+                batch = ordered[i:i + RESOLVE_BATCH]
+                try:
+                    result = await client(GetChannelsRequest(
+                        [InputChannel(utils.resolve_id(p)[0], 0) for p in batch]
+                    ))
+                except RPCError as e:
+                    log(f"Не удалось разрешить каналы пачкой ({len(batch)}): {e}")
+                    continue
+                for chat in result.chats:
+                    found.append(utils.get_input_peer(chat))
+                    missing.discard(utils.get_peer_id(chat))
+        else:
+            async for dialog in client.iter_dialogs():
+                peer_id = dialog.id
+                if peer_id in missing:
+                    found.append(utils.get_input_peer(dialog.entity))
+                    missing.discard(peer_id)
+                    if not missing:
+                        break
+        return found
+
+    async def refresh(self, client_key: str, client: TelegramClient, peers: Iterable[Union[int, object]]) -> int:
+        """
+        ChannelInvalid: access hash устарел и в нашем кэше, и в кэше сессии Telethon,
+        поэтому записи сбрасываются и каналы разрешаются заново по сети.
+        Возвращает число каналов, которые разрешить не удалось.
+        """
+        peer_ids = {self.peer_id(p) for p in peers}
+        await self.invalidate(client_key, peer_ids)
+        missing = {p for p in peer_ids if utils.resolve_id(p)[1] is PeerChannel}
+        if not missing:
+            return 0
+        try:
+            found = await self._fetch(client, missing)
+        except RPCError as e:
+            log(f"Клиент {client_key}: не удалось обновить access hash каналов: {e}")
+            return len(missing)
+        await self._remember(client_key, found)
+        if missing:
+            log(f"Клиент {client_key}: каналы {sorted(missing)} не найдены при обновлении access hash")
+        return len(missing)
+
+    async def resolve(self, client_key: str, client: TelegramClient, peer_ids: Iterable[int]) -> int:
+        """
+        Разрешает неизвестные каналы пачками: сначала локальный кэш сессии Telethon,
+        затем по сети (_fetch). Возвращает число каналов, оставшихся неразрешёнными.
+        """
+        missing: Set[int] = set()
+        found: List[object] = []
+        for peer_id in set(peer_ids):
+            if utils.resolve_id(peer_id)[1] is not PeerChannel or self.get(client_key, peer_id) is not None:
+                continue
+            try:
+                found.append(client.session.get_input_entity(peer_id))
+            except (ValueError, TypeError):
+                missing.add(peer_id)
+        if missing:
+            found.extend(await self._fetch(client, missing))
+        await self._remember(client_key, found)
+        if missing:
+            log(f"Клиент {client_key}: не удалось разрешить каналы {sorted(missing)}")
+        return len(missing)
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Ограничение частоты отправки: token bucket на весь процесс, на клиент и на склад,
+плюс «парковка» клиента/склада по FloodWait от сервера и полосы приоритета
+"""
+import asyncio
+import time
+from typing import Dict, Tuple
+
+# Полосы приоритета: меньше — важнее
+LANE_INTERACTIVE = 0  # ответы админам (команды, кнопки)
+LANE_LIVE = 1  # живые посты
+LANE_BULK = 2  # догоняние, бэкфилл, повторы
+LANE_NAMES = {LANE_INTERACTIVE: "interactive", LANE_LIVE: "live", LANE_BULK: "bulk"}
+
+
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше capacity"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = max(rate, 1e-6)
+        self.capacity = max(capacity, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now: float, reserve: float = 0.0) -> float:
+        """Через сколько секунд будет доступен токен сверх reserve (0 — уже доступен)"""
+        self._refill(now)
+        need = 1.0 + min(reserve, self.capacity - 1.0)
+        if self.tokens >= need:
+            return 0.0
+        return (need - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1.0
+
+
+class RateLimiter:
+    """
+    Отправка разрешена, когда токен есть сразу в трёх корзинах: глобальной,
+    клиента и склада. FloodWait паркует клиент (лимит аккаунта), SlowModeWait —
+    только склад; остальные клиенты и склады продолжают работать.
+
+    Полосы: в глобальной корзине и корзине клиента для более важных полос
+    оставляется запас токенов — живые посты не трогают reserve_interactive,
+    массовая пересылка не трогает ещё и reserve_live. Поэтому ответ админу не ждёт
+    токена даже под нагрузкой. Сразу после действия админа (interactive_hold сек)
+    массовая пересылка стоит целиком.
+    """
+
+    def __init__(self, global_per_sec: float, client_per_sec: float,
+                 target_per_min: float, target_burst: float,
+                 reserve_interactive: float = 0.0, reserve_live: float = 0.0, interactive_hold: float = 0.0):
+        self._global = TokenBucket(global_per_sec, global_per_sec)
+        # Запас токенов, недоступный полосе: для полосы — сумма запасов более важных полос
+        self._reserve = {
+            LANE_INTERACTIVE: 0.0,
+            LANE_LIVE: max(0.0, reserve_interactive),
+            LANE_BULK: max(0.0, reserve_interactive) + max(0.0, reserve_live),
+        }
+        self.interactive_hold = max(0.0, interactive_hold)
+        self._interactive_until = 0.0
+        self.lane_waits: Dict[int, float] = {lane: 0.0 for lane in LANE_NAMES}  # суммарное ожидание, сек
+        self._client_rate = client_per_sec
+        self._target_rate = target_per_min / 60.0
+        self._target_burst = target_burst
+        self._clients: Dict[str, TokenBucket] = {}
+        self._targets: Dict[int, TokenBucket] = {}
+        self._parked: Dict[Tuple[str, object], float] = {}
+        self.flood_waits = 0
+
+    def _client_bucket(self, client_key: str) -> TokenBucket:
+        bucket = self._clients.get(client_key)
+        if bucket is None:
+            bucket = self._clients[client_key] = TokenBucket(self._client_rate, self._client_rate)
+        return bucket
+
+    def _target_bucket(self, target: int) -> TokenBucket:
+        bucket = self._targets.get(target)
+        if bucket is None:
+            bucket = self._targets[target] = TokenBucket(self._target_rate, self._target_burst)
+        return bucket
+
+    def parked_for(self, client_key: str, target: int) -> float:
+        """Сколько секунд ещё запрещена отправка этим клиентом в этот склад"""
+        now = time.monotonic()
+        until = max(
+            self._parked.get(("client", client_key), 0.0),
+            self._parked.get(("target", target), 0.0),
+        )
+        return max(0.0, until - now)
+
+    def park_client(self, client_key: str, seconds: float) -> None:
+        self.flood_waits += 1
+        key = ("client", client_key)
+        self._parked[key] = max(self._parked.get(key, 0.0), time.monotonic() + seconds)
+
+    def park_target(self, target: int, seconds: float) -> None:
+        self.flood_waits += 1
+        key = ("target", target)
+        self._parked[key] = max(self._parked.get(key, 0.0), time.monotonic() + seconds)
+
+    def note_interactive(self, client_key: str) -> None:
+        """
+        Действие админа: списывает токен на ответ без ожидания (запас полосы для
+        этого и держится) и приостанавливает массовую пересылку на interactive_hold
+        """
+        now = time.monotonic()
+        self._global.take(now)
+        self._client_bucket(client_key).take(now)
+        self._interactive_until = now + self.interactive_hold
+
+    async def acquire(self, client_key: str, target: int, lane: int = LANE_LIVE) -> None:
+        """Ждёт, пока отправка уложится во все лимиты с учётом запаса полосы, и списывает токены"""
+        client_bucket = self._client_bucket(client_key)
+        target_bucket = self._target_bucket(target)
+        reserve = self._reserve.get(lane, 0.0)
+        started = time.monotonic()
+        while True:
+            now = time.monotonic()
+            wait = max(
+                self._global.delay(now, reserve),
+                client_bucket.delay(now, reserve),
+                target_bucket.delay(now),
+                self._interactive_until - now if lane == LANE_BULK else 0.0,
+            )
+            if wait <= 0:
+                self._global.take(now)
+                client_bucket.take(now)
+                target_bucket.take(now)
+                self.lane_waits[lane] = self.lane_waits.get(lane, 0.0) + (now - started)
+                return
+            await asyncio.sleep(wait)
+
+    def stats(self) -> Dict[str, object]:
+        now = time.monotonic()
+        parked = {f"{kind}:{name}": round(until - now) for (kind, name), until in self._parked.items() if until > now}
+        waits = {LANE_NAMES.get(lane, str(lane)): round(sec, 1) for lane, sec in self.lane_waits.items()}
+        return {"flood_waits": self.flood_waits, "parked": parked, "lane_waits": waits}
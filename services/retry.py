@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Повторы неудачных пересылок: очередь в SQLite с экспоненциальной задержкой и dead letters
+"""
+import asyncio
+import random
+import time
+from typing import Awaitable, Callable, Optional, Set
+from config import RETRY_BASE_SEC, RETRY_MAX_SEC, RETRY_MAX_ATTEMPTS, RETRY_POLL_SEC, RETRY_BATCH
+from database import AsyncDatabase
+from services.delivery import DeliveryJob
+from services.scheduler import Scheduler
+from services.ratelimit import LANE_BULK
+from services.errors import NON_RETRYABLE, classify
+from utils.logger import log
+
+
+class RetryService:
+    """
+    Неудачное задание сохраняется в retry_queue с next_at = now + backoff (с джиттером).
+    Фоновый цикл небольшими пачками забирает созревшие повторы и ставит их в очередь
+    доставки; планировщик будит его к next_at, а опрос раз в poll_interval
+    подхватывает повторы, оставшиеся от прошлого запуска.
+    После RETRY_MAX_ATTEMPTS попыток задание уходит в dead_letters.
+    """
+
+    def __init__(self, db: AsyncDatabase, enqueue: Callable[[DeliveryJob], Awaitable[None]],
+                 base: float = RETRY_BASE_SEC, max_delay: float = RETRY_MAX_SEC,
+                 max_attempts: int = RETRY_MAX_ATTEMPTS, poll_interval: float = RETRY_POLL_SEC,
+                 batch: int = RETRY_BATCH, scheduler: Optional[Scheduler] = None):
+        self.db = db
+        self.enqueue = enqueue
+        self.base = max(0.1, base)
+        self.max_delay = max(self.base, max_delay)
+        self.max_attempts = max(1, max_attempts)
+        self.poll_interval = max(0.5, poll_interval)
+        self.batch = max(1, batch)
+        self.scheduler = scheduler
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        # Повторы, уже стоящие в очереди доставки: задание может ждать там дольше аренды
+        self._inflight: Set[int] = set()
+        self.dead_count = 0
+
+    def backoff(self, attempts: int) -> float:
+        """Экспоненциальная задержка с джиттером ±50%"""
+        delay = min(self.max_delay, self.base * (2 ** max(0, attempts - 1)))
+        return delay * random.uniform(0.5, 1.5)
+
+    async def schedule(self, job: DeliveryJob, error: Exception) -> None:
+        """Записывает неудачу: следующий повтор или dead letter"""
+        self._inflight.discard(job.retry_id)
+        attempts = job.attempts + 1
+        error_text = f"{type(error).__name__}: {error}"[:500]
+        try:
+            # Отключённый склад и удалённые исходные сообщения повторять бесполезно
+            if attempts >= self.max_attempts or classify(error) in NON_RETRYABLE:
+                await self.db.add_dead_letter(
+                    job.source_id, job.target_id, job.message_ids, job.album, attempts, error_text, job.retry_id
+                )
+                self.dead_count += 1
+                log(f"ОШИБКА: пересылка {job.source_id} → {job.target_id} {job.message_ids} "
+                    f"не удалась ({error_text}), попыток: {attempts}, перенесена в dead letters")
+                return
+            delay = self.backoff(attempts)
+            retry_id = await self.db.add_retry(
+                job.source_id, job.target_id, job.message_ids, job.album,
+                attempts, time.time() + delay, error_text, job.retry_id
+            )
+            if self.scheduler is not None:
+                self.scheduler.call_later(delay, ("retry", retry_id), self._wake.set)
+            log(f"Повтор пересылки {job.source_id} → {job.target_id} через {delay:.0f} сек (попытка {attempts + 1})")
+        except Exception as e:
+            log(f"ОШИБКА записи повтора пересылки {job.source_id} → {job.target_id}: {e}")
+
+    async def complete(self, job: DeliveryJob) -> None:
+        """Удаляет успешно выполненный повтор"""
+        if job.retry_id is None:
+            return
+        self._inflight.discard(job.retry_id)
+        try:
+            await self.db.delete_retry(job.retry_id)
+        except Exception as e:
+            log(f"ОШИБКА удаления выполненного повтора {job.retry_id}: {e}")
+
+    async def poll(self) -> int:
+        """Ставит в очередь доставки созревшие повторы. Возвращает их количество."""
+        # Аренда с запасом: пока повтор в очереди доставки, его не заберут повторно
+        lease = self.max_delay
+        rows = await self.db.claim_due_retries(time.time(), self.batch, lease)
+        queued = 0
+        for retry_id, source_id, target_id, message_ids, album, attempts in rows:
+            # Аренда истекла, а задание всё ещё ждёт в очереди — второй раз не ставим
+            if retry_id in self._inflight:
+                continue
+            self._inflight.add(retry_id)
+            try:
+                await self.enqueue(DeliveryJob(
+                    source_id, target_id, message_ids, album=album, retry_id=retry_id, attempts=attempts,
+                    lane=LANE_BULK
+                ))
+            except Exception:
+                self._inflight.discard(retry_id)
+                raise
+            queued += 1
+        return queued
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log(f"ОШИБКА цикла повторов: {e}")
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
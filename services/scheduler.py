@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Общий планировщик отложенных действий: одна задача-таймер вместо задачи на каждое ожидание
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Any, Callable, Dict, Hashable, List, Optional, Set, Tuple
+from utils.logger import log
+
+
+class Scheduler:
+    """
+    Дедлайны лежат в куче, у каждого — ключ. Повторное планирование по тому же ключу
+    просто переносит дедлайн (старая запись в куче становится устаревшей и
+    пропускается), отмена — O(1). Одна фоновая задача спит до ближайшего дедлайна,
+    так что накладные расходы не растут с числом ожидающих альбомов и повторов.
+    Колбэк может быть корутинной функцией — тогда он запускается отдельной задачей.
+    """
+
+    def __init__(self):
+        self._entries: Dict[Hashable, Tuple[float, int, Callable, tuple]] = {}
+        self._heap: List[Tuple[float, int, Hashable]] = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._running: Set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def call_later(self, delay: float, key: Optional[Hashable], callback: Callable, *args: Any) -> Hashable:
+        """Планирует callback(*args) через delay секунд; существующий дедлайн ключа переносится"""
+        return self.call_at(time.monotonic() + max(0.0, delay), key, callback, *args)
+
+    def call_at(self, when: float, key: Optional[Hashable], callback: Callable, *args: Any) -> Hashable:
+        if key is None:
+            key = object()  # анонимное действие, отменить его нельзя
+        seq = next(self._seq)
+        self._entries[key] = (when, seq, callback, args)
+        if not self._heap or when < self._heap[0][0]:
+            self._wakeup.set()
+        heapq.heappush(self._heap, (when, seq, key))
+        # Переносы оставляют в куче устаревшие записи — периодически пересобираем её
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [(w, s, k) for k, (w, s, _, _) in self._entries.items()]
+            heapq.heapify(self._heap)
+        return key
+
+    def cancel(self, key: Hashable) -> bool:
+        return self._entries.pop(key, None) is not None
+
+    def deadline(self, key: Hashable) -> Optional[float]:
+        entry = self._entries.get(key)
+        return entry[0] if entry else None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Останавливает таймер; несработавшие действия остаются в планировщике"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._running:
+            await asyncio.gather(*self._running, return_exceptions=True)
+
+    def _fire(self, callback: Callable, args: tuple) -> None:
+        try:
+            result = callback(*args)
+        except Exception as e:
+            log(f"ОШИБКА отложенного действия {getattr(callback, '__name__', callback)}: {e}")
+            return
+        if asyncio.iscoroutine(result):
+            task = asyncio.create_task(result)
+            self._running.add(task)
+            task.add_done_callback(self._task_done)
+
+    def _task_done(self, task: asyncio.Task) -> None:
+        self._running.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            log(f"ОШИБКА отложенного действия: {task.exception()}")
+
+    async def _run(self) -> None:
+        while True:
+            now = time.monotonic()
+            while self._heap and self._heap[0][0] <= now:
+                when, seq, key = heapq.heappop(self._heap)
+                entry = self._entries.get(key)
+                if entry is None or entry[1] != seq:
+                    continue  # отменено или перенесено
+                del self._entries[key]
+                self._fire(entry[2], entry[3])
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Пул user-сессий: несколько аккаунтов для резервной пересылки с выбором наименее загруженного
+"""
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from telethon import TelegramClient
+from services.capabilities import probe_client
+
+# Вес нового замера в скользящей средней задержки
+LATENCY_ALPHA = 0.2
+# Оценка задержки для сессии без замеров
+DEFAULT_LATENCY = 0.5
+
+
+class UserSession:
+    """Один аккаунт: клиент, здоровье, текущая нагрузка и средняя задержка отправки"""
+
+    def __init__(self, name: str, client: TelegramClient):
+        self.name = name
+        self.client = client
+        self.healthy = True
+        self.inflight = 0
+        self.latency: Optional[float] = None  # EWMA, сек
+        self.sends = 0
+        self.failures = 0
+        self.denied: Set[int] = set()  # склады, куда аккаунт не может публиковать
+
+    @property
+    def key(self) -> str:
+        """Ключ клиента для лимитов частоты и FloodWait"""
+        return f"user:{self.name}"
+
+    @property
+    def available(self) -> bool:
+        try:
+            return self.healthy and self.client.is_connected()
+        except Exception:
+            return False
+
+    def load(self) -> float:
+        """Ожидаемое время до завершения ещё одной отправки"""
+        latency = self.latency if self.latency is not None else DEFAULT_LATENCY
+        return (self.inflight + 1) * latency
+
+    def observe(self, seconds: float) -> None:
+        self.sends += 1
+        self.latency = seconds if self.latency is None else (
+            LATENCY_ALPHA * seconds + (1 - LATENCY_ALPHA) * self.latency
+        )
+
+
+class SessionPool:
+    """
+    Для каждой отправки выбирается доступная сессия, которой склад не запрещён,
+    с наименьшей нагрузкой; сессии на паузе FloodWait — в последнюю очередь.
+    Первая сессия — основная (через неё принимаются события и резолвятся названия).
+    """
+
+    def __init__(self):
+        self._sessions: Dict[str, UserSession] = {}
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __iter__(self):
+        return iter(list(self._sessions.values()))
+
+    @property
+    def primary(self) -> Optional[UserSession]:
+        for session in self._sessions.values():
+            return session
+        return None
+
+    def get(self, name: str) -> Optional[UserSession]:
+        return self._sessions.get(name)
+
+    def add(self, name: str, client: TelegramClient) -> UserSession:
+        session = self._sessions.get(name)
+        if session is None:
+            session = self._sessions[name] = UserSession(name, client)
+        else:
+            session.client = client
+        session.healthy = True
+        return session
+
+    def mark_down(self, name: str) -> None:
+        session = self._sessions.get(name)
+        if session is not None:
+            session.healthy = False
+
+    def pick(self, target: int, exclude: Set[str], parked_for: Callable[[str], float]) -> Optional[UserSession]:
+        candidates = [
+            s for s in self._sessions.values()
+            if s.name not in exclude and s.available and target not in s.denied
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda s: (parked_for(s.key) > 0, s.load()))
+
+    def deny(self, session: UserSession, target: int) -> None:
+        session.denied.add(target)
+
+    def has_access(self, target: int) -> bool:
+        """Есть ли сессия, которой склад не запрещён"""
+        return any(s.available and target not in s.denied for s in self._sessions.values())
+
+    async def probe(self, target: int) -> Tuple[Optional[bool], Optional[str]]:
+        """Проверяет права каждой сессии; склад доступен, если может хотя бы одна"""
+        result: Optional[bool] = None
+        error: Optional[str] = None
+        for session in self:
+            if not session.available:
+                continue
+            ok, err = await probe_client(session.client, target)
+            if ok is None:
+                continue
+            if ok:
+                session.denied.discard(target)
+                result = True
+            else:
+                session.denied.add(target)
+                if result is None:
+                    result, error = False, err
+        return result, (None if result else error)
+
+    def stats(self) -> List[Dict[str, object]]:
+        return [
+            {
+                "name": s.name,
+                "up": s.available,
+                "inflight": s.inflight,
+                "latency_ms": round(s.latency * 1000) if s.latency is not None else None,
+                "sends": s.sends,
+                "failures": s.failures,
+                "denied": len(s.denied),
+            }
+            for s in self._sessions.values()
+        ]
@@ -79,6 +79,8 @@ Environment="PATH=$PROJECT_DIR/venv/bin"
 ExecStart=$VENV_PYTHON $PROJECT_DIR/main.py
 Restart=always
 RestartSec=10
+KillSignal=SIGTERM
+TimeoutStopSec=60
 StandardOutput=append:$PROJECT_DIR/bot.log
 StandardError=append:$PROJECT_DIR/bot.log
 
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import html
 from typing import List, Optional, Tuple, Union
 from telethon.tl.types import Channel, Chat
 from telethon.utils import get_display_name
@@ -14,9 +15,9 @@ def make_channel_link(name: str, chat_id: int, username: Optional[str] = None, i
     return name
 
 
-def render_sources_view(db) -> Tuple[str, List]:
+async def render_sources_view(db) -> Tuple[str, List]:
     """Формирует текст и кнопки для списка источников"""
-    items = db.list_sources()
+    items = await db.list_sources()
     if not items:
         text = "Источников нет."
         buttons = [[Button.inline("Закрыть", b"close_msg")]]
@@ -30,9 +31,9 @@ def render_sources_view(db) -> Tuple[str, List]:
     return "\n".join(lines), buttons
 
 
-def render_targets_view(db) -> Tuple[str, List]:
+async def render_targets_view(db) -> Tuple[str, List]:
     """Формирует текст и кнопки для списка складов"""
-    items = db.list_targets()
+    items = await db.list_targets()
     if not items:
         text = "Складов нет."
         buttons = [[Button.inline("Закрыть", b"close_msg")]]
@@ -46,18 +47,18 @@ def render_targets_view(db) -> Tuple[str, List]:
     return "\n".join(lines), buttons
 
 
-def render_settings_main(db) -> Tuple[str, List]:
+async def render_settings_main(db) -> Tuple[str, List]:
     """Формирует текст и кнопки для главного экрана настроек шага репостов"""
-    default_step = db.get_repost_step()
+    default_step, target_steps = db.get_repost_steps()
     default_desc = "все посты" if default_step == 1 else f"каждый {default_step}-й пост"
     lines = [f"<b>Шаг репостов</b>\n", f"По умолчанию: <b>{default_desc}</b>\n"]
     btns = [[Button.inline("По умолч. 1", b"set_step_1"), Button.inline("2", b"set_step_2"),
             Button.inline("3", b"set_step_3"), Button.inline("4", b"set_step_4")]]
-    targets = db.list_targets()
+    targets = await db.list_targets()
     if targets:
         lines.append("Выбери склад:")
         for tid, tname, tuser, tinv in targets:
-            s = db.get_repost_step(tid)
+            s = target_steps.get(tid, default_step)
             sd = "все" if s == 1 else f"каждый {s}-й"
             lines.append(f"• {make_channel_link(tname, tid, tuser, tinv)} — {sd}")
             btns.append([Button.inline(f"⚙️ {tname[:20]}", f"tgt_step_{tid}".encode())])
@@ -67,6 +68,78 @@ def render_settings_main(db) -> Tuple[str, List]:
     return "\n".join(lines), btns
 
 
+def render_status(forwarder) -> str:
+    """Формирует текст со статистикой очередей доставки"""
+    q = forwarder.queue.stats()
+    lines = [
+        "<b>Очереди доставки</b>",
+        f"В очереди: <b>{q['queued']}</b> из {q['max_backlog']} (ключей: {q['keys']}, массовых заданий: {q['bulk']})",
+    ]
+    if q["spilled"]:
+        lines.append(f"На диске: {q['spilled']}")
+    if q["dropped"]:
+        lines.append(f"Отброшено при переполнении: {q['dropped']}")
+    rl = forwarder.limiter.stats()
+    lines.append(f"FloodWait с запуска: {rl['flood_waits']}")
+    waits = rl["lane_waits"]
+    lines.append(
+        f"Ожидание лимитов: живые {waits.get('live', 0)} сек, массовые {waits.get('bulk', 0)} сек"
+    )
+    for name, seconds in rl["parked"].items():
+        lines.append(f"• на паузе {name}: ещё {seconds} сек")
+    caps = forwarder.capabilities.stats()
+    lines.append(
+        f"Склады: через бота {caps['bot']}, только через user client {caps['user_only']}, "
+        f"недоступны {caps['none']}, не проверены {caps['unknown']}"
+    )
+    breakers = forwarder.breakers.stats()
+    if breakers:
+        lines.append("Отключённые склады:")
+        for target, state, failures, probe_in in breakers:
+            status = "пробная доставка" if state == "half_open" else f"проверка через {probe_in:.0f} сек"
+            lines.append(f"• {target}: неудач {failures}, {status}")
+    claims = forwarder.claims.stats()
+    if claims["claimed"]:
+        claimed = ", ".join(f"{name} {count}" for name, count in sorted(claims["claimed"].items()))
+        lines.append(f"Получено первым: {claimed}; дублей отброшено: {claims['dropped']}")
+        for name, wins in sorted(claims["wins"].items()):
+            lines.append(f"• {name} опережает в {wins} гонках, в среднем на {claims['lead_ms'].get(name, 0)} мс")
+    sessions = forwarder.users.stats()
+    if sessions:
+        lines.append("User-сессии:")
+        for st in sessions:
+            latency = f"{st['latency_ms']} мс" if st["latency_ms"] is not None else "—"
+            lines.append(
+                f"• {html.escape(st['name'])}: {'✓' if st['up'] else '✗'}, в работе {st['inflight']}, "
+                f"задержка {latency}, отправок {st['sends']}, ошибок {st['failures']}"
+            )
+    if q["deepest"]:
+        lines.append("Самые длинные очереди:")
+        for (source_id, target_id), depth in q["deepest"]:
+            lines.append(f"• {source_id} → {target_id}: {depth}")
+    return "\n".join(lines)
+
+
+async def render_dead_letters(db) -> Tuple[str, List]:
+    """Формирует текст и кнопки для списка неудавшихся пересылок (dead letters)"""
+    total = await db.count_dead_letters()
+    retries = await db.count_retries()
+    if not total:
+        text = f"Неудавшихся пересылок нет.\nОжидают повтора: {retries}"
+        return text, [[Button.inline("Закрыть", b"close_msg")]]
+    items = await db.list_dead_letters(20)
+    lines = [f"<b>Неудавшиеся пересылки:</b> {total} (ожидают повтора: {retries})"]
+    buttons = []
+    for dead_id, source_id, target_id, message_ids, attempts, error, _ in items:
+        ids = ", ".join(str(i) for i in message_ids[:5]) + ("…" if len(message_ids) > 5 else "")
+        lines.append(f"#{dead_id} {source_id} → {target_id} [{ids}], попыток: {attempts}\n   <code>{html.escape(error[:120])}</code>")
+        buttons.append(Button.inline(f"♻️ #{dead_id}", f"dl_replay_{dead_id}".encode()))
+    rows = chunk_buttons(buttons, per_row=4)
+    rows.append([Button.inline("♻️ Повторить все", b"dl_replay_all"), Button.inline("🗑 Очистить", b"dl_clear")])
+    rows.append([Button.inline("Закрыть", b"close_msg")])
+    return "\n".join(lines), rows
+
+
 def chunk_buttons(buttons: list, per_row: int = 2) -> List[List]:
     """Разбивает кнопки на строки"""
     if per_row < 1: